@@ -1,13 +1,36 @@
 from crypt import methods
 import os
 import sys
+from functools import partial
+from hmac import compare_digest
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   abort)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import (db, connect_db, identity_cache, User, Message, Likes,
+                    Follows, Recommendation)
+from timelines import make_timeline
+from follow_graph import FollowGraph
+from user_search import UserSearch, USERS_PER_PAGE, create_trigram_indexes
+from message_search import MessageSearch
+from passwords import PasswordHasherBusy, password_hasher
+from principals import PrincipalCache
+from likes import make_likes
+from fragments import FragmentCache
+from sql_stats import SQLStats
+from slow_queries import SlowQueryLog
+from profiling import RequestProfiler
+from http_cache import HTTPCache
+from assets import Assets, build as build_assets
+from compression import Compression
+from metrics import (Metrics, CONTENT_TYPE, cache_samples, password_samples,
+                     sql_samples, compression_samples)
+import read_models
+from bulk_load import load_csvs
 
 CURR_USER_KEY = "curr_user"
 
@@ -25,7 +48,173 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 toolbar = DebugToolbarExtension(app)
 
+# How home timelines are built: 'join' queries them on every read,
+# 'fanout' materializes them per follower when messages are written,
+# 'ring' merges per-author ring buffers held in memory.
+app.config['TIMELINE_MODE'] = os.environ.get('TIMELINE_MODE', 'join')
+app.config['TIMELINE_MAX_LENGTH'] = int(
+    os.environ.get('TIMELINE_MAX_LENGTH', 800))
+app.config['TIMELINE_FANOUT_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_FANOUT_THRESHOLD', 10000))
+app.config['TIMELINE_RING_SIZE'] = int(
+    os.environ.get('TIMELINE_RING_SIZE', 100))
+app.config['TIMELINE_MAX_AUTHORS'] = int(
+    os.environ.get('TIMELINE_MAX_AUTHORS', 100000))
+# Seconds before in-memory timelines ('fanout' and 'ring') are reloaded
+# from the database, picking up messages and follows from other processes.
+app.config['TIMELINE_MAX_AGE'] = int(
+    os.environ.get('TIMELINE_MAX_AGE', 60))
+
+# Seconds before the in-memory follow graph is reloaded from the database,
+# picking up follows made by other processes.
+app.config['FOLLOW_GRAPH_MAX_AGE'] = int(
+    os.environ.get('FOLLOW_GRAPH_MAX_AGE', 60))
+
+# Seconds before the in-memory username search index (used when the
+# database has no pg_trgm) is reloaded from the database.
+app.config['USER_SEARCH_MAX_AGE'] = int(
+    os.environ.get('USER_SEARCH_MAX_AGE', 300))
+
+# Message search: 'postgres' full-text search, a 'disk' inverted index
+# for other databases, or 'auto' to pick based on the database.
+app.config['MESSAGE_SEARCH_BACKEND'] = os.environ.get(
+    'MESSAGE_SEARCH_BACKEND', 'auto')
+app.config['MESSAGE_SEARCH_INDEX'] = os.environ.get(
+    'MESSAGE_SEARCH_INDEX', os.path.join(app.instance_path, 'message-search'))
+
+# bcrypt cost for new password hashes (older hashes are upgraded on login),
+# and how much bcrypt work may run or wait at once.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_MAX_WORKERS'] = int(os.environ.get('BCRYPT_MAX_WORKERS', 4))
+app.config['BCRYPT_MAX_QUEUE'] = int(os.environ.get('BCRYPT_MAX_QUEUE', 64))
+
+# How long (seconds) and for how many users a logged-in user's basic
+# details are cached between requests.
+app.config['PRINCIPAL_CACHE_TTL'] = int(
+    os.environ.get('PRINCIPAL_CACHE_TTL', 60))
+app.config['PRINCIPAL_CACHE_SIZE'] = int(
+    os.environ.get('PRINCIPAL_CACHE_SIZE', 10000))
+
+# Seconds to collect likes before writing them in one batch (0 writes
+# each like straight away), and how many may wait before an early flush.
+app.config['LIKE_BUFFER_INTERVAL'] = float(
+    os.environ.get('LIKE_BUFFER_INTERVAL', 0))
+app.config['LIKE_BUFFER_MAX_PENDING'] = int(
+    os.environ.get('LIKE_BUFFER_MAX_PENDING', 1000))
+
+# Rows of users and messages cached by primary key between requests (0
+# turns the cache off) for up to IDENTITY_CACHE_TTL seconds, as changes
+# made by other worker processes aren't seen; or the import path of a
+# shared cache backend, which sees them.
+app.config['IDENTITY_CACHE_SIZE'] = int(
+    os.environ.get('IDENTITY_CACHE_SIZE', 10000))
+app.config['IDENTITY_CACHE_TTL'] = float(
+    os.environ.get('IDENTITY_CACHE_TTL', 10))
+app.config['IDENTITY_CACHE_BACKEND'] = os.environ.get('IDENTITY_CACHE_BACKEND')
+
+# Rendered message and user card fragments kept for reuse (0 turns the
+# fragment cache off).
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+
+# Statements run this many times in one request are logged as a likely
+# N+1 query (0 turns that off), and whether responses get X-SQL-* headers
+# with the request's statement count and time (by default, everywhere
+# but production).
+app.config['SQL_REPEAT_THRESHOLD'] = int(
+    os.environ.get('SQL_REPEAT_THRESHOLD', 5))
+app.config['SQL_STATS_HEADERS'] = bool(int(
+    os.environ.get('SQL_STATS_HEADERS', app.config['ENV'] != 'production')))
+
+# Statements slower than SLOW_QUERY_MS are logged with their EXPLAIN plan
+# (0 turns this off); a fraction of slow SELECTs are EXPLAIN ANALYZEd on
+# PostgreSQL. See slow_queries.py for the log file settings.
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['SLOW_QUERY_ANALYZE_RATE'] = float(
+    os.environ.get('SLOW_QUERY_ANALYZE_RATE', 0))
+app.config['SLOW_QUERY_LOG'] = os.environ.get(
+    'SLOW_QUERY_LOG', os.path.join(app.instance_path, 'slow-queries.log'))
+
+# Per-request profiling (see profiling.py): a fraction of requests, only
+# to PROFILE_ENDPOINTS (comma separated) if set, plus any carrying a
+# token from `flask profile-token`, are profiled into PROFILE_DIR, by
+# 'sample'-ing their stack every PROFILE_INTERVAL seconds or 'cprofile'.
+app.config['PROFILE_SAMPLE_RATE'] = float(
+    os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_ENDPOINTS'] = set(
+    filter(None, os.environ.get('PROFILE_ENDPOINTS', '').split(',')))
+app.config['PROFILE_MODE'] = os.environ.get('PROFILE_MODE', 'sample')
+app.config['PROFILE_INTERVAL'] = float(
+    os.environ.get('PROFILE_INTERVAL', 0.005))
+app.config['PROFILE_DIR'] = os.environ.get(
+    'PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+
+# Browser caching of pages: off in development (everything is no-store),
+# otherwise pages get per-view Cache-Control policies and ETags (see
+# http_cache.py). HTTP_CACHE_SALT (e.g. the release id) changes every
+# ETag; older timeline pages may be reused for TIMELINE_CACHE_SECONDS.
+app.config['HTTP_CACHING'] = bool(int(
+    os.environ.get('HTTP_CACHING', app.config['ENV'] != 'development')))
+app.config['HTTP_CACHE_SALT'] = os.environ.get('HTTP_CACHE_SALT', '')
+app.config['TIMELINE_CACHE_SECONDS'] = int(
+    os.environ.get('TIMELINE_CACHE_SECONDS', 30))
+
+# Link templates to the content-hashed copies of static files made by
+# `flask build-assets` (off in development, where files change under you).
+app.config['ASSET_FINGERPRINTS'] = bool(int(
+    os.environ.get('ASSET_FINGERPRINTS', app.config['ENV'] != 'development')))
+
+# Responses of at least COMPRESSION_MIN_SIZE bytes are gzip (or brotli)
+# compressed for browsers that accept it, at these levels (see
+# compression.py; set COMPRESSION=0 if a proxy in front compresses).
+app.config['COMPRESSION'] = bool(int(os.environ.get('COMPRESSION', 1)))
+app.config['COMPRESSION_MIN_SIZE'] = int(
+    os.environ.get('COMPRESSION_MIN_SIZE', 500))
+app.config['COMPRESSION_GZIP_LEVEL'] = int(
+    os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+app.config['COMPRESSION_BROTLI_QUALITY'] = int(
+    os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+
+# Usernames (comma separated) allowed to see admin pages.
+app.config['ADMIN_USERNAMES'] = set(
+    filter(None, os.environ.get('ADMIN_USERNAMES', '').split(',')))
+
+# /metrics is for admins and for scrapers sending this bearer token.
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+
 connect_db(app)
+follow_graph = FollowGraph(max_age=app.config['FOLLOW_GRAPH_MAX_AGE'])
+timeline = make_timeline(app.config, follow_graph)
+timeline.init_app(app)
+user_search = UserSearch(max_age=app.config['USER_SEARCH_MAX_AGE'])
+message_search = MessageSearch(app.config['MESSAGE_SEARCH_BACKEND'],
+                               app.config['MESSAGE_SEARCH_INDEX'])
+principals = PrincipalCache(ttl=app.config['PRINCIPAL_CACHE_TTL'],
+                            max_size=app.config['PRINCIPAL_CACHE_SIZE'])
+like_writer = make_likes(app)
+fragments = FragmentCache(max_size=app.config['FRAGMENT_CACHE_SIZE'])
+fragments.init_app(app)
+sql_stats = SQLStats(repeat_threshold=app.config['SQL_REPEAT_THRESHOLD'],
+                     headers=app.config['SQL_STATS_HEADERS'])
+sql_stats.init_app(app, db.get_engine(app))
+slow_queries = SlowQueryLog()
+slow_queries.init_app(app, db.get_engine(app))
+assets = Assets()
+assets.init_app(app)
+http_cache = HTTPCache()
+http_cache.init_app(app)
+profiler = RequestProfiler()
+profiler.init_app(app)
+metrics = Metrics()
+metrics.init_app(app, db.get_engine(app))
+metrics.add_collector(partial(cache_samples, {'principals': principals,
+                                              'identity': identity_cache,
+                                              'fragments': fragments}))
+metrics.add_collector(partial(password_samples, password_hasher))
+metrics.add_collector(partial(sql_samples, sql_stats))
+compression = Compression()
+compression.init_app(app)
+metrics.add_collector(partial(compression_samples, compression))
 
 
 ##############################################################################
@@ -34,15 +223,44 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    `g.user` is a cached `Principal` with just the id, username and
+    images; views that need the full `User` call `current_user()`.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = principals.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+def page_viewer(other_id):
+    """What pages show of the viewer, for ETags: their nav bar details and
+    whether they follow `other_id`."""
+
+    if not g.user:
+        return None
+    return (g.user.id, g.user.username, g.user.image_url,
+            follow_graph.is_following(g.user.id, other_id))
+
+
+def current_user():
+    """Full `User` row for the logged-in user, loaded once per request."""
+
+    if 'user_record' not in g:
+        g.user_record = identity_cache.get_or_404(User, g.user.id)
+    return g.user_record
+
+
+@app.context_processor
+def add_follow_graph():
+    """Let templates check follows without loading `following` lists."""
+
+    return dict(follow_graph=follow_graph)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -79,6 +297,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            user_search.changed(user)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -103,6 +322,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # Saves the password if it was rehashed at a new cost.
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -112,6 +333,14 @@ def login():
     return render_template('users/login.html', form=form)
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Too many logins/signups at once: ask the client to retry."""
+
+    return ("Too many sign-ins right now, please try again in a moment.",
+            503, {"Retry-After": "1"})
+
+
 @app.route('/logout')
 def logout():
     """Handle logout of user."""
@@ -129,33 +358,54 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username
+    (or bio), and a 'page' param for pages after the first.
     """
 
     search = request.args.get('q')
+    page = max(request.args.get('page', 1, type=int), 1)
+    offset = (page - 1) * USERS_PER_PAGE
 
+    # Fetch one extra to know whether there is a next page.
     if not search:
-        users = User.query.all()
+        users = (User
+                 .query
+                 .order_by(User.id)
+                 .offset(offset)
+                 .limit(USERS_PER_PAGE + 1)
+                 .all())
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = user_search.search(search, offset, USERS_PER_PAGE + 1)
+
+    has_next = len(users) > USERS_PER_PAGE
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users[:USERS_PER_PAGE],
+                           search=search, page=page, has_next=has_next)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
-
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    user = identity_cache.get_or_404(User, user_id)
+
+    # Messages can't be edited, only added (as the newest) or deleted, so
+    # the newest one and the count pin down which are shown.
+    newest = (db.session
+              .query(Message.id)
+              .filter(Message.user_id == user_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(1)
+              .scalar())
+    not_modified = http_cache.check(
+        'users_show', page_viewer(user.id),
+        user.username, user.image_url, user.header_image_url, user.bio,
+        user.location, user.messages_count, user.following_count,
+        user.followers_count, user.likes_count, newest)
+    if not_modified:
+        return not_modified
+
+    messages = read_models.user_messages(user_id)
     return render_template('users/show.html', user=user, messages=messages)
 
 
@@ -167,7 +417,7 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = identity_cache.get_or_404(User, user_id)
     return render_template('users/following.html', user=user)
 
 
@@ -179,7 +429,7 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = identity_cache.get_or_404(User, user_id)
     return render_template('users/followers.html', user=user)
 
 
@@ -191,9 +441,20 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    identity_cache.get_or_404(User, follow_id)
+    already_following = (Follows
+                         .query
+                         .filter_by(user_following_id=g.user.id,
+                                    user_being_followed_id=follow_id)
+                         .first())
+    if not already_following:
+        db.session.add(Follows(user_following_id=g.user.id,
+                               user_being_followed_id=follow_id))
+        User.update_counts(g.user.id, following_count=1)
+        User.update_counts(follow_id, followers_count=1)
     db.session.commit()
+    timeline.followed(g.user.id, follow_id)
+    follow_graph.add(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -206,9 +467,17 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    removed = (Follows
+               .query
+               .filter_by(user_following_id=g.user.id,
+                          user_being_followed_id=follow_id)
+               .delete())
+    if removed:
+        User.update_counts(g.user.id, following_count=-1)
+        User.update_counts(follow_id, followers_count=-1)
     db.session.commit()
+    timeline.unfollowed(g.user.id, follow_id)
+    follow_graph.remove(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -233,6 +502,8 @@ def profile():
             user.bio = form.bio.data
 
             db.session.commit()
+            principals.invalidate(user.id)
+            user_search.changed(user)
             return redirect(f'/users/{user.id}')
         else:
             flash('Invalid credentials.', "danger")
@@ -249,9 +520,35 @@ def delete_user():
         return redirect("/")
 
     do_logout()
-
-    db.session.delete(g.user)
+    user_id = g.user.id
+
+    # Follows go away with the user, so fix the counts on the other side.
+    followed_ids = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+    follower_ids = (db.session
+                    .query(Follows.user_following_id)
+                    .filter(Follows.user_being_followed_id == user_id))
+    User.update_counts(followed_ids, followers_count=-1)
+    User.update_counts(follower_ids, following_count=-1)
+
+    # So do their messages, and everyone's likes of them.
+    likes_of_theirs = (Likes.query
+                       .join(Message, Likes.message_id == Message.id)
+                       .filter(Message.user_id == user_id))
+    liker_ids = likes_of_theirs.with_entities(Likes.user_id)
+    likes_lost = (likes_of_theirs
+                  .with_entities(db.func.count(Likes.id))
+                  .filter(Likes.user_id == User.id)
+                  .correlate(User)
+                  .as_scalar())
+    User.update_counts(liker_ids, likes_count=-likes_lost)
+
+    db.session.delete(current_user())
     db.session.commit()
+    principals.invalidate(user_id)
+    follow_graph.remove_user(user_id)
+    user_search.removed(user_id)
 
     return redirect("/signup")
 
@@ -263,9 +560,11 @@ def list_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    likes = user.likes
-    return render_template('/users/likes.html', user=user, likes=likes)
+    user = identity_cache.get_or_404(User, user_id)
+    likes, next_cursor = read_models.liked_messages(
+        user_id, after=request.args.get('after', type=int))
+    return render_template('/users/likes.html', user=user, likes=likes,
+                           next_cursor=next_cursor)
 
 @app.route('/users/add_like/<int:msg_id>', methods=["POST"])
 def add_like(msg_id):
@@ -275,17 +574,7 @@ def add_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    likes = g.user.likes
-    for msg in likes:
-        if msg_id == msg.id:
-            like = Likes.query.filter_by(message_id=msg.id).first()
-            db.session.delete(like)
-            db.session.commit()
-            return redirect('/')
-
-    new_like = Likes(user_id=g.user.id, message_id=msg_id)
-    db.session.add(new_like)
-    db.session.commit()
+    like_writer.toggle(g.user.id, msg_id)
 
     return redirect('/')
 
@@ -307,20 +596,51 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        User.update_counts(g.user.id, messages_count=1)
         db.session.commit()
+        timeline.message_added(msg)
+        message_search.added(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search messages.
+
+    Takes a 'q' param with the words to look for, and an 'after' cursor
+    for pages after the first.
+    """
+
+    search = request.args.get('q', '').strip()
+    messages, next_cursor = [], None
+
+    if search:
+        messages, next_cursor = message_search.search(
+            search, after=request.args.get('after'))
+
+    return render_template('messages/search.html', search=search,
+                           messages=messages, next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = identity_cache.get_or_404(Message, message_id)
+    author = msg.user
+
+    not_modified = http_cache.check(
+        'messages_show', page_viewer(author.id),
+        msg.id, msg.text, msg.timestamp,
+        author.id, author.username, author.image_url)
+    if not_modified:
+        return not_modified
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -332,13 +652,126 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = identity_cache.get_or_404(Message, message_id)
+    author_id, text = msg.user_id, msg.text
+    User.update_counts(author_id, messages_count=-1)
+    User.update_counts(
+        db.session.query(Likes.user_id).filter_by(message_id=message_id),
+        likes_count=-1)
     db.session.delete(msg)
     db.session.commit()
+    timeline.message_deleted(message_id, author_id)
+    message_search.deleted(message_id, text)
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts():
+    """Recompute the cached message/follow/like counts of every user."""
+
+    User.reconcile_counts()
+    db.session.commit()
+
+
+@app.cli.command('load-data')
+@click.argument('directory', default='generator')
+@click.option('--batch-size', default=10000,
+              help='Rows per INSERT when the database has no COPY.')
+def load_data(directory, batch_size):
+    """Replace all data with the CSV files in DIRECTORY (see bulk_load.py)."""
+
+    load_csvs(directory, batch_size=batch_size, echo=click.echo)
+
+
+@app.cli.command('profile-token')
+def profile_token():
+    """Print a token; requests with it in X-Warbler-Profile are profiled."""
+
+    click.echo(profiler.make_token())
+
+
+@app.cli.command('build-assets')
+def build_static_assets():
+    """Write hashed, precompressed copies of static files (see assets.py)."""
+
+    build_assets(app.static_folder, echo=click.echo)
+
+
+@app.cli.command('reindex-messages')
+@click.option('--merge', is_flag=True,
+              help='Only fold in the messages logged since the last run.')
+def reindex_messages(merge):
+    """Rebuild the on-disk message search index (for the 'disk' backend)."""
+
+    backend = message_search.backend
+    if merge and hasattr(backend, 'merge'):
+        backend.merge()
+    elif hasattr(backend, 'rebuild'):
+        backend.rebuild()
+
+
+@app.cli.command('create-search-indexes')
+def create_search_indexes():
+    """Add the pg_trgm user search indexes to an existing database."""
+
+    with db.engine.begin() as connection:
+        created = create_trigram_indexes(connection)
+
+    if not created:
+        click.echo("pg_trgm is not available; user search stays in memory")
+
+
+@app.cli.command('compute-recommendations')
+def compute_recommendations():
+    """Recompute "who to follow" suggestions for every user."""
+
+    # Imported here so the web app doesn't need scipy.
+    from recommendations import compute_recommendations
+
+    compute_recommendations()
+
+
+##############################################################################
+# Monitoring
+
+
+@app.route('/metrics')
+def show_metrics():
+    """Metrics of this process, for Prometheus to scrape.
+
+    Only for admins, or requests with `Authorization: Bearer <token>`
+    where the token is METRICS_TOKEN.
+    """
+
+    token = app.config['METRICS_TOKEN']
+    scraper = token and compare_digest(
+        request.headers.get('Authorization', ''), f'Bearer {token}')
+    admin = g.user and g.user.username in app.config['ADMIN_USERNAMES']
+    if not (scraper or admin):
+        abort(403)
+
+    return metrics.render(), 200, {'Content-Type': CONTENT_TYPE}
+
+
+@app.route('/admin/slow-queries')
+def show_slow_queries():
+    """Most recent slow SQL statements and their plans (admins only)."""
+
+    if not g.user or g.user.username not in app.config['ADMIN_USERNAMES']:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_template('admin/slow_queries.html',
+                           queries=list(slow_queries.recent),
+                           total=slow_queries.count,
+                           threshold=app.config['SLOW_QUERY_MS'])
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -349,37 +782,41 @@ def homepage():
 
     - anon users: no messages
     - logged in: 100 most recent messages of followed_users
+
+    Older pages are fetched with `?before=<cursor>`, where the cursor
+    comes from the last message on the previous page.
     """
 
     if g.user:
-        messages = []
-        user = g.user
-        following = user.following
-        likes = user.likes
-        for follow in following:
-            m = follow.messages
-            for message in m:
-                messages.append(message)
+        # Older pages hardly change, and the browser can reuse them for a
+        # while; the first page always shows the viewer's latest follows
+        # and likes.
+        if request.args.get('before'):
+            http_cache.policy(
+                f"private, max-age={app.config['TIMELINE_CACHE_SECONDS']}")
+
+        messages, next_cursor = timeline.page(
+            g.user.id, before=request.args.get('before'))
+        user = current_user()
+        liked = like_writer.liked_message_ids(
+            user, [msg.id for msg in messages])
+
+        suggestions = Recommendation.for_user(g.user.id)
 
-        return render_template('home.html', messages=messages, likes=likes)
+        return render_template('home.html', user=user, messages=messages,
+                               liked=liked, next_cursor=next_cursor,
+                               suggestions=suggestions)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Cache headers (see http_cache.py; turned off in development)
+
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Add the view's cache policy and validators, or no-cache headers."""
+
+    return http_cache.apply(response)
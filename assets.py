@@ -0,0 +1,208 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file under static/ into static/dist/
+with a hash of its contents in the name (`style.css` becomes
+`style.1f0c2d9e4b.css`), rewriting the `url(/static/...)` references in
+stylesheets to the hashed names. Text files also get `.gz` (and `.br`,
+if the brotli package is installed) variants, and a manifest.json maps
+each original path to its hashed one. Copies from earlier builds are
+kept, so pages rendered before a rebuild still find their files.
+
+Templates link to files with `static_url('images/warbler-logo.png')`,
+which gives the hashed URL if the file is in the manifest and the plain
+/static/ URL if not (e.g. before a build, or with ASSET_FINGERPRINTS off,
+the default in development). It also takes stored URLs like users'
+default images, leaving other sites' URLs alone.
+
+A hashed name never gets different contents, so hashed files are served
+with a one-year immutable Cache-Control, as the precompressed variant
+the browser accepts when there is one.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+from flask import abort, request, send_file
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+STATIC_URL = '/static/'
+MANIFEST = 'manifest.json'
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Types worth compressing; images other than these are compressed already.
+COMPRESSIBLE = {'application/javascript', 'application/json',
+                'image/svg+xml', 'image/vnd.microsoft.icon', 'image/x-icon'}
+
+CSS_URL = re.compile(r"""url\((['"]?)/static/([^'")]+)\1\)""")
+
+
+class Assets:
+    """Hashed URLs for templates, and serving the hashed files."""
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.url_prefix = '/static/dist/'
+        self.manifest = {}
+        self.version = ''
+
+    def init_app(self, app):
+        """Load the manifest, add `static_url` and the route for hashed files."""
+
+        self.enabled = app.config.get('ASSET_FINGERPRINTS', True)
+        self.directory = os.path.join(app.static_folder, 'dist')
+        self.manifest = {}
+
+        if self.enabled:
+            path = os.path.join(self.directory, MANIFEST)
+            try:
+                with open(path) as f:
+                    self.manifest = json.load(f)
+            except FileNotFoundError:
+                app.logger.warning(
+                    "No asset manifest at %s; run `flask build-assets`", path)
+        self.version = hashlib.sha1(
+            json.dumps(self.manifest, sort_keys=True).encode()).hexdigest()
+
+        app.add_template_global(self.url, 'static_url')
+        app.add_url_rule(f'{self.url_prefix}<path:filename>', 'assets',
+                         self.send)
+        app.extensions['assets'] = self
+
+    def url(self, path):
+        """URL of the static file at `path` (e.g. 'images/x.png' or
+        '/static/images/x.png'), hashed if it was built."""
+
+        if not path:
+            return path
+        if path.startswith(STATIC_URL):
+            path = path[len(STATIC_URL):]
+        elif path.startswith('/') or '://' in path:
+            return path
+
+        hashed = self.manifest.get(path)
+        if hashed is None:
+            return STATIC_URL + path
+        return self.url_prefix + hashed
+
+    def send(self, filename):
+        """Serve a hashed file, precompressed if the browser accepts it."""
+
+        path = safe_join(self.directory, filename)
+        if path is None or filename == MANIFEST or not os.path.isfile(path):
+            abort(404)
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings[encoding] and os.path.isfile(
+                    path + suffix):
+                response = send_file(path + suffix, mimetype=mimetype,
+                                     download_name=os.path.basename(path),
+                                     conditional=True)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_file(path, mimetype=mimetype, conditional=True)
+
+        response.headers['Cache-Control'] = CACHE_CONTROL
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+def build(source, destination=None, echo=print):
+    """Write hashed copies of the files under `source` (a static folder)
+    to `destination` (by default its dist/), and return the manifest."""
+
+    destination = destination or os.path.join(source, 'dist')
+    paths = sorted(static_files(source, skip=destination),
+                   key=lambda path: (path.endswith('.css'), path))
+
+    # Stylesheets come last, so the files they refer to are hashed already.
+    manifest = {}
+    for path in paths:
+        with open(os.path.join(source, path), 'rb') as f:
+            data = f.read()
+        if path.endswith('.css'):
+            data = rewrite_css(data, path, manifest)
+
+        hashed = hashed_name(path, data)
+        manifest[path] = hashed
+        written = write_variants(os.path.join(destination, hashed), data,
+                                 compressible(path))
+        echo(f"{path} -> {hashed} {' '.join(written)}".rstrip())
+
+    with open(os.path.join(destination, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def static_files(source, skip):
+    """Paths (relative, with /) of the files under `source`, but not `skip`."""
+
+    for directory, subdirectories, files in os.walk(source):
+        subdirectories[:] = [
+            name for name in subdirectories
+            if os.path.join(directory, name) != os.path.normpath(skip)]
+        for name in files:
+            path = os.path.relpath(os.path.join(directory, name), source)
+            yield path.replace(os.sep, '/')
+
+
+def hashed_name(path, data):
+    """`path` with a hash of `data` before its extension."""
+
+    root, ext = posixpath.splitext(path)
+    return f"{root}.{hashlib.sha1(data).hexdigest()[:10]}{ext}"
+
+
+def rewrite_css(data, path, manifest):
+    """Point a stylesheet's /static/ URLs at the hashed files, relative to
+    the stylesheet's own hashed location."""
+
+    here = posixpath.dirname(path)
+
+    def replace(match):
+        quote, target = match.groups()
+        hashed = manifest.get(target)
+        if hashed is None:
+            return match.group(0)
+        return f"url({quote}{posixpath.relpath(hashed, here)}{quote})"
+
+    return CSS_URL.sub(replace, data.decode()).encode()
+
+
+def compressible(path):
+    mimetype = mimetypes.guess_type(path)[0] or ''
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE
+
+
+def write_variants(path, data, compress):
+    """Write `data` to `path`, and compressed copies where they're smaller;
+    return the suffixes of the copies written."""
+
+    variants = {'': data}
+    if compress:
+        variants['.gz'] = gzip.compress(data, compresslevel=9, mtime=0)
+        if brotli is not None:
+            variants['.br'] = brotli.compress(data)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    written = []
+    for suffix, contents in variants.items():
+        if suffix and len(contents) >= len(data):
+            continue
+        with open(path + suffix, 'wb') as f:
+            f.write(contents)
+        if suffix:
+            written.append(suffix)
+    return written
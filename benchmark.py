@@ -0,0 +1,347 @@
+"""Route benchmarks: latency and SQL statements per page.
+
+Seeds a database with a synthetic dataset, then requests the main pages
+through the Flask test client, logged in as the user who follows the
+most people, about the most followed user and most liked message:
+
+    DATABASE_URL=postgresql:///warbler-bench python benchmark.py
+    DATABASE_URL=sqlite:////tmp/warbler-bench.db python benchmark.py --users 200
+
+The database's data is REPLACED, so point DATABASE_URL at a scratch
+database (the default is postgresql:///warbler-bench). Use --no-seed to
+reuse the data from a previous run.
+
+Each route is requested once with the in-process caches emptied (the
+"cold" statement count, which is checked against the route's budget in
+`ROUTES`), then `--iterations` more times to time it. Results are
+compared with the baseline in `--baseline` for the same database dialect
+and TIMELINE_MODE, and `--save` records them as the new baseline. The
+exit status is 1 if any route is over budget or has regressed: it runs
+more statements than the baseline, or its median time grew by more than
+`--threshold` (and `--slack-ms`). Timings are only compared against a
+baseline taken with the same dataset options.
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from random import Random
+from statistics import median
+from time import perf_counter
+
+from sqlalchemy import event
+
+# The benchmark replaces all data, so don't default to the development
+# database; this must be set before the app is imported.
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app, CURR_USER_KEY, fragments, principals, follow_graph
+from bulk_load import reset_sequences
+from models import db, identity_cache, User, Message, Follows, Likes
+
+# (name, URL, most SQL statements allowed with cold caches). Budgets are
+# fixed counts: a page that needs more statements as the data grows has
+# an N+1 query.
+
+ROUTES = [
+    ('home', '/', 7),
+    ('users', '/users', 2),
+    ('user', '/users/{user}', 4),
+    ('followers', '/users/{user}/followers', 3),
+    ('likes', '/users/{user}/likes', 3),
+    ('message', '/messages/{message}', 3),
+]
+
+# bcrypt hash of "password", so seeded users can also log in by hand.
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+
+##############################################################################
+# Dataset
+
+
+def skewed(rng, n):
+    """Random id in 1..n, low ids far more likely (80/20 Pareto)."""
+
+    return min(int(rng.paretovariate(1.16)), n)
+
+
+def seed(users=1000, messages=10000, follows=20000, likes=20000,
+         seed=0, batch_size=10000):
+    """Replace all data with a random dataset of the given size.
+
+    The same arguments always give the same rows. Low user ids are the
+    most followed and post the most; low message ids get the most likes.
+    """
+
+    rng = Random(seed)
+    follows = min(follows, users * (users - 1) // 2)
+    likes = min(likes, users * messages // 2)
+    start = datetime(2022, 1, 1)
+
+    db.drop_all()
+    db.create_all()
+
+    user_rows = ({'id': i, 'email': f'user{i}@example.com',
+                  'username': f'user{i}', 'password': PASSWORD,
+                  'bio': f'Benchmark user {i}.'}
+                 for i in range(1, users + 1))
+
+    message_rows = ({'id': i, 'text': f'Benchmark message {i}.',
+                     'timestamp': start + timedelta(minutes=i),
+                     'user_id': skewed(rng, users)}
+                    for i in range(1, messages + 1))
+
+    follow_pairs = set()
+    while len(follow_pairs) < follows:
+        followed, follower = skewed(rng, users), rng.randint(1, users)
+        if followed != follower:
+            follow_pairs.add((followed, follower))
+
+    like_pairs = set()
+    while len(like_pairs) < likes:
+        like_pairs.add((rng.randint(1, users), skewed(rng, messages)))
+
+    follow_rows = ({'user_being_followed_id': followed,
+                    'user_following_id': follower}
+                   for followed, follower in sorted(follow_pairs))
+    like_rows = ({'id': i, 'user_id': user_id, 'message_id': message_id}
+                 for i, (user_id, message_id)
+                 in enumerate(sorted(like_pairs), start=1))
+
+    for model, rows in [(User, user_rows), (Message, message_rows),
+                        (Follows, follow_rows), (Likes, like_rows)]:
+        insert_rows(model.__table__, rows, batch_size)
+    db.session.commit()
+
+    reset_sequences([User.__table__, Message.__table__, Likes.__table__])
+    User.reconcile_counts()
+    db.session.commit()
+
+
+def insert_rows(table, rows, batch_size):
+    """Insert `rows` (dicts) into `table`, `batch_size` at a time."""
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+
+
+def pick_subjects():
+    """Ids of the busiest viewer, user and message in the database."""
+
+    def busiest(column):
+        return (db.session
+                .query(column)
+                .group_by(column)
+                .order_by(db.func.count().desc(), column)
+                .limit(1)
+                .scalar())
+
+    return {
+        'viewer': busiest(Follows.user_following_id),
+        'user': busiest(Follows.user_being_followed_id),
+        'message': busiest(Likes.message_id),
+    }
+
+
+##############################################################################
+# Measuring
+
+
+class StatementCounter:
+    """Count SQL statements sent to the database while in a `with` block."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def reset_caches():
+    """Empty the caches kept between requests in this process."""
+
+    identity_cache.invalidate_all(User)
+    identity_cache.invalidate_all(Message)
+    fragments.clear()
+    principals.clear()
+
+
+def fetch(client, url):
+    """Request `url`; return (milliseconds taken, SQL statements run)."""
+
+    with StatementCounter(db.engine) as counter:
+        start = perf_counter()
+        resp = client.get(url)
+        resp.get_data()
+        elapsed = (perf_counter() - start) * 1000
+
+    if resp.status_code != 200:
+        raise RuntimeError(f"GET {url} returned {resp.status_code}")
+    return elapsed, counter.count
+
+
+def measure(client, url, iterations=20, warmup=2):
+    """Cold statement count, then warm statement count and timings, of `url`."""
+
+    reset_caches()
+    _, cold_queries = fetch(client, url)
+
+    for _ in range(warmup):
+        fetch(client, url)
+
+    timings, queries = zip(*[fetch(client, url) for _ in range(iterations)])
+    timings = sorted(timings)
+
+    return {
+        'queries': cold_queries,
+        'cached_queries': max(queries),
+        'p50_ms': round(median(timings), 3),
+        'p95_ms': round(timings[int(0.95 * (len(timings) - 1))], 3),
+    }
+
+
+def run_routes(subjects, iterations=20, warmup=2):
+    """Measure every route in `ROUTES` as `subjects['viewer']`."""
+
+    # Built once per process and kept fresh in place, so load it up front
+    # rather than charging it to whichever route comes first.
+    follow_graph.rebuild()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = subjects['viewer']
+
+    return {name: measure(client, url.format(**subjects), iterations, warmup)
+            for name, url, _ in ROUTES}
+
+
+##############################################################################
+# Checking results
+
+
+def over_budget(results):
+    """Messages for routes that ran more statements than their budget."""
+
+    return [f"{name}: {results[name]['queries']} statements"
+            f" (budget {budget})"
+            for name, _, budget in ROUTES
+            if name in results and results[name]['queries'] > budget]
+
+
+def regressions(results, baseline, threshold=0.25, slack_ms=1.0,
+                compare_timings=True):
+    """Messages for routes that got worse than in `baseline`."""
+
+    problems = []
+
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+
+        for key in ('queries', 'cached_queries'):
+            if result[key] > base[key]:
+                problems.append(f"{name}: {key} {base[key]} -> {result[key]}")
+
+        limit = max(base['p50_ms'] * (1 + threshold),
+                    base['p50_ms'] + slack_ms)
+        if compare_timings and result['p50_ms'] > limit:
+            problems.append(f"{name}: p50 {base['p50_ms']:.1f}ms"
+                            f" -> {result['p50_ms']:.1f}ms")
+
+    return problems
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(path, baselines):
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def report(results):
+    print(f"{'route':<12}{'queries':>9}{'cached':>8}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, result in results.items():
+        print(f"{name:<12}{result['queries']:>9}{result['cached_queries']:>8}"
+              f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--likes', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-seed', action='store_true',
+                        help="reuse the data already in the database")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--baseline', default='benchmarks.json')
+    parser.add_argument('--save', action='store_true',
+                        help="record these results as the baseline")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="allowed fractional growth of median time")
+    parser.add_argument('--slack-ms', type=float, default=1.0,
+                        help="allowed absolute growth of median time")
+    options = parser.parse_args(args)
+
+    dataset = {key: getattr(options, key)
+               for key in ('users', 'messages', 'follows', 'likes', 'seed')}
+    dialect = db.engine.dialect.name
+    key = f"{dialect}:{app.config['TIMELINE_MODE']}"
+
+    if not options.no_seed:
+        print(f"Seeding {dialect} database: {dataset}")
+        seed(**dataset)
+
+    results = run_routes(pick_subjects(), options.iterations, options.warmup)
+    report(results)
+
+    baselines = load_baselines(options.baseline)
+    baseline = baselines.get(key, {})
+    same_data = baseline.get('dataset') == dataset and not options.no_seed
+    if baseline and not same_data:
+        print("Baseline dataset differs; comparing statement counts only.")
+
+    problems = (over_budget(results)
+                + regressions(results, baseline.get('routes', {}),
+                              options.threshold, options.slack_ms,
+                              compare_timings=same_data))
+    for problem in problems:
+        print(f"FAIL {problem}")
+
+    if options.save:
+        baselines[key] = {'dataset': dataset, 'routes': results}
+        save_baselines(options.baseline, baselines)
+        print(f"Saved baseline to {options.baseline}")
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+"""Load CSV files (such as those in generator/) into a fresh database.
+
+Run with `flask load-data [DIRECTORY]` (or `python seed.py`). The schema
+is dropped and recreated, then users.csv, messages.csv, follows.csv and
+likes.csv are loaded, in that order, from whichever exist. The first
+line of each file names its columns. Rows without an `id` column are
+numbered in file order, starting from 1.
+
+On PostgreSQL each file is streamed straight into `COPY ... FROM STDIN`.
+Secondary indexes, unique constraints and foreign keys are dropped
+before the load and rebuilt once all the data is in, which is much
+faster than maintaining them row by row. Elsewhere (e.g. SQLite), rows
+are parsed in batches and inserted with executemany, with the schema
+left as it is.
+
+Afterwards the id sequences are moved past the loaded ids and the
+cached counter columns on users are recomputed.
+"""
+
+import csv
+import os
+from datetime import datetime
+from time import perf_counter
+
+from models import db, User
+
+LOAD_ORDER = ['users', 'messages', 'follows', 'likes']
+
+# Bytes read from a CSV file per write to COPY.
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def load_csvs(directory='generator', batch_size=10000, echo=print):
+    """Recreate the schema and load the CSV files in `directory`."""
+
+    db.drop_all()
+    db.create_all()
+
+    files = [(db.metadata.tables[name], os.path.join(directory, f'{name}.csv'))
+             for name in LOAD_ORDER]
+    files = [(table, path) for table, path in files if os.path.exists(path)]
+    tables = [table for table, _ in files]
+
+    if db.engine.dialect.name == 'postgresql':
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            deferred = drop_deferrable(cursor, tables)
+            for table, path in files:
+                timed(echo, table, path, copy_csv, cursor, table, path)
+            echo("Rebuilding indexes and constraints")
+            for statement in deferred:
+                cursor.execute(statement)
+            connection.commit()
+        finally:
+            connection.close()
+    else:
+        for table, path in files:
+            timed(echo, table, path, insert_csv, table, path, batch_size)
+        db.session.commit()
+
+    reset_sequences(tables)
+    echo("Recomputing user counts")
+    User.reconcile_counts()
+    db.session.commit()
+
+
+def timed(echo, table, path, load, *args):
+    """Run `load(*args)` and report how many rows it loaded, how fast."""
+
+    start = perf_counter()
+    rows = load(*args)
+    elapsed = perf_counter() - start
+    echo(f"{table.name}: {rows} rows from {path}"
+         f" in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
+
+
+def read_header(csv_file, table):
+    """Column names from the first line of `csv_file`, checked against `table`."""
+
+    header = next(csv.reader([csv_file.readline()]))
+    unknown = [name for name in header if name not in table.c]
+    if unknown:
+        raise ValueError(f"{csv_file.name}: no such columns in {table.name}:"
+                         f" {', '.join(unknown)}")
+    return header
+
+
+def copy_csv(cursor, table, path):
+    """Stream the CSV file at `path` into `table` with COPY."""
+
+    quote = db.engine.dialect.identifier_preparer.quote
+
+    with open(path, newline='') as csv_file:
+        header = read_header(csv_file, table)
+        cursor.copy_expert(
+            f"COPY {quote(table.name)} ({', '.join(map(quote, header))})"
+            f" FROM STDIN WITH (FORMAT csv)",
+            csv_file, size=COPY_BUFFER_SIZE)
+        return cursor.rowcount
+
+
+def insert_csv(table, path, batch_size):
+    """Insert the CSV file at `path` into `table`, `batch_size` rows at a time."""
+
+    rows = 0
+
+    with open(path, newline='') as csv_file:
+        header = read_header(csv_file, table)
+        converters = [converter(table.c[name]) for name in header]
+        numbered = 'id' in table.c and 'id' not in header
+        insert = table.insert()
+
+        batch = []
+        for values in csv.reader(csv_file):
+            row = {name: convert(value)
+                   for name, convert, value in zip(header, converters, values)}
+            rows += 1
+            if numbered:
+                row['id'] = rows
+            batch.append(row)
+            if len(batch) == batch_size:
+                db.session.execute(insert, batch)
+                batch = []
+
+        if batch:
+            db.session.execute(insert, batch)
+
+    return rows
+
+
+def converter(column):
+    """Turn a CSV field into a value for `column` (empty fields are NULL)."""
+
+    python_type = column.type.python_type
+
+    if python_type is datetime:
+        parse = datetime.fromisoformat
+    elif python_type in (int, float):
+        parse = python_type
+    else:
+        parse = str
+
+    return lambda value: parse(value) if value != '' else None
+
+
+def drop_deferrable(cursor, tables):
+    """Drop secondary indexes and constraints of `tables` (PostgreSQL).
+
+    Primary keys are kept. Returns the statements that recreate what was
+    dropped, in an order that works: unique constraints and indexes
+    before the foreign keys that may rely on them.
+    """
+
+    names = [table.name for table in tables]
+    quote = db.engine.dialect.identifier_preparer.quote
+
+    cursor.execute("""
+        SELECT conrelid::regclass::text, conname, contype,
+               pg_get_constraintdef(oid)
+          FROM pg_constraint
+         WHERE conrelid::regclass::text = ANY(%s)
+           AND contype IN ('f', 'u')
+    """, (names,))
+    constraints = cursor.fetchall()
+
+    cursor.execute("""
+        SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid)
+          FROM pg_index
+         WHERE indrelid::regclass::text = ANY(%s)
+           AND NOT indisprimary
+           AND NOT EXISTS (SELECT 1 FROM pg_constraint
+                            WHERE conindid = indexrelid)
+    """, (names,))
+    indexes = cursor.fetchall()
+
+    foreign_keys = [c for c in constraints if c[2] == 'f']
+    uniques = [c for c in constraints if c[2] == 'u']
+
+    for table, name, _, _ in foreign_keys + uniques:
+        cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {quote(name)}")
+    for name, _ in indexes:
+        cursor.execute(f"DROP INDEX {name}")
+
+    return ([f"ALTER TABLE {table} ADD CONSTRAINT {quote(name)} {definition}"
+             for table, name, _, definition in uniques]
+            + [definition for _, definition in indexes]
+            + [f"ALTER TABLE {table} ADD CONSTRAINT {quote(name)} {definition}"
+               for table, name, _, definition in foreign_keys]
+            + [f"ANALYZE {table}" for table in names])
+
+
+def reset_sequences(tables):
+    """Move id sequences past the largest loaded id (PostgreSQL)."""
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    for table in tables:
+        if 'id' not in table.c:
+            continue
+        db.session.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'),"
+            f" COALESCE((SELECT max(id) FROM {table.name}), 0) + 1, false)")
+    db.session.commit()
@@ -0,0 +1,187 @@
+"""Compress responses (gzip, or brotli if installed) at the WSGI level.
+
+The encoding is picked from the request's Accept-Encoding, preferring
+brotli. A response is compressed if its type is text-like and it isn't
+encoded already (hashed assets come precompressed, see assets.py), it
+is at least COMPRESSION_MIN_SIZE bytes, and it isn't a partial (206),
+bodiless or `no-transform` response.
+
+Streamed responses (those without a Content-Length) are always
+compressed, since their size isn't known up front, and each chunk is
+flushed through the compressor as it comes so they still arrive piece
+by piece. A compressed response's ETag is made weak, as its bytes differ
+from the uncompressed one's; conditional GETs still match weak ETags.
+
+Bytes in and out and the CPU time spent, per encoding, are kept for
+metrics (see `metrics.compression_samples`), to tune the levels with.
+"""
+
+import zlib
+from collections import Counter
+from functools import partial
+from threading import Lock
+from time import thread_time
+
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+# Types worth compressing, besides text/*.
+COMPRESSIBLE = {'application/javascript', 'application/json',
+                'application/xml', 'image/svg+xml'}
+
+
+class Compression:
+    """WSGI middleware compressing an app's responses."""
+
+    def __init__(self):
+        self.enabled = True
+        self.min_size = 500
+        self.gzip_level = 6
+        self.brotli_quality = 4
+        self.encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+        self.wsgi_app = None
+
+        self.responses = Counter()
+        self.bytes_in = Counter()
+        self.bytes_out = Counter()
+        self.seconds = Counter()
+        self.skipped = Counter()
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """Read the COMPRESSION_* settings and wrap `app.wsgi_app`."""
+
+        self.enabled = app.config.get('COMPRESSION', True)
+        self.min_size = app.config.get('COMPRESSION_MIN_SIZE', 500)
+        self.gzip_level = app.config.get('COMPRESSION_GZIP_LEVEL', 6)
+        self.brotli_quality = app.config.get('COMPRESSION_BROTLI_QUALITY', 4)
+
+        self.wsgi_app = app.wsgi_app
+        app.wsgi_app = self
+
+    def __call__(self, environ, start_response):
+        if not self.enabled or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+
+        encoding = parse_accept_header(
+            environ.get('HTTP_ACCEPT_ENCODING', '')).best_match(self.encodings)
+        chosen = []
+
+        def compressing_start_response(status, headers, exc_info=None):
+            status_code = int(status.split(None, 1)[0])
+            chosen[:] = [self.choose(status_code, headers, encoding)]
+            if chosen[0] is not None:
+                headers = compressed_headers(headers, encoding)
+            # Bodies written with the legacy write() callable (which
+            # Flask never uses) would go out uncompressed.
+            return start_response(status, headers, exc_info)
+
+        body = self.wsgi_app(environ, compressing_start_response)
+        if not chosen or chosen[0] is None:
+            return body
+        return ClosingIterator(self.compress(body, encoding, chosen[0]),
+                               getattr(body, 'close', None))
+
+    def choose(self, status, headers, encoding):
+        """Whether to compress a response with `status` and `headers`:
+        None if not, else whether it is streamed. Adds Vary to responses
+        that might have been compressed."""
+
+        fields = {name.lower(): value for name, value in headers}
+        mimetype = fields.get('content-type', '').split(';')[0].strip()
+        length = fields.get('content-length')
+
+        if (status < 200 or status in (204, 206, 304)
+                or 'no-transform' in fields.get('cache-control', '')):
+            return None
+        if 'content-encoding' in fields:
+            return self._skip('encoded')
+        if not (mimetype.startswith('text/') or mimetype in COMPRESSIBLE):
+            return self._skip('type')
+        if length is not None and int(length) < self.min_size:
+            return self._skip('small')
+
+        add_vary(headers, 'Accept-Encoding')
+        if encoding is None:
+            return self._skip('not accepted')
+        return length is None
+
+    def compress(self, body, encoding, streamed):
+        """Iterate over `body` compressed with `encoding`, flushing after
+        each chunk if it is `streamed`."""
+
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            compress, flush, finish = (compressor.process, compressor.flush,
+                                       compressor.finish)
+        else:
+            compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            compress, finish = compressor.compress, compressor.flush
+            flush = partial(compressor.flush, zlib.Z_SYNC_FLUSH)
+
+        bytes_in = bytes_out = 0
+        seconds = 0.0
+        try:
+            for chunk in body:
+                if not chunk:
+                    continue
+                start = thread_time()
+                data = compress(chunk)
+                if streamed:
+                    data += flush()
+                seconds += thread_time() - start
+                bytes_in += len(chunk)
+                bytes_out += len(data)
+                if data:
+                    yield data
+
+            start = thread_time()
+            data = finish()
+            seconds += thread_time() - start
+            bytes_out += len(data)
+            yield data
+
+        finally:
+            with self._lock:
+                self.responses[encoding] += 1
+                self.bytes_in[encoding] += bytes_in
+                self.bytes_out[encoding] += bytes_out
+                self.seconds[encoding] += seconds
+
+    def _skip(self, reason):
+        with self._lock:
+            self.skipped[reason] += 1
+        return None
+
+
+def add_vary(headers, field):
+    """Add `field` to the Vary header in `headers` (a list of pairs)."""
+
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == 'vary':
+            if field.lower() not in value.lower():
+                headers[i] = (name, f'{value}, {field}')
+            return
+    headers.append(('Vary', field))
+
+
+def compressed_headers(headers, encoding):
+    """`headers` for the response compressed with `encoding`: no
+    Content-Length (the size isn't known yet) and a weak ETag."""
+
+    rewritten = []
+    for name, value in headers:
+        lower = name.lower()
+        if lower == 'content-length':
+            continue
+        if lower == 'etag' and not value.startswith('W/'):
+            value = f'W/{value}'
+        rewritten.append((name, value))
+    rewritten.append(('Content-Encoding', encoding))
+    return rewritten
@@ -0,0 +1,336 @@
+"""In-memory index of the follows graph.
+
+Answers "does A follow B?", degree and neighbour lookups without going
+through the ORM. Both directions of the graph are stored in CSR layout:
+for each user id, a slice of one sorted numpy array of neighbour ids.
+Follows and unfollows since the last build are kept in small per-user
+delta sets and folded back into the arrays once there are enough of them.
+"""
+
+from collections import defaultdict
+from threading import Lock, Thread
+from time import monotonic
+
+import numpy as np
+from flask import current_app, has_app_context
+
+from models import db, Follows
+
+# Edges are read from the follows table this many at a time.
+READ_BATCH = 100000
+
+
+class Adjacency:
+    """One direction of the graph: CSR arrays plus pending changes."""
+
+    def __init__(self, offsets=None, targets=None):
+        # Neighbours of node n are targets[offsets[n]:offsets[n + 1]].
+        self.offsets = (offsets if offsets is not None
+                        else np.zeros(1, dtype=np.int64))
+        self.targets = (targets if targets is not None
+                        else np.zeros(0, dtype=np.int64))
+        self.added = defaultdict(set)
+        self.removed = defaultdict(set)
+        self.pending = 0
+
+    @classmethod
+    def from_edges(cls, sources, targets):
+        """Build from parallel int64 arrays of edges, in any order."""
+
+        return cls.from_keys(np.sort(edge_keys(sources, targets)))
+
+    @classmethod
+    def from_keys(cls, keys):
+        """Build from a sorted array of `edge_keys`."""
+
+        sources = keys >> 32
+        offsets = np.zeros(1, dtype=np.int64)
+        if len(keys):
+            offsets = np.zeros(int(sources[-1]) + 2, dtype=np.int64)
+            np.cumsum(np.bincount(sources), out=offsets[1:])
+
+        return cls(offsets, keys & 0xFFFFFFFF)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Build from (source, target) pairs."""
+
+        edges = np.array(list(pairs), dtype=np.int64).reshape(-1, 2)
+        return cls.from_edges(edges[:, 0], edges[:, 1])
+
+    def edges(self):
+        """(sources, targets) arrays of the edges in the CSR arrays."""
+
+        sources = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int64),
+                            np.diff(self.offsets))
+        return sources, self.targets
+
+    def _slice(self, source):
+        if source + 1 >= len(self.offsets):
+            return 0, 0
+        return int(self.offsets[source]), int(self.offsets[source + 1])
+
+    def _in_base(self, source, target):
+        start, end = self._slice(source)
+        i = start + int(np.searchsorted(self.targets[start:end], target))
+        return i < end and self.targets[i] == target
+
+    def contains(self, source, target):
+        if target in self.added.get(source, ()):
+            return True
+        if target in self.removed.get(source, ()):
+            return False
+        return self._in_base(source, target)
+
+    def degree(self, source):
+        start, end = self._slice(source)
+        return (end - start
+                + len(self.added.get(source, ()))
+                - len(self.removed.get(source, ())))
+
+    def neighbours(self, source):
+        start, end = self._slice(source)
+        removed = self.removed.get(source, ())
+        base = [t for t in self.targets[start:end].tolist() if t not in removed]
+
+        added = self.added.get(source)
+        return sorted(base + list(added)) if added else base
+
+    def add(self, source, target):
+        if target in self.removed.get(source, ()):
+            self.removed[source].discard(target)
+        elif not self._in_base(source, target):
+            self.added[source].add(target)
+        self.pending += 1
+
+    def remove(self, source, target):
+        if target in self.added.get(source, ()):
+            self.added[source].discard(target)
+        elif self._in_base(source, target):
+            self.removed[source].add(target)
+        self.pending += 1
+
+    def compacted(self):
+        """A new `Adjacency` with the pending changes folded in."""
+
+        # The CSR arrays are sorted by (source, target), so their keys are
+        # too, and the changes can be merged in without sorting again.
+        keys = edge_keys(*self.edges())
+
+        removed = pairs_array(self.removed)
+        if len(removed):
+            removed = edge_keys(removed[:, 0], removed[:, 1])
+            keys = np.delete(keys, np.searchsorted(keys, removed))
+
+        added = pairs_array(self.added)
+        if len(added):
+            added = np.sort(edge_keys(added[:, 0], added[:, 1]))
+            keys = np.insert(keys, np.searchsorted(keys, added), added)
+
+        return Adjacency.from_keys(keys)
+
+
+def pairs_array(changes):
+    """(n, 2) array of the (source, target) pairs in {source: targets}."""
+
+    pairs = [(source, target)
+             for source, targets in changes.items() for target in targets]
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def edge_keys(sources, targets):
+    """One int64 per edge (user ids are 32-bit)."""
+
+    return (sources << 32) | targets
+
+
+class FollowGraph:
+    """CSR index of who follows whom.
+
+    Built from the follows table on first use, and rebuilt once it is
+    older than `max_age` seconds (so changes made by other processes show
+    up eventually). Rebuilds after the first run in a background thread,
+    one at a time, while lookups use the old graph; follows and unfollows
+    made meanwhile are applied to both. Changes made here are applied
+    with `add`/`remove`.
+    """
+
+    def __init__(self, max_age=None, compact_after=10000):
+        self.max_age = max_age
+        self.compact_after = compact_after
+        self._following = None
+        self._followers = None
+        self._built_at = None
+        self._changes = None
+        self._refreshing = False
+        self._refresher = None
+        self._lock = Lock()
+        self._build_lock = Lock()
+
+    def rebuild(self):
+        """Reload the whole graph from the follows table."""
+
+        with self._build_lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        """Reload the graph (build lock must be held)."""
+
+        with self._lock:
+            self._changes = []
+
+        try:
+            edges = read_follows()
+            following = Adjacency.from_edges(edges[:, 0], edges[:, 1])
+            followers = Adjacency.from_edges(edges[:, 1], edges[:, 0])
+
+            with self._lock:
+                # Changes made while the table was read may be missing.
+                for method, follower_id, followed_id in self._changes:
+                    getattr(following, method)(follower_id, followed_id)
+                    getattr(followers, method)(followed_id, follower_id)
+
+                self._following = following
+                self._followers = followers
+                self._built_at = monotonic()
+                self._maybe_compact()
+
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def _ensure_built(self):
+        if self._built_at is None:
+            with self._build_lock:
+                if self._built_at is None:
+                    self._rebuild()
+
+        elif (self.max_age is not None
+                and monotonic() - self._built_at > self.max_age):
+            self._refresh()
+
+    def _refresh(self):
+        """Rebuild in the background, unless that is already happening."""
+
+        if not has_app_context():
+            self.rebuild()
+            return
+
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        app = current_app._get_current_object()
+
+        def refresh():
+            try:
+                with app.app_context():
+                    self.rebuild()
+            except Exception:
+                app.logger.exception("Reloading the follow graph failed")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        self._refresher = Thread(target=refresh, daemon=True,
+                                 name='follow-graph')
+        self._refresher.start()
+
+    def is_following(self, user_id, other_id):
+        """Does `user_id` follow `other_id`?"""
+
+        self._ensure_built()
+        with self._lock:
+            return self._following.contains(user_id, other_id)
+
+    def is_followed_by(self, user_id, other_id):
+        """Is `user_id` followed by `other_id`?"""
+
+        return self.is_following(other_id, user_id)
+
+    def following_count(self, user_id):
+        """How many users `user_id` follows."""
+
+        self._ensure_built()
+        with self._lock:
+            return self._following.degree(user_id)
+
+    def followers_count(self, user_id):
+        """How many users follow `user_id`."""
+
+        self._ensure_built()
+        with self._lock:
+            return self._followers.degree(user_id)
+
+    def following_ids(self, user_id):
+        """Sorted ids of the users `user_id` follows."""
+
+        self._ensure_built()
+        with self._lock:
+            return self._following.neighbours(user_id)
+
+    def follower_ids(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        self._ensure_built()
+        with self._lock:
+            return self._followers.neighbours(user_id)
+
+    def add(self, follower_id, followed_id):
+        """Record that `follower_id` now follows `followed_id`."""
+
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append(('add', follower_id, followed_id))
+            if self._built_at is None:
+                return
+            self._following.add(follower_id, followed_id)
+            self._followers.add(followed_id, follower_id)
+            self._maybe_compact()
+
+    def remove(self, follower_id, followed_id):
+        """Record that `follower_id` no longer follows `followed_id`."""
+
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append(('remove', follower_id, followed_id))
+            if self._built_at is None:
+                return
+            self._following.remove(follower_id, followed_id)
+            self._followers.remove(followed_id, follower_id)
+            self._maybe_compact()
+
+    def remove_user(self, user_id):
+        """Drop every edge to or from a deleted user."""
+
+        for followed_id in self.following_ids(user_id):
+            self.remove(user_id, followed_id)
+        for follower_id in self.follower_ids(user_id):
+            self.remove(follower_id, user_id)
+
+    def _maybe_compact(self):
+        """Fold pending changes into the arrays (lock must be held)."""
+
+        if self._following.pending >= self.compact_after:
+            self._following = self._following.compacted()
+            self._followers = self._followers.compacted()
+
+
+def read_follows():
+    """(n, 2) array of (follower, followed) ids from the follows table."""
+
+    select = db.select([Follows.user_following_id,
+                        Follows.user_being_followed_id])
+    result = (db.session.connection()
+              .execution_options(stream_results=True)
+              .execute(select))
+
+    batches = [np.zeros((0, 2), dtype=np.int64)]
+    while True:
+        rows = result.fetchmany(READ_BATCH)
+        if not rows:
+            break
+        batches.append(np.array([tuple(row) for row in rows], dtype=np.int64))
+
+    return np.concatenate(batches)
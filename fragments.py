@@ -0,0 +1,84 @@
+"""Cache rendered template fragments.
+
+Templates wrap the shared parts of list items in a cache block:
+
+    {% cache 'message', msg.id, msg.text, author.username %}
+      ...
+    {% endcache %}
+
+The block is rendered once per key and reused for every viewer until it
+falls out of the LRU. A key is the entity id plus every value the block
+displays, so any edit gives a new key and nothing has to be invalidated.
+Per-viewer parts (like and follow buttons) stay outside the block.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentCache:
+    """LRU of up to `max_size` rendered fragments (0 caches nothing)."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """Add the {% cache %} tag to the app's templates."""
+
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.fragment_cache = self
+
+    def render(self, key, render):
+        """Cached fragment for `key`, calling `render()` on a miss."""
+
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+            self.misses += 1
+
+        fragment = render()
+
+        if self.max_size:
+            with self._lock:
+                self._fragments[key] = fragment
+                while len(self._fragments) > self.max_size:
+                    self._fragments.popitem(last=False)
+
+        return fragment
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache key, ... %}...{% endcache %} tag for `FragmentCache`."""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method('_render', [nodes.Tuple(key, 'load')]),
+            [], [], body,
+        ).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        return self.environment.fragment_cache.render(key, caller)
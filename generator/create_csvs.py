@@ -2,15 +2,38 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 10000000 --follows 1000000000 \\
+        --messages 100000000 --out /data/warbler --workers 32
+
+Then load them with `flask load-data /data/warbler`.
+
+Output is the same for the same options and --seed, however many
+--workers are used: rows are generated in fixed-size chunks, each with
+its own seeded random generator, and written out in order. Nothing is
+fetched from the network.
+
+Followers and posts are skewed like on a real network: how many accounts
+each user follows, how often an account is followed and how much each
+user posts all follow power laws, so there are a few very popular and
+very active accounts and a long tail of quiet ones.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import io
+import os
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
+from faker.providers.address.en_US import Provider as AddressProvider
+from faker.providers.lorem.en_US import Provider as LoremProvider
+from faker.providers.person.en_US import Provider as PersonProvider
+
+from helpers import (get_random_datetime, power_law_count, power_law_rank,
+                     Scatter)
 
 MAX_WARBLER_LENGTH = 140
 
@@ -18,60 +41,169 @@ USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'heade
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+HEADER_IMAGE_URL = '/static/images/warbler-hero.jpg'
 
-fake = Faker()
+WORDS = list(LoremProvider.word_list)
+FIRST_NAMES = [name.lower() for name in PersonProvider.first_names]
+LAST_NAMES = [name.lower() for name in PersonProvider.last_names]
+CITY_SUFFIXES = list(AddressProvider.city_suffixes)
+EMAIL_DOMAINS = ['example.com', 'example.net', 'example.org']
 
-# Generate random profile image URLs to use for users
+# Profile image URLs to use for users (served by randomuser.me, but
+# never fetched here).
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def sentence(rng, min_words, max_words):
+    """Random capitalized sentence of lorem words."""
+
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return ' '.join(words).capitalize() + '.'
+
+
+def generate_users(rng, options, start, stop):
+    """Rows for users start+1..stop. Usernames end in the user's id,
+    so they are unique however many users there are."""
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    for user_id in range(start + 1, stop + 1):
+        username = f"{rng.choice(FIRST_NAMES)}{rng.choice(LAST_NAMES)}{user_id}"
+        writer.writerow([
+            f"{username}@{rng.choice(EMAIL_DOMAINS)}",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD,
+            sentence(rng, 3, 12),
+            HEADER_IMAGE_URL,
+            rng.choice(WORDS).capitalize() + rng.choice(CITY_SUFFIXES),
+        ])
+
+    return out.getvalue(), stop - start
+
+
+def generate_messages(rng, options, start, stop):
+    """Rows for messages start..stop-1, with authors drawn by activity."""
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    authors = Scatter(options.users, salt=options.seed * 2 + 1)
+
+    for _ in range(start, stop):
+        writer.writerow([
+            sentence(rng, 4, 30)[:MAX_WARBLER_LENGTH],
+            get_random_datetime(rng, options.end),
+            authors(power_law_rank(rng, options.users, options.posting_skew)),
+        ])
+
+    return out.getvalue(), stop - start
+
+
+def generate_follows(rng, options, start, stop):
+    """Follows of users start+1..stop, with followed users drawn by popularity."""
+
+    lines = []
+    popular = Scatter(options.users, salt=options.seed * 2)
+    mean = options.follows / options.users
+    limit = min(options.users - 1, options.max_following)
+
+    for follower in range(start + 1, stop + 1):
+        count = power_law_count(rng, mean, options.following_skew, limit)
+        followed = set()
+
+        for _ in range(count * 4):
+            if len(followed) == count:
+                break
+            user_id = popular(power_law_rank(rng, options.users,
+                                             options.follower_skew))
+            if user_id != follower:
+                followed.add(user_id)
+
+        lines.extend(f"{user_id},{follower}\n" for user_id in sorted(followed))
+
+    return ''.join(lines), len(lines)
+
+
+GENERATORS = {
+    'users': (generate_users, USERS_CSV_HEADERS),
+    'messages': (generate_messages, MESSAGES_CSV_HEADERS),
+    'follows': (generate_follows, FOLLOWS_CSV_HEADERS),
+}
+
+
+def generate_chunk(task):
+    """CSV text and row count for one chunk of a table (run in a worker)."""
+
+    table, chunk, start, stop, options = task
+    rng = Random(f"{options.seed}-{table}-{chunk}")
+    return GENERATORS[table][0](rng, options, start, stop)
+
+
+def write_table(pool, table, total, options):
+    """Generate `total` rows (users, for follows) of `table` into its CSV."""
+
+    path = os.path.join(options.out, f'{table}.csv')
+    tasks = [(table, chunk, start, min(start + options.chunk_size, total), options)
+             for chunk, start in enumerate(range(0, total, options.chunk_size))]
+
+    rows = 0
+
+    with open(path, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerow(GENERATORS[table][1])
+        for text, count in pool.imap(generate_chunk, tasks):
+            csv_file.write(text)
+            rows += count
+
+    print(f"Wrote {rows} rows to {path}")
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Generate Warbler users.csv, messages.csv and follows.csv.")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000,
+                        help="roughly how many follows to generate")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="directory to write the CSVs to")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help="rows (users, for follows) per unit of work")
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime(2022, 1, 1),
+                        help="latest message timestamp; messages span two years before it")
+    parser.add_argument('--max-following', type=int, default=5000,
+                        help="most accounts any one user follows")
+    parser.add_argument('--follower-skew', type=float, default=1.2,
+                        help="power-law exponent of how often accounts are followed")
+    parser.add_argument('--following-skew', type=float, default=2.5,
+                        help="power-law exponent of how many accounts users follow (> 2)")
+    parser.add_argument('--posting-skew', type=float, default=1.1,
+                        help="power-law exponent of how much users post")
+
+    options = parser.parse_args(args)
+    if options.following_skew <= 2:
+        parser.error("--following-skew must be above 2")
+    return options
+
+
+def main(args=None):
+    options = parse_args(args)
+    os.makedirs(options.out, exist_ok=True)
+
+    with Pool(options.workers) as pool:
+        write_table(pool, 'users', options.users, options)
+        write_table(pool, 'messages', options.messages, options)
+        write_table(pool, 'follows', options.users, options)
+
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
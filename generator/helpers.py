@@ -1,14 +1,57 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from datetime import timedelta
+from math import gcd, log
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(rng, end, year_gap=2):
+    """Get a random datetime within `year_gap` years before `end`."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    span = timedelta(days=365 * year_gap).total_seconds()
+    return end - timedelta(seconds=rng.uniform(0, span))
 
-    return datetime.fromtimestamp(random_timestamp)
+
+def power_law_rank(rng, n, exponent):
+    """Random rank in 0..n-1, rank r drawn with weight ~ 1 / (r + 1)**exponent.
+
+    Uses the inverse CDF of a power law truncated to [1, n + 1), so it
+    costs the same for any `n`. For `exponent` 1 that CDF is logarithmic.
+    """
+
+    if exponent == 1:
+        x = (n + 1) ** rng.random()
+    else:
+        e = 1 - exponent
+        top = (n + 1) ** e
+        x = (1 + rng.random() * (top - 1)) ** (1 / e)
+    return min(int(x) - 1, n - 1)
+
+
+def power_law_count(rng, mean, exponent, limit):
+    """Random count with a power-law tail and roughly the given `mean`.
+
+    `exponent` is that of the density, and must be above 2 for the mean
+    to exist. Counts are capped at `limit`.
+    """
+
+    minimum = mean * (exponent - 2) / (exponent - 1)
+    x = minimum * (1 - rng.random()) ** (-1 / (exponent - 1))
+    return min(round(x), limit)
+
+
+class Scatter:
+    """Spread ranks 0..n-1 over ids 1..n, a different way for each `salt`.
+
+    Keeps popular ranks from all being the lowest ids, without holding a
+    permutation of every id in memory.
+    """
+
+    def __init__(self, n, salt):
+        self.n = n
+        self.offset = salt % n
+        self.multiplier = 1000003 % n or 1
+        while gcd(self.multiplier, n) != 1:
+            self.multiplier += 1
+
+    def __call__(self, rank):
+        return (rank * self.multiplier + self.offset) % self.n + 1
@@ -0,0 +1,114 @@
+"""HTTP caching of pages: Cache-Control policies and conditional GETs.
+
+Views pick a Cache-Control policy with `policy(...)`; pages that don't
+get DEFAULT_POLICY, which lets browsers keep a page but makes them
+check back each time. Pages show the logged-in user's name and buttons,
+so policies should be private, and responses vary on the cookie.
+
+Views that can tell cheaply whether a page changed call `check(...)`
+with the values the page is rendered from, before doing the expensive
+part. These values are the rows' columns (rows here have no version
+column), the viewer and whatever else the page shows. They are hashed
+into an ETag, together with a fingerprint of the templates and of the
+asset manifest (and HTTP_CACHE_SALT, e.g. a release id, for changes
+outside them). If the browser already has that version, `check`
+returns a 304 Not Modified response to send instead. A page is never
+given validators while it has flashed messages to show, since those
+are only shown once.
+
+`apply` (called from the app's after_request hook) adds the headers.
+With HTTP_CACHING off (the default in development) pages are not
+cached; responses that set their own Cache-Control are left alone either
+way.
+"""
+
+import hashlib
+import os
+
+from flask import current_app, g, request, session
+from werkzeug.http import is_resource_modified
+
+DEFAULT_POLICY = 'private, no-cache'
+
+
+class HTTPCache:
+    """Cache headers and conditional GETs for an app's pages."""
+
+    def __init__(self):
+        self.enabled = False
+        self.version = ''
+
+    def init_app(self, app):
+        """Read HTTP_CACHING and HTTP_CACHE_SALT, and fingerprint templates
+        (and hashed asset names, if assets are set up first)."""
+
+        self.enabled = app.config.get('HTTP_CACHING', True)
+        digest = hashlib.sha1(app.config.get('HTTP_CACHE_SALT', '').encode())
+        for path in template_files(app):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        if 'assets' in app.extensions:
+            digest.update(app.extensions['assets'].version.encode())
+        self.version = digest.hexdigest()
+
+    def policy(self, cache_control):
+        """Use `cache_control` for the current response."""
+
+        g.cache_control = cache_control
+
+    def etag(self, *parts):
+        """ETag of a page rendered from `parts` (reprs of plain values)."""
+
+        data = repr((self.version,) + parts).encode()
+        return hashlib.sha1(data).hexdigest()
+
+    def check(self, *parts):
+        """A 304 response if the browser has this version, else None.
+
+        `parts` are the values the page is rendered from. Pages get no
+        Last-Modified: none of them has a timestamp covering everything
+        it shows, so If-Modified-Since alone would match forever.
+        """
+
+        if not self.enabled or '_flashes' in session:
+            return None
+
+        etag = self.etag(*parts)
+        g.etag = etag
+
+        if is_resource_modified(request.environ, etag=etag):
+            return None
+        return current_app.response_class(status=304)
+
+    def apply(self, response):
+        """Add the current request's cache headers to `response`."""
+
+        # Static files and hashed assets come with their own headers.
+        if 'Cache-Control' in response.headers:
+            return response
+
+        if not self.enabled:
+            response.headers['Cache-Control'] = (
+                'no-cache, no-store, must-revalidate')
+            response.headers['Pragma'] = 'no-cache'
+            response.headers['Expires'] = '0'
+            return response
+
+        response.headers['Cache-Control'] = g.get('cache_control',
+                                                  DEFAULT_POLICY)
+        response.vary.add('Cookie')
+
+        etag = g.get('etag')
+        if etag and response.status_code in (200, 304):
+            response.set_etag(etag)
+
+        return response
+
+
+def template_files(app):
+    """Paths of the app's template files, in a stable order."""
+
+    folder = os.path.join(app.root_path, app.template_folder)
+    return sorted(os.path.join(directory, name)
+                  for directory, _, files in os.walk(folder)
+                  for name in files)
@@ -0,0 +1,336 @@
+"""Second-level cache of model rows by primary key.
+
+`IdentityCache.get` and `get_many` look rows up in the session first, then
+in a cache backend shared between requests, and only then in the
+database. Cached rows are plain dicts of column values, which are turned
+back into instances attached to the current session, so relationships
+still lazy load as usual.
+
+Invalidation is version based. Every cached row has a version number,
+which is bumped when the row is flushed (changed or deleted), again when
+the transaction commits or rolls back, and by bulk `Query.update` and
+`Query.delete` calls. A row loaded from the database is only stored if
+its version has not moved since the lookup began, so a reader racing a
+writer cannot put back stale data. Bulk changes whose rows can't be
+told from the query bump a per-table generation instead, which drops
+every cached row of that table. Deletes do the same for cached tables
+with foreign keys to the deleted rows, as the delete may cascade.
+
+Writes made outside the ORM session (raw SQL, other programs) are not
+seen; call `invalidate` or `invalidate_all` after them.
+
+Backends implement three methods, keyed by hashable tuples:
+
+- ``get(key)``: the (version, value) pair for `key`; the value is None
+  if it isn't cached
+- ``add(key, version, value)``: store `value` only if `key` is still at
+  `version`
+- ``bump(keys)``: move `keys` to versions no reader has seen yet, and
+  drop their values
+
+`MemoryBackend` keeps them in an LRU dict in this process, so bumps made
+by other worker processes are never seen there; its values expire after
+IDENTITY_CACHE_TTL seconds instead. A shared cache (e.g. memcached or
+Redis) can implement the same three operations with a version key per
+row and compare-and-set, and is seen by every process.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from flask import abort
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, Grouping
+from werkzeug.utils import import_string
+
+
+class MemoryBackend:
+    """Up to `max_size` versioned entries in an in-process LRU dict.
+
+    Values are dropped `ttl` seconds after they are stored (0 keeps them
+    until evicted), which bounds how stale a row can be when other
+    processes change it. Versions come from one clock for the whole
+    backend, and unknown keys are at the version of the newest entry
+    evicted so far; so a key evicted after a bump is still ahead of any
+    reader that looked it up before the bump.
+    """
+
+    def __init__(self, max_size=10000, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._clock = 0
+        self._floor = 0
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return self._floor, None
+            self._entries.move_to_end(key)
+            version, value, expires = entry
+            if expires is not None and expires <= monotonic():
+                return version, None
+            return version, value
+
+    def add(self, key, version, value):
+        with self._lock:
+            entry = self._entries.get(key)
+            current = entry[0] if entry is not None else self._floor
+            if current != version:
+                return
+            expires = monotonic() + self.ttl if self.ttl else None
+            self._entries[key] = (version, value, expires)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def bump(self, keys):
+        with self._lock:
+            for key in keys:
+                self._clock += 1
+                self._entries[key] = (self._clock, None, None)
+                self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            _, (version, _, _) = self._entries.popitem(last=False)
+            self._floor = max(self._floor, version)
+
+
+class NullBackend:
+    """Cache nothing (IDENTITY_CACHE_SIZE = 0)."""
+
+    def get(self, key):
+        return 0, None
+
+    def add(self, key, version, value):
+        pass
+
+    def bump(self, keys):
+        pass
+
+
+class IdentityCache:
+    """Cache rows of the registered model classes by primary key.
+
+    Configured from the app with `init_app`:
+
+    - IDENTITY_CACHE_SIZE: rows kept by the in-process backend
+      (default 10000; 0 turns the cache off)
+    - IDENTITY_CACHE_TTL: seconds the in-process backend keeps a row
+      (default 10; 0 keeps it until evicted, for a single process)
+    - IDENTITY_CACHE_BACKEND: import path of a backend class, called
+      with the app, to use instead
+    """
+
+    def __init__(self):
+        self.backend = NullBackend()
+        self.session = None
+        self.hits = 0
+        self.misses = 0
+        self._tables = {}
+
+    def init_app(self, app, session, models):
+        """Cache `models`, loaded through the scoped `session`."""
+
+        backend = app.config.get('IDENTITY_CACHE_BACKEND')
+        size = app.config.get('IDENTITY_CACHE_SIZE', 10000)
+
+        if backend:
+            self.backend = import_string(backend)(app)
+        elif size:
+            self.backend = MemoryBackend(
+                size, ttl=app.config.get('IDENTITY_CACHE_TTL', 10))
+        else:
+            self.backend = NullBackend()
+
+        self._tables = {cls.__table__.name: cls for cls in models}
+
+        if self.session is None:
+            event.listen(session, 'after_flush', self._after_flush)
+            event.listen(session, 'after_commit', self._after_end)
+            event.listen(session, 'after_rollback', self._after_end)
+            event.listen(session, 'after_bulk_update',
+                         self._after_bulk_update)
+            event.listen(session, 'after_bulk_delete',
+                         self._after_bulk_delete)
+        self.session = session
+
+    def get(self, cls, ident):
+        """The `cls` row with primary key `ident`, or None."""
+
+        found = self.get_many(cls, [ident])
+        return found[0] if found else None
+
+    def get_or_404(self, cls, ident):
+        """Like `get`, but abort with a 404 when there is no such row."""
+
+        obj = self.get(cls, ident)
+        if obj is None:
+            abort(404)
+        return obj
+
+    def get_many(self, cls, idents):
+        """Rows of `cls` by primary key, in the order of `idents`.
+
+        Missing rows are skipped.
+        """
+
+        session = self.session()
+        found = {}
+        missing = {}
+
+        for ident in idents:
+            if ident in found or ident in missing:
+                continue
+
+            obj = session.identity_map.get(session.identity_key(cls, ident))
+            if obj is not None:
+                found[ident] = obj
+                continue
+
+            key = self._key(cls, ident)
+            version, values = self.backend.get(key)
+            if values is not None:
+                self.hits += 1
+                found[ident] = self._attach(session, cls, values)
+            else:
+                self.misses += 1
+                missing[ident] = (key, version)
+
+        if missing:
+            pk = inspect(cls).primary_key[0]
+            for obj in session.query(cls).filter(pk.in_(missing)):
+                ident = getattr(obj, pk.key)
+                found[ident] = obj
+                values = self._values(obj)
+                if values is not None:
+                    self.backend.add(*missing[ident], values)
+
+        return [found[ident] for ident in idents if ident in found]
+
+    def invalidate(self, cls, idents):
+        """Drop cached rows of `cls` by primary key."""
+
+        self.backend.bump([self._key(cls, ident) for ident in idents])
+
+    def invalidate_all(self, cls):
+        """Drop every cached row of `cls`."""
+
+        self.backend.bump([(cls.__table__.name,)])
+
+    def _key(self, cls, ident):
+        table = cls.__table__.name
+        generation = self.backend.get((table,))[0]
+        return (table, generation, ident)
+
+    @staticmethod
+    def _values(obj):
+        """Column values of a clean, fully loaded `obj`, or None."""
+
+        state = inspect(obj)
+        if state.modified or state.deleted:
+            return None
+
+        keys = [attr.key for attr in state.mapper.column_attrs]
+        if state.unloaded.intersection(keys):
+            return None
+
+        return {key: state.dict[key] for key in keys}
+
+    @staticmethod
+    def _attach(session, cls, values):
+        """Instance of `cls` with `values`, merged into `session`."""
+
+        obj = inspect(cls).class_manager.new_instance()
+        for key, value in values.items():
+            setattr(obj, key, value)
+        make_transient_to_detached(obj)
+        return session.merge(obj, load=False)
+
+    def _is_cached(self, cls):
+        return self._tables.get(getattr(cls, '__tablename__', None)) is cls
+
+    def _cached_idents(self, objects):
+        """{class: primary keys} of the cached-class rows in `objects`."""
+
+        idents = {}
+        for obj in objects:
+            identity = inspect(obj).identity
+            if self._is_cached(type(obj)) and identity:
+                idents.setdefault(type(obj), set()).add(identity[0])
+        return idents
+
+    def _invalidate_dependents(self, cls):
+        """Drop cached classes whose rows deleting `cls` rows may cascade to."""
+
+        for other in self._tables.values():
+            if any(fk.column.table is cls.__table__
+                   for fk in other.__table__.foreign_keys):
+                self.invalidate_all(other)
+
+    def _touch(self, session, cls, idents):
+        """Bump rows now, and again when the transaction ends."""
+
+        self.invalidate(cls, idents)
+        session.info.setdefault('identity_cache', {}) \
+               .setdefault(cls, set()).update(idents)
+
+    def _after_flush(self, session, flush_context):
+        for cls, idents in self._cached_idents(session.dirty).items():
+            self._touch(session, cls, idents)
+
+        for cls, idents in self._cached_idents(session.deleted).items():
+            self._touch(session, cls, idents)
+            self._invalidate_dependents(cls)
+
+    def _after_end(self, session):
+        for cls, idents in session.info.pop('identity_cache', {}).items():
+            self.invalidate(cls, idents)
+
+    def _after_bulk_update(self, context):
+        self._after_bulk(context, deleted=False)
+
+    def _after_bulk_delete(self, context):
+        self._after_bulk(context, deleted=True)
+
+    def _after_bulk(self, context, deleted):
+        cls = context.query.column_descriptions[0]['entity']
+        if not self._is_cached(cls):
+            return
+
+        idents = _idents_from_criterion(cls, context.query.whereclause)
+        if idents is None:
+            self.invalidate_all(cls)
+        else:
+            self._touch(context.session, cls, idents)
+
+        if deleted:
+            self._invalidate_dependents(cls)
+
+
+def _idents_from_criterion(cls, criterion):
+    """Primary keys picked by `pk == value` or `pk IN (values)`, or None."""
+
+    pk = inspect(cls).primary_key[0]
+
+    if (not isinstance(criterion, BinaryExpression)
+            or criterion.left is not pk):
+        return None
+
+    right = criterion.right
+    if criterion.operator is operators.eq and isinstance(right, BindParameter):
+        return {right.value}
+
+    if (criterion.operator is operators.in_op
+            and isinstance(right, Grouping)
+            and all(isinstance(clause, BindParameter)
+                    for clause in right.element.clauses)):
+        return {clause.value for clause in right.element.clauses}
+
+    return None
@@ -0,0 +1,161 @@
+"""Writing likes, either straight away or through a write-behind buffer.
+
+With LIKE_BUFFER_INTERVAL set to 0 (the default), every like or unlike
+is written and committed in its own request. Otherwise likes go through
+a `LikeBuffer`: toggles are collected in memory, repeated toggles of the
+same like are coalesced, and the result is written in one batch every
+LIKE_BUFFER_INTERVAL seconds, or sooner once LIKE_BUFFER_MAX_PENDING
+likes are waiting. This keeps bursts of likes on a popular message from
+queueing up behind one commit each.
+
+Buffered likes show up straight away on the home page of the process that
+took them, but likes lists and counts lag until the next flush, and
+likes still in memory are lost if the process is killed.
+"""
+
+import atexit
+from threading import Lock, Timer
+
+from flask import has_app_context
+
+from models import db, Likes
+
+
+class DirectLikes:
+    """Write every like toggle in its own transaction."""
+
+    def toggle(self, user_id, message_id):
+        """Like or unlike; see `Likes.toggle`."""
+
+        liked = Likes.toggle(user_id, message_id)
+        db.session.commit()
+        return liked
+
+    def liked_message_ids(self, user, message_ids):
+        """Which of `message_ids` has `user` liked? Returns a set."""
+
+        return user.liked_message_ids(message_ids)
+
+    def flush(self):
+        """Nothing is ever waiting to be written."""
+
+
+class LikeBuffer:
+    """Collect like toggles and write them to the database in batches."""
+
+    def __init__(self, app, interval=1.0, max_pending=1000):
+        self.app = app
+        self.interval = interval
+        self.max_pending = max_pending
+        self.flushes = 0
+        self._pending = {}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._timer = None
+        atexit.register(self.flush)
+
+    def toggle(self, user_id, message_id):
+        """Like or unlike, without writing to the database yet.
+
+        Returns True if the message is now liked and False if unliked.
+        """
+
+        key = (user_id, message_id)
+
+        with self._lock:
+            liked = self._pending.get(key)
+
+        if liked is None:
+            liked = bool(Likes
+                         .query
+                         .filter_by(user_id=user_id, message_id=message_id)
+                         .count())
+
+        with self._lock:
+            liked = not self._pending.get(key, liked)
+            self._pending[key] = liked
+            full = len(self._pending) >= self.max_pending
+            self._schedule(0 if full else self.interval)
+
+        return liked
+
+    def liked_message_ids(self, user, message_ids):
+        """Which of `message_ids` has `user` liked, including pending likes?"""
+
+        liked = user.liked_message_ids(message_ids)
+
+        with self._lock:
+            for message_id in message_ids:
+                pending = self._pending.get((user.id, message_id))
+                if pending is True:
+                    liked.add(message_id)
+                elif pending is False:
+                    liked.discard(message_id)
+
+        return liked
+
+    def flush(self):
+        """Write all pending likes in one transaction.
+
+        Toggles leave this to the timer's thread, which has its own
+        database session, so a request never commits or rolls back for
+        someone else's batch. A failed batch is logged and retried.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                changes, self._pending = self._pending, {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+            if not changes:
+                return
+
+            if has_app_context():
+                self._write(changes)
+            else:
+                with self.app.app_context():
+                    self._write(changes)
+
+    def _schedule(self, delay):
+        """Flush in `delay` seconds, unless due sooner (lock must be held)."""
+
+        if self._timer is not None:
+            if self._timer.interval <= delay:
+                return
+            self._timer.cancel()
+        self._timer = Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _write(self, changes):
+        try:
+            Likes.apply(changes)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self.app.logger.exception(
+                "Writing %d buffered likes failed; retrying", len(changes))
+            # Keep the batch for the next flush, under any newer toggles.
+            with self._lock:
+                for key, liked in changes.items():
+                    self._pending.setdefault(key, liked)
+                self._schedule(self.interval)
+            return
+        self.flushes += 1
+
+
+def make_likes(app):
+    """Create the like writer selected by LIKE_BUFFER_INTERVAL."""
+
+    interval = app.config.get('LIKE_BUFFER_INTERVAL', 0)
+
+    if interval > 0:
+        return LikeBuffer(
+            app,
+            interval=interval,
+            max_pending=app.config.get('LIKE_BUFFER_MAX_PENDING', 1000),
+        )
+
+    return DirectLikes()
@@ -0,0 +1,436 @@
+"""Full-text search over messages.
+
+Two backends, picked with the MESSAGE_SEARCH_BACKEND setting:
+
+- 'postgres': PostgreSQL full-text search on a GIN index of
+  to_tsvector(messages.text), ranked with ts_rank.
+- 'disk': a pure-Python inverted index stored in a dbm file, for
+  databases without full-text search (e.g. SQLite test setups). Build
+  it with `flask reindex-messages`; new and deleted messages are logged
+  next to it, and `flask reindex-messages --merge` folds them in.
+  Results are scored from whole posting lists.
+
+'auto' (the default) uses postgres when the database is PostgreSQL.
+
+Results are ranked, and pages after the first are fetched with a cursor
+made of the (score, id) of the last result.
+"""
+
+import dbm
+import fcntl
+import glob
+import math
+import os
+import re
+from array import array
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+from sqlalchemy import DDL, event
+from sqlalchemy.types import REAL
+
+from models import db, Message
+
+MESSAGES_PER_SEARCH_PAGE = 20
+
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_messages_text_fts"
+        " ON messages USING gin (to_tsvector('english', text))")
+    .execute_if(dialect='postgresql'),
+)
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Lowercased words of `text`."""
+
+    return TOKEN_RE.findall(text.lower())
+
+
+def make_cursor(score, msg_id):
+    """Cursor pointing just past a result with this score and id."""
+
+    return f"{score!r}_{msg_id}"
+
+
+def parse_cursor(cursor):
+    """Turn a cursor from `make_cursor` into (score, id), or None."""
+
+    try:
+        score, msg_id = cursor.rsplit('_', 1)
+        return float(score), int(msg_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class PostgresMessageSearch:
+    """Search with PostgreSQL full-text search."""
+
+    def search(self, q, after=None, limit=MESSAGES_PER_SEARCH_PAGE):
+        """Messages matching `q`, best first, and the next page's cursor."""
+
+        document = db.func.to_tsvector('english', Message.text)
+        query = db.func.plainto_tsquery('english', q)
+        # ts_rank is a real; compare cursors as reals too, since a real
+        # widened to double precision never equals the cursor's double.
+        rank = db.cast(db.func.ts_rank(document, query), REAL)
+
+        results = (db.session
+                   .query(Message, rank)
+                   .filter(document.op('@@')(query))
+                   .options(db.joinedload(Message.user)))
+
+        position = parse_cursor(after)
+        if position:
+            score, msg_id = position
+            results = results.filter(
+                db.tuple_(rank, Message.id)
+                < db.tuple_(db.cast(score, REAL), msg_id))
+
+        results = (results
+                   .order_by(rank.desc(), Message.id.desc())
+                   .limit(limit)
+                   .all())
+
+        next_cursor = None
+        if len(results) == limit:
+            msg, score = results[-1]
+            next_cursor = make_cursor(score, msg.id)
+
+        return [msg for msg, _ in results], next_cursor
+
+    def added(self, msg):
+        """The database index keeps itself up to date."""
+
+    def deleted(self, msg_id, text):
+        """The database index keeps itself up to date."""
+
+
+class DiskMessageSearch:
+    """Inverted index of message words, stored in a dbm file at `path`.
+
+    Each word maps to a posting list of (message id, term frequency)
+    pairs packed as 64-bit ints, sorted by id. Results must contain every
+    query word and are ranked by tf-idf.
+
+    The dbm file is only written offline: `rebuild` builds it from the
+    messages table and `merge` folds in the changes logged since. Requests
+    just append a line to a log next to it (`added`, `deleted`), and
+    searches apply the lines they haven't seen yet on top of the dbm file.
+    Until the index is built, searches find nothing.
+
+    Several processes can share the index: the dbm file and the log are
+    guarded by an fcntl lock on `path`.lock, as most dbm modules don't
+    lock their files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log_path = path + '.log'
+        self.lock_path = path + '.lock'
+        self.build_lock_path = path + '.build'
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        # Changes read from the log, for the dbm file of `_version`.
+        self._lock = Lock()
+        self._version = None
+        self._position = 0
+        self._count = 0
+        self._max_id = 0
+        self._added = {}
+        self._added_words = defaultdict(dict)
+        self._removed = set()
+
+    def rebuild(self):
+        """Rebuild the whole index from the messages table."""
+
+        with locked(self.build_lock_path, fcntl.LOCK_EX):
+            with locked(self.lock_path, fcntl.LOCK_EX):
+                # Messages logged from here on may be in the table or not.
+                log_offset = log_size(self.log_path)
+                version = self._stored_version()
+
+            postings = {}
+            count = max_id = 0
+
+            rows = (db.session
+                    .query(Message.id, Message.text)
+                    .order_by(Message.id)
+                    .yield_per(10000))
+
+            for msg_id, text in rows:
+                count += 1
+                max_id = msg_id
+                for word, tf in Counter(tokenize(text)).items():
+                    postings.setdefault(word, array('q')).extend((msg_id, tf))
+
+            new = self.path + '.new'
+            with dbm.open(new, 'n') as index:
+                for word, posting in postings.items():
+                    index[word_key(word)] = posting.tobytes()
+                write_meta(index, version=version + 1, count=count,
+                           max_id=max_id, log_offset=log_offset)
+
+            with locked(self.lock_path, fcntl.LOCK_EX):
+                for name in glob.glob(glob.escape(new) + '*'):
+                    os.replace(name, self.path + name[len(new):])
+
+    def merge(self):
+        """Fold the changes logged since the last build into the dbm file."""
+
+        with locked(self.build_lock_path, fcntl.LOCK_EX):
+            with locked(self.lock_path, fcntl.LOCK_SH):
+                try:
+                    index = dbm.open(self.path, 'r')
+                except dbm.error:
+                    return
+                with index:
+                    meta = read_meta(index)
+                    records, end = read_log(self.log_path, meta['log_offset'])
+                    postings = {word: decode(index.get(word_key(word), b''))
+                                for _, _, counts in records for word in counts}
+
+            count, max_id = meta['count'], meta['max_id']
+            for op, msg_id, counts in records:
+                present = any(msg_id in postings[word] for word in counts)
+                if op == '+' and not present:
+                    for word, tf in counts.items():
+                        postings[word][msg_id] = tf
+                    count += 1
+                    max_id = max(max_id, msg_id)
+                elif op == '-' and present:
+                    for word in counts:
+                        postings[word].pop(msg_id, None)
+                    count -= 1
+
+            with locked(self.lock_path, fcntl.LOCK_EX):
+                with dbm.open(self.path, 'w') as index:
+                    for word, posting in postings.items():
+                        if posting:
+                            index[word_key(word)] = encode(posting)
+                        elif word_key(word) in index:
+                            del index[word_key(word)]
+
+                    # Start the log afresh, unless more was logged meanwhile.
+                    if log_size(self.log_path) == end:
+                        open(self.log_path, 'wb').close()
+                        end = 0
+                    write_meta(index, version=meta['version'] + 1,
+                               count=count, max_id=max_id, log_offset=end)
+
+    def search(self, q, after=None, limit=MESSAGES_PER_SEARCH_PAGE):
+        """Messages matching `q`, best first, and the next page's cursor."""
+
+        words = set(tokenize(q))
+        if not words:
+            return [], None
+
+        with self._lock, locked(self.lock_path, fcntl.LOCK_SH):
+            try:
+                index = dbm.open(self.path, 'r')
+            except dbm.error:
+                return [], None
+            with index:
+                self._read_changes(index)
+                count = self._count
+                postings = [self._posting(index, word) for word in words]
+
+        if not all(postings):
+            return [], None
+
+        # Start from the shortest posting list and intersect.
+        postings.sort(key=len)
+        scores = None
+        for posting in postings:
+            idf = math.log(1 + count / len(posting))
+            weights = {msg_id: tf * idf for msg_id, tf in posting.items()}
+            if scores is None:
+                scores = weights
+            else:
+                scores = {msg_id: score + weights[msg_id]
+                          for msg_id, score in scores.items()
+                          if msg_id in weights}
+
+        ranked = sorted(((score, msg_id) for msg_id, score in scores.items()),
+                        reverse=True)
+
+        position = parse_cursor(after)
+        if position:
+            ranked = [entry for entry in ranked if entry < position]
+
+        page = ranked[:limit]
+        next_cursor = make_cursor(*page[-1]) if len(page) == limit else None
+
+        return Message.get_many([msg_id for _, msg_id in page]), next_cursor
+
+    def added(self, msg):
+        """Log a newly committed message for the index."""
+
+        self._log('+', msg.id, msg.text)
+
+    def deleted(self, msg_id, text):
+        """Log a deleted message, whose text was `text`, for the index."""
+
+        self._log('-', msg_id, text)
+
+    def _log(self, op, msg_id, text):
+        counts = Counter(tokenize(text))
+        line = ' '.join([op, str(msg_id)]
+                        + [f'{word}:{tf}' for word, tf in counts.items()])
+
+        with locked(self.lock_path, fcntl.LOCK_SH):
+            if not dbm.whichdb(self.path):
+                return
+            # One short O_APPEND write, so concurrent lines don't mix.
+            with open(self.log_path, 'ab') as log:
+                log.write(line.encode() + b'\n')
+
+    def _stored_version(self):
+        """Version of the dbm file, or 0 if there is none (file lock held)."""
+
+        try:
+            with dbm.open(self.path, 'r') as index:
+                return read_meta(index)['version']
+        except dbm.error:
+            return 0
+
+    def _read_changes(self, index):
+        """Catch up with the log (both locks must be held)."""
+
+        meta = read_meta(index)
+        if meta['version'] != self._version:
+            self._version = meta['version']
+            self._position = meta['log_offset']
+            self._count = meta['count']
+            self._added = {}
+            self._added_words = defaultdict(dict)
+            self._removed = set()
+        self._max_id = meta['max_id']
+
+        records, self._position = read_log(self.log_path, self._position)
+        for op, msg_id, counts in records:
+            if op == '+':
+                # Ids up to max_id were in the table when it was read.
+                if msg_id <= self._max_id or msg_id in self._added:
+                    continue
+                self._added[msg_id] = counts
+                for word, tf in counts.items():
+                    self._added_words[word][msg_id] = tf
+                self._count += 1
+            elif msg_id in self._added:
+                for word in self._added.pop(msg_id):
+                    del self._added_words[word][msg_id]
+                self._count -= 1
+            elif msg_id <= self._max_id and msg_id not in self._removed:
+                self._removed.add(msg_id)
+                self._count -= 1
+
+    def _posting(self, index, word):
+        """{message id: term frequency} for `word` (locks must be held)."""
+
+        posting = decode(index.get(word_key(word), b''))
+        for msg_id in self._removed.intersection(posting):
+            del posting[msg_id]
+        posting.update(self._added_words.get(word, {}))
+        return posting
+
+
+META = ('version', 'count', 'max_id', 'log_offset')
+
+
+def read_meta(index):
+    return {name: int(index[name.encode()]) for name in META}
+
+
+def write_meta(index, **meta):
+    for name in META:
+        index[name.encode()] = str(meta[name]).encode()
+
+
+def word_key(word):
+    return b'w:' + word.encode()
+
+
+def decode(packed_bytes):
+    """{message id: term frequency} from a packed posting list."""
+
+    packed = array('q')
+    packed.frombytes(packed_bytes)
+    return dict(zip(packed[::2], packed[1::2]))
+
+
+def encode(posting):
+    """Pack {message id: term frequency} into a posting list."""
+
+    return array('q', [n for msg_id in sorted(posting)
+                       for n in (msg_id, posting[msg_id])]).tobytes()
+
+
+def read_log(path, position):
+    """(op, message id, {word: tf}) records of the log at `path` from
+    byte `position` on, and the position after the last whole line."""
+
+    try:
+        with open(path, 'rb') as log:
+            log.seek(position)
+            data = log.read()
+    except FileNotFoundError:
+        return [], position
+
+    end = data.rfind(b'\n') + 1
+    records = []
+    for line in data[:end].decode().splitlines():
+        op, msg_id, *counts = line.split()
+        records.append((op, int(msg_id),
+                        {word: int(tf) for word, tf
+                         in (count.rsplit(':', 1) for count in counts)}))
+    return records, position + end
+
+
+def log_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+@contextmanager
+def locked(path, operation):
+    """Hold an fcntl lock (LOCK_SH or LOCK_EX) on the file at `path`."""
+
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, operation)
+        yield
+
+
+class MessageSearch:
+    """Pick the configured search backend the first time it is needed."""
+
+    def __init__(self, backend='auto', index_path='message-search'):
+        self.backend_name = backend
+        self.index_path = index_path
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            name = self.backend_name
+            if name == 'auto':
+                name = ('postgres' if db.engine.dialect.name == 'postgresql'
+                        else 'disk')
+            self._backend = (PostgresMessageSearch() if name == 'postgres'
+                             else DiskMessageSearch(self.index_path))
+        return self._backend
+
+    def search(self, q, after=None, limit=MESSAGES_PER_SEARCH_PAGE):
+        return self.backend.search(q, after, limit)
+
+    def added(self, msg):
+        self.backend.added(msg)
+
+    def deleted(self, msg_id, text):
+        self.backend.deleted(msg_id, text)
@@ -0,0 +1,278 @@
+"""Prometheus metrics, served by the app at /metrics.
+
+`Metrics` times every request and keeps, per endpoint, a count of
+requests by method and status and a latency histogram. It also watches
+the database connection pool, through its checkout and checkin events:
+how many connections are checked out, and for how long. A pool running
+short shows as connections in use reaching its size plus overflow.
+Anything else (cache hit ratios, the bcrypt queue) comes from
+collectors: functions returning samples, which are called on each
+scrape.
+
+Metrics are kept per process, so with several worker processes each one
+must be scraped (or the numbers are just from whichever answered).
+"""
+
+from bisect import bisect_left
+from collections import Counter
+from threading import Lock
+from time import perf_counter
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds (seconds) of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Counts of observed values by bucket, with their sum."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        """(name, labels, value) rows in Prometheus' cumulative form."""
+
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield f'{name}_bucket', {**labels, 'le': str(bound)}, total
+        total += self.counts[-1]
+        yield f'{name}_bucket', {**labels, 'le': '+Inf'}, total
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, total
+
+
+class Metrics:
+    """Request, connection pool and collected metrics for an app."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.requests = Counter()
+        self.latency = {}
+        self.connection_hold = Histogram(buckets)
+        self.connections_in_use = 0
+        self.engine = None
+        self._collectors = []
+        self._lock = Lock()
+
+    def init_app(self, app, engine):
+        """Time requests to `app` and watch the pool of `engine`."""
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+        self.engine = engine
+        event.listen(engine, 'checkout', self._checkout)
+        event.listen(engine, 'checkin', self._checkin)
+
+    def add_collector(self, collect):
+        """Call `collect()` on each scrape for more samples.
+
+        It returns (name, type, help, labels, value) tuples.
+        """
+
+        self._collectors.append(collect)
+
+    def observe_request(self, endpoint, method, status, seconds):
+        with self._lock:
+            self.requests[endpoint, method, status] += 1
+            if endpoint not in self.latency:
+                self.latency[endpoint] = Histogram(self.buckets)
+            self.latency[endpoint].observe(seconds)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+
+        families = {}
+
+        def add(name, kind, help, samples):
+            family = families.setdefault(name, (kind, help, []))
+            family[2].extend(samples)
+
+        with self._lock:
+            add('warbler_requests_total', 'counter', 'Requests handled.',
+                [('warbler_requests_total',
+                  {'endpoint': endpoint, 'method': method, 'status': status},
+                  count)
+                 for (endpoint, method, status), count
+                 in sorted(self.requests.items())])
+            add('warbler_request_duration_seconds', 'histogram',
+                'Time to handle a request.',
+                [sample
+                 for endpoint, histogram in sorted(self.latency.items())
+                 for sample in histogram.samples(
+                     'warbler_request_duration_seconds',
+                     {'endpoint': endpoint})])
+            add('warbler_db_connection_hold_seconds', 'histogram',
+                'Time database connections are checked out for.',
+                list(self.connection_hold.samples(
+                    'warbler_db_connection_hold_seconds', {})))
+            add('warbler_db_connections_in_use', 'gauge',
+                'Database connections checked out of the pool.',
+                [('warbler_db_connections_in_use', {},
+                  self.connections_in_use)])
+
+        pool = self.engine.pool if self.engine is not None else None
+        if isinstance(pool, QueuePool):
+            add('warbler_db_pool_size', 'gauge',
+                'Connections the pool keeps open.',
+                [('warbler_db_pool_size', {}, pool.size())])
+            add('warbler_db_pool_overflow', 'gauge',
+                'Connections open beyond the pool size.',
+                [('warbler_db_pool_overflow', {}, max(pool.overflow(), 0))])
+
+        for collect in self._collectors:
+            for name, kind, help, labels, value in collect():
+                add(name, kind, help, [(name, labels, value)])
+
+        lines = []
+        for name, (kind, help, samples) in families.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{sample}{format_labels(labels)} {format_value(value)}'
+                         for sample, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+    def _start_request(self):
+        g.metrics_start = perf_counter()
+
+    def _finish_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            self.observe_request(request.endpoint or 'none', request.method,
+                                 str(response.status_code),
+                                 perf_counter() - start)
+        return response
+
+    def _teardown_request(self, exc):
+        # Only still set if the request failed before after_request ran.
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            self.observe_request(request.endpoint or 'none', request.method,
+                                 '500', perf_counter() - start)
+
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['metrics_checkout'] = perf_counter()
+        with self._lock:
+            self.connections_in_use += 1
+
+    def _checkin(self, dbapi_connection, connection_record):
+        start = connection_record.info.pop('metrics_checkout', None)
+        with self._lock:
+            self.connections_in_use -= 1
+            if start is not None:
+                self.connection_hold.observe(perf_counter() - start)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{escape(str(value))}"'
+                     for key, value in labels.items())
+    return f'{{{pairs}}}'
+
+
+def escape(value):
+    return (value.replace('\\', r'\\')
+            .replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+##############################################################################
+# Collectors
+
+
+def cache_samples(caches):
+    """Hit, miss and hit ratio samples of `caches` (name -> cache).
+
+    Each cache has `hits` and `misses` counters.
+    """
+
+    for name, cache in caches.items():
+        hits, misses = cache.hits, cache.misses
+        labels = {'cache': name}
+        yield ('warbler_cache_hits_total', 'counter',
+               'Cache lookups that found an entry.', labels, hits)
+        yield ('warbler_cache_misses_total', 'counter',
+               'Cache lookups that found nothing.', labels, misses)
+        yield ('warbler_cache_hit_ratio', 'gauge',
+               'Fraction of cache lookups that were hits.', labels,
+               hits / (hits + misses) if hits + misses else 0.0)
+
+
+def password_samples(hasher):
+    """Samples from a `passwords.PasswordHasher`."""
+
+    stats = hasher.stats()
+    yield ('warbler_bcrypt_queue_depth', 'gauge',
+           'Password hashes waiting for a bcrypt thread.', {},
+           stats['queue_depth'])
+    yield ('warbler_bcrypt_pending', 'gauge',
+           'Password hashes running or waiting.', {}, stats['pending'])
+    yield ('warbler_bcrypt_completed_total', 'counter',
+           'Password hashes computed or checked.', {}, stats['completed'])
+    yield ('warbler_bcrypt_rejected_total', 'counter',
+           'Password hashes refused because the queue was full.', {},
+           stats['rejected'])
+    yield ('warbler_bcrypt_seconds_total', 'counter',
+           'Time spent computing password hashes.', {}, stats['seconds'])
+
+
+def sql_samples(sql_stats):
+    """Samples from a `sql_stats.SQLStats`."""
+
+    yield ('warbler_sql_statements_total', 'counter',
+           'SQL statements run while handling requests.', {},
+           sql_stats.statements)
+    yield ('warbler_sql_seconds_total', 'counter',
+           'Time spent in SQL statements while handling requests.', {},
+           sql_stats.seconds)
+    yield ('warbler_sql_repeated_requests_total', 'counter',
+           'Requests that repeated a statement enough to be a likely N+1.',
+           {}, sql_stats.flagged)
+
+
+def compression_samples(compression):
+    """Samples from a `compression.Compression`."""
+
+    with compression._lock:
+        encodings = sorted(compression.responses)
+        stats = [(encoding, compression.responses[encoding],
+                  compression.bytes_in[encoding],
+                  compression.bytes_out[encoding],
+                  compression.seconds[encoding]) for encoding in encodings]
+        skipped = sorted(compression.skipped.items())
+
+    for encoding, responses, bytes_in, bytes_out, seconds in stats:
+        labels = {'encoding': encoding}
+        yield ('warbler_compression_responses_total', 'counter',
+               'Responses compressed.', labels, responses)
+        yield ('warbler_compression_input_bytes_total', 'counter',
+               'Bytes of responses before compression.', labels, bytes_in)
+        yield ('warbler_compression_output_bytes_total', 'counter',
+               'Bytes of responses after compression.', labels, bytes_out)
+        yield ('warbler_compression_ratio', 'gauge',
+               'Compressed size as a fraction of the original size.', labels,
+               bytes_out / bytes_in if bytes_in else 0.0)
+        yield ('warbler_compression_cpu_seconds_total', 'counter',
+               'CPU time spent compressing responses.', labels, seconds)
+    for reason, count in skipped:
+        yield ('warbler_compression_skipped_total', 'counter',
+               'Responses not compressed, by reason.', {'reason': reason},
+               count)
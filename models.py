@@ -2,11 +2,17 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm.attributes import set_committed_value
+
+from identity_cache import IdentityCache
+from passwords import password_hasher
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
+identity_cache = IdentityCache()
+
+TIMELINE_PAGE_SIZE = 100
 
 
 class Follows(db.Model):
@@ -14,6 +20,13 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key covers lookups by followed user; timelines and
+    # "following" lists look up by follower, so index that direction too.
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -32,6 +45,14 @@ class Likes(db.Model):
 
     __tablename__ = 'likes' 
 
+    # The unique constraint covers lookups by user; deleting a message
+    # (and its cascade) finds its likes by message, so index that too.
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_id_message_id'),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -39,15 +60,100 @@ class Likes(db.Model):
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id')
+        db.ForeignKey('users.id', ondelete="cascade")
     )
 
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id'),
-        unique=True
+        db.ForeignKey('messages.id', ondelete="cascade")
     )
 
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like a message for a user, or unlike it if they already do.
+
+        Returns True if the message is now liked, False if it was unliked
+        and None if there is no such message. The user's likes_count is
+        updated in the same transaction; the caller commits.
+        """
+
+        unliked = (cls
+                   .query
+                   .filter_by(user_id=user_id, message_id=message_id)
+                   .delete(synchronize_session=False))
+        if unliked:
+            User.update_counts(user_id, likes_count=-1)
+            return False
+
+        liked = db.session.execute(
+            cls.insert_missing(),
+            dict(user_id=user_id, message_id=message_id)).rowcount
+        if liked:
+            User.update_counts(user_id, likes_count=1)
+            return True
+
+        # A concurrent toggle may have liked it first (and counted it).
+        if cls.query.filter_by(user_id=user_id, message_id=message_id).count():
+            return True
+
+        return None
+
+    @classmethod
+    def apply(cls, changes):
+        """Write a batch of likes and unlikes.
+
+        `changes` maps (user_id, message_id) to True (liked) or False
+        (unliked). Changes that are already in place are skipped, and the
+        counters of the users involved are recomputed. The caller commits.
+        """
+
+        likes = [dict(user_id=user_id, message_id=message_id)
+                 for (user_id, message_id), liked in changes.items() if liked]
+        unlikes = [dict(user_id=user_id, message_id=message_id)
+                   for (user_id, message_id), liked in changes.items()
+                   if not liked]
+
+        if unlikes:
+            db.session.execute(
+                cls.__table__.delete()
+                .where(cls.user_id == db.bindparam('user_id'))
+                .where(cls.message_id == db.bindparam('message_id')),
+                unlikes)
+        if likes:
+            db.session.execute(cls.insert_missing(), likes)
+
+        User.reconcile_counts({user_id for user_id, _ in changes})
+
+    @classmethod
+    def insert_missing(cls):
+        """INSERT for a `user_id`/`message_id` parameter pair.
+
+        Inserts nothing if the like already exists or the user or message
+        does not, so it is safe to run as a batch. On PostgreSQL that
+        includes a like inserted by a concurrent transaction, which the
+        NOT EXISTS check can't see yet.
+        """
+
+        user_id = db.bindparam('user_id', type_=db.Integer)
+        message_id = db.bindparam('message_id', type_=db.Integer)
+
+        already_liked = (db.exists()
+                         .where(cls.user_id == user_id)
+                         .where(cls.message_id == message_id))
+        user_exists = db.exists().where(User.id == user_id)
+
+        insert = cls.__table__.insert()
+        if db.engine.dialect.name == 'postgresql':
+            insert = postgresql.insert(cls.__table__).on_conflict_do_nothing()
+
+        return insert.from_select(
+            ['user_id', 'message_id'],
+            db.select([user_id, Message.id])
+            .where(Message.id == message_id)
+            .where(user_exists)
+            .where(~already_liked),
+        )
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,7 +200,42 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Counter cache for the stats shown on profiles and the home page.
+    # Views keep these up to date with `update_counts`; run
+    # `flask reconcile-counts` to recompute them from the base tables.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Deleting a user deletes their messages: the database cascades to
+    # those not loaded, rather than the ORM setting their user_id NULL.
+    messages = db.relationship('Message', cascade='save-update, merge, delete',
+                               passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -121,14 +262,81 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_use`?
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        Looks up the single follows row rather than loading the whole
+        `following` list. Views rendering many users at once should ask
+        the in-memory follow graph (see follow_graph.py) instead.
+        """
+
+        follow = (Follows
+                  .query
+                  .filter_by(user_following_id=self.id,
+                             user_being_followed_id=other_user.id)
+                  .exists())
+        return db.session.query(follow).scalar()
+
+    @classmethod
+    def update_counts(cls, user_ids, **deltas):
+        """Add `deltas` to counter columns, e.g. `messages_count=1`.
+
+        `user_ids` is a user id or a list (or subquery) of them, and a
+        delta may be an SQL expression correlated with each user's row.
+        This runs as an UPDATE in the current transaction, so commit it
+        together with the change being counted.
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+
+        (cls
+         .query
+         .filter(cls.id.in_(user_ids))
+         .update(values, synchronize_session=False))
+
+    @classmethod
+    def reconcile_counts(cls, user_ids=None):
+        """Recompute the counter columns from the base tables.
+
+        Only the users in `user_ids` are updated, if given.
+        """
+
+        def count(column, key):
+            return (db.select([db.func.count(column)])
+                    .where(key == cls.id)
+                    .as_scalar())
+
+        users = cls.query
+        if user_ids is not None:
+            users = users.filter(cls.id.in_(user_ids))
+
+        (users
+         .update({
+             cls.messages_count: count(Message.id, Message.user_id),
+             cls.following_count: count(Follows.user_being_followed_id,
+                                        Follows.user_following_id),
+             cls.followers_count: count(Follows.user_following_id,
+                                        Follows.user_being_followed_id),
+             cls.likes_count: count(Likes.id, Likes.user_id),
+         }, synchronize_session=False))
+
+    def liked_message_ids(self, message_ids):
+        """Which of `message_ids` has this user liked? Returns a set."""
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +345,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -158,13 +366,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with a different bcrypt cost than is
+        configured now, it is replaced with a new hash; commit to save it.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
                 return user
 
         return False
@@ -175,6 +388,13 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # Timelines read "newest messages by these authors", so keep them
+    # indexed by author and time (id breaks ties between equal timestamps).
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp_id',
+                 'user_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -188,7 +408,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +419,117 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    @property
+    def cursor(self):
+        """Keyset pagination cursor pointing just past this message."""
+
+        return self.make_cursor(self.timestamp, self.id)
+
+    @staticmethod
+    def make_cursor(timestamp, msg_id):
+        """Cursor for the message with this timestamp and id."""
+
+        return f"{timestamp.isoformat()}_{msg_id}"
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """Turn a cursor from `Message.cursor` into (timestamp, id).
+
+        Returns None if the cursor is missing or malformed.
+        """
+
+        try:
+            timestamp, msg_id = cursor.rsplit('_', 1)
+            return datetime.fromisoformat(timestamp), int(msg_id)
+        except (AttributeError, ValueError):
+            return None
+
+    @classmethod
+    def get_many(cls, ids):
+        """Fetch messages (with their authors) by id, in the order of `ids`.
+
+        Ids of messages that no longer exist are skipped. Messages and
+        authors come from the identity cache where possible.
+        """
+
+        messages = identity_cache.get_many(cls, ids)
+        authors = {user.id: user
+                   for user in identity_cache.get_many(
+                       User, {msg.user_id for msg in messages})}
+        for msg in messages:
+            set_committed_value(msg, 'user', authors.get(msg.user_id))
+        return messages
+
+    @classmethod
+    def timeline_query(cls, user_id, position=None):
+        """Query for messages from users that `user_id` follows.
+
+        Built as a single JOIN of follows -> messages, ordered by
+        (timestamp, id) descending. `position` is a (timestamp, id) pair
+        from `Message.parse_cursor`; only messages older than it match.
+        """
+
+        query = (cls
+                 .query
+                 .join(Follows, Follows.user_being_followed_id == cls.user_id)
+                 .filter(Follows.user_following_id == user_id))
+
+        if position:
+            timestamp, msg_id = position
+            query = query.filter(db.or_(
+                cls.timestamp < timestamp,
+                db.and_(cls.timestamp == timestamp, cls.id < msg_id),
+            ))
+
+        return query.order_by(cls.timestamp.desc(), cls.id.desc())
+
+
+class Recommendation(db.Model):
+    """An account suggested for a user to follow.
+
+    Written in bulk by the batch job in recommendations.py.
+    """
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    recommended_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    @classmethod
+    def for_user(cls, user_id, limit=5):
+        """Users suggested to `user_id`, best first.
+
+        Skips anyone `user_id` has followed since the batch job ran.
+        """
+
+        already_following = (Follows
+                             .query
+                             .filter(Follows.user_following_id == user_id,
+                                     Follows.user_being_followed_id == User.id)
+                             .exists())
+
+        return (User
+                .query
+                .join(cls, cls.recommended_user_id == User.id)
+                .filter(cls.user_id == user_id, ~already_following)
+                .order_by(cls.score.desc())
+                .limit(limit)
+                .all())
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -208,3 +539,5 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    password_hasher.init_app(app)
+    identity_cache.init_app(app, db.session, [User, Message])
@@ -0,0 +1,128 @@
+"""Password hashing on a bounded pool of worker threads.
+
+bcrypt is deliberately slow, and it releases the GIL while it works, so
+hashes are computed on a small thread pool rather than however many
+request threads happen to be logging in at once. When more than
+`max_queue` jobs are already waiting, new ones are refused with
+`PasswordHasherBusy` instead of piling up behind them.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+# bcrypt only uses the first 72 bytes of a password; bcrypt 5 raises on
+# longer ones instead of ignoring the rest.
+MAX_PASSWORD_BYTES = 72
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password hashes are already queued."""
+
+
+class PasswordHasher:
+    """Hash and check passwords with bcrypt on a bounded executor.
+
+    Configured from the app with `init_app`:
+
+    - BCRYPT_LOG_ROUNDS: cost factor for new hashes (default 12)
+    - BCRYPT_MAX_WORKERS: threads doing bcrypt work (default 4)
+    - BCRYPT_MAX_QUEUE: jobs allowed to wait for a thread (default 64)
+    """
+
+    def __init__(self, rounds=12, max_workers=4, max_queue=64):
+        self._lock = Lock()
+        self._configure(rounds, max_workers, max_queue)
+
+        self.completed = 0
+        self.rejected = 0
+        self.seconds = 0.0
+
+    def _configure(self, rounds, max_workers, max_queue):
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers,
+                                            thread_name_prefix='bcrypt')
+
+    def init_app(self, app):
+        """Read the BCRYPT_* settings of `app`."""
+
+        old = self._executor
+        self._configure(app.config.get('BCRYPT_LOG_ROUNDS', 12),
+                        app.config.get('BCRYPT_MAX_WORKERS', 4),
+                        app.config.get('BCRYPT_MAX_QUEUE', 64))
+        old.shutdown(wait=False)
+
+    def hash(self, password):
+        """bcrypt hash of `password`, at the configured cost."""
+
+        hashed = self._run(bcrypt.generate_password_hash,
+                           truncated(password), self.rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        return self._run(bcrypt.check_password_hash, hashed,
+                         truncated(password))
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than configured?"""
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    @property
+    def queue_depth(self):
+        """Jobs waiting for a worker thread."""
+
+        return max(self.pending - self.max_workers, 0)
+
+    def stats(self):
+        """Counters for monitoring."""
+
+        with self._lock:
+            return dict(rounds=self.rounds,
+                        pending=self.pending,
+                        queue_depth=self.queue_depth,
+                        completed=self.completed,
+                        rejected=self.rejected,
+                        seconds=self.seconds)
+
+    def _run(self, func, *args):
+        """Run `func(*args)` on the pool and wait for its result."""
+
+        with self._lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise PasswordHasherBusy()
+            self.pending += 1
+
+        def timed():
+            start = perf_counter()
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self.pending -= 1
+                    self.completed += 1
+                    self.seconds += perf_counter() - start
+
+        return self._executor.submit(timed).result()
+
+
+def truncated(password):
+    """The part of `password` bcrypt uses, as bytes."""
+
+    return password.encode('UTF-8')[:MAX_PASSWORD_BYTES]
+
+
+password_hasher = PasswordHasher()
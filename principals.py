@@ -0,0 +1,85 @@
+"""Cached snapshots of the logged-in user.
+
+Most requests only need a few columns of the current user (to show the
+nav bar, or check who is allowed to do what), so `add_user_to_g` puts a
+small `Principal` on `g.user` instead of a full `User`. Principals are
+kept in a TTL/LRU cache, which views that change or delete a user must
+`invalidate`. With several processes, each has its own cache, so other
+processes may show old profile details for up to `ttl` seconds.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from models import db, User
+
+
+class Principal:
+    """Read-only snapshot of the columns of a user needed on most pages."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url')
+
+    def __init__(self, id, username, image_url, header_image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self.header_image_url = header_image_url
+
+    def __repr__(self):
+        return f"<Principal #{self.id}: {self.username}>"
+
+
+class PrincipalCache:
+    """LRU cache of up to `max_size` principals, each kept `ttl` seconds."""
+
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id):
+        """Principal for `user_id`, or None if there is no such user."""
+
+        now = monotonic()
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        row = (db.session
+               .query(User.id, User.username, User.image_url,
+                      User.header_image_url)
+               .filter(User.id == user_id)
+               .first())
+        if row is None:
+            return None
+
+        principal = Principal(*row)
+
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, principal)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return principal
+
+    def invalidate(self, user_id):
+        """Forget the cached principal of `user_id`."""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Forget every cached principal."""
+
+        with self._lock:
+            self._entries.clear()
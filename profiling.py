@@ -0,0 +1,197 @@
+"""Profile individual requests, in production, on demand.
+
+A request is profiled if it carries a valid X-Warbler-Profile token
+(made with `flask profile-token`, signed with the app's SECRET_KEY and
+good for PROFILE_TOKEN_MAX_AGE seconds), or if it is picked at random
+at PROFILE_SAMPLE_RATE. Random picks can be limited to the endpoints in
+PROFILE_ENDPOINTS.
+
+Profiling runs from the first before_request hook to after_request, so
+it covers loading the user, the view and rendering the template. Two
+modes (PROFILE_MODE):
+
+- 'sample': a thread samples the request thread's stack every
+  PROFILE_INTERVAL seconds and writes the counts as collapsed stacks
+  (`*.folded`), ready for flamegraph.pl or speedscope. Cheap enough for
+  production; requests shorter than the interval may get no samples.
+- 'cprofile': runs cProfile and writes its stats (`*.prof`), for
+  pstats, snakeviz and similar. Exact call counts, but much slower.
+
+Files go to PROFILE_DIR, named by time, endpoint and user id, e.g.
+`20220101T120000.123456-homepage-user42.folded`. A token-triggered
+response names its file in the X-Warbler-Profile-File header.
+"""
+
+import cProfile
+import os
+import random
+import sys
+from collections import Counter
+from datetime import datetime
+from threading import Event, Thread, get_ident
+
+from flask import g, request
+from itsdangerous import BadSignature, TimestampSigner
+
+HEADER = 'X-Warbler-Profile'
+
+
+class StackSampler:
+    """Count the stacks of one thread, sampled from another thread."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, daemon=True,
+                              name='stack-sampler')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.stacks[collapse(frame)] += 1
+
+
+class CProfiler:
+    """cProfile of the current thread, with the same interface."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+def collapse(frame):
+    """Stack of `frame`, outermost first, in collapsed-stack form."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', '?')
+        names.append(f"{module}.{code.co_name}:{code.co_firstlineno}"
+                     .replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class RequestProfiler:
+    """Profile requests picked by token or at random."""
+
+    EXTENSIONS = {'sample': 'folded', 'cprofile': 'prof'}
+
+    def __init__(self):
+        self.mode = 'sample'
+        self.sample_rate = 0.0
+        self.endpoints = set()
+        self.interval = 0.005
+        self.directory = None
+        self.token_max_age = 3600
+        self.signer = None
+        self.profiled = 0
+
+    def init_app(self, app):
+        """Read the PROFILE_* settings of `app` and hook its requests."""
+
+        self.mode = app.config.get('PROFILE_MODE', 'sample')
+        if self.mode not in self.EXTENSIONS:
+            raise ValueError(f"Unknown PROFILE_MODE: {self.mode}")
+        self.sample_rate = app.config.get('PROFILE_SAMPLE_RATE', 0.0)
+        self.endpoints = set(app.config.get('PROFILE_ENDPOINTS') or ())
+        self.interval = app.config.get('PROFILE_INTERVAL', 0.005)
+        self.directory = app.config.get('PROFILE_DIR') or os.path.join(
+            app.instance_path, 'profiles')
+        self.token_max_age = app.config.get('PROFILE_TOKEN_MAX_AGE', 3600)
+        self.signer = TimestampSigner(app.config['SECRET_KEY'],
+                                      salt='warbler-profile')
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+    def make_token(self):
+        """A token for the X-Warbler-Profile header."""
+
+        return self.signer.sign('profile').decode()
+
+    def wanted(self):
+        """Should the current request be profiled? (and was it asked for?)"""
+
+        token = request.headers.get(HEADER)
+        if token:
+            try:
+                self.signer.unsign(token, max_age=self.token_max_age)
+                return True, True
+            except BadSignature:
+                pass
+
+        if (self.sample_rate
+                and (not self.endpoints or request.endpoint in self.endpoints)
+                and random.random() < self.sample_rate):
+            return True, False
+
+        return False, False
+
+    def _start_request(self):
+        wanted, requested = self.wanted()
+        if not wanted:
+            return
+
+        if self.mode == 'sample':
+            profiler = StackSampler(get_ident(), self.interval)
+        else:
+            profiler = CProfiler()
+        g.profiler = (profiler, requested)
+        profiler.start()
+
+    def _finish_request(self, response):
+        profiler, requested = g.pop('profiler', (None, False))
+        if profiler is None:
+            return response
+
+        profiler.stop()
+        path = self._write(profiler)
+        if requested:
+            response.headers[f'{HEADER}-File'] = os.path.basename(path)
+        return response
+
+    def _teardown_request(self, exc):
+        # Only still set if the request failed before after_request ran.
+        profiler, _ = g.pop('profiler', (None, False))
+        if profiler is not None:
+            profiler.stop()
+            self._write(profiler)
+
+    def _write(self, profiler):
+        user = getattr(g.get('user'), 'id', None)
+        name = (f"{datetime.utcnow():%Y%m%dT%H%M%S.%f}"
+                f"-{request.endpoint or 'none'}"
+                f"-{f'user{user}' if user else 'anon'}"
+                f".{self.EXTENSIONS[self.mode]}")
+        path = os.path.join(self.directory, name)
+
+        os.makedirs(self.directory, exist_ok=True)
+        profiler.write(path)
+        self.profiled += 1
+        return path
@@ -0,0 +1,141 @@
+"""Read-only rows for pages that list messages.
+
+Timelines, profiles and likes pages print a few columns of hundreds of
+messages and their authors. Building full ORM instances for that means
+identity-map bookkeeping, attribute instrumentation and lazy loaders for
+every row. The functions here select just the columns the templates use,
+with the author joined in, into small slotted objects. Each author is
+built once per page however many of their messages are on it.
+
+Rows are snapshots: they don't lazy load and changes to them are not
+saved. Views that change messages still load `Message` instances.
+"""
+
+from models import Likes, Message, User, TIMELINE_PAGE_SIZE
+
+MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp,
+                   Message.user_id, User.username, User.image_url)
+
+
+class Author:
+    """The author fields shown next to a message."""
+
+    __slots__ = ('id', 'username', 'image_url')
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+    def __repr__(self):
+        return f"<Author #{self.id}: {self.username}>"
+
+
+class MessageRow:
+    """A message as listed on a page, with its `user` (an `Author`)."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user')
+
+    def __init__(self, id, text, timestamp, user):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user = user
+
+    @property
+    def user_id(self):
+        return self.user.id
+
+    @property
+    def cursor(self):
+        """Keyset pagination cursor, as `Message.cursor`."""
+
+        return Message.make_cursor(self.timestamp, self.id)
+
+    def __repr__(self):
+        return f"<MessageRow #{self.id}: {self.user.username}>"
+
+
+def message_rows(query, limit=None):
+    """`MessageRow`s for (up to `limit` of) a query of messages, in order."""
+
+    return build_rows(query
+                      .join(User, User.id == Message.user_id)
+                      .with_entities(*MESSAGE_COLUMNS)
+                      .limit(limit))
+
+
+def build_rows(rows):
+    """`MessageRow`s for tuples of MESSAGE_COLUMNS values."""
+
+    authors = {}
+    messages = []
+    for msg_id, text, timestamp, user_id, username, image_url in rows:
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = Author(user_id, username, image_url)
+        messages.append(MessageRow(msg_id, text, timestamp, author))
+
+    return messages
+
+
+def messages_by_id(ids):
+    """Messages by id, in the order of `ids`; missing ids are skipped."""
+
+    if not ids:
+        return []
+
+    found = {msg.id: msg
+             for msg in message_rows(Message
+                                     .query
+                                     .filter(Message.id.in_(ids)))}
+
+    return [found[msg_id] for msg_id in ids if msg_id in found]
+
+
+def timeline(user_id, before=None, limit=TIMELINE_PAGE_SIZE):
+    """Newest messages from users that `user_id` follows.
+
+    `before` is a cursor from `MessageRow.cursor`; only messages older
+    than it are returned.
+    """
+
+    return message_rows(Message
+                        .timeline_query(user_id, Message.parse_cursor(before)),
+                        limit)
+
+
+def user_messages(user_id, limit=100):
+    """Newest messages written by `user_id`."""
+
+    return message_rows(Message
+                        .query
+                        .filter(Message.user_id == user_id)
+                        .order_by(Message.timestamp.desc(), Message.id.desc()),
+                        limit)
+
+
+def liked_messages(user_id, after=None, limit=TIMELINE_PAGE_SIZE):
+    """A page of messages liked by `user_id`, in the order they were
+    liked, and the cursor for the next page (None on the last one).
+
+    `after` is a cursor from an earlier page.
+    """
+
+    query = (Message
+             .query
+             .join(Likes, Likes.message_id == Message.id)
+             .join(User, User.id == Message.user_id)
+             .filter(Likes.user_id == user_id))
+    if after is not None:
+        query = query.filter(Likes.id > after)
+
+    # One extra row tells whether there is a next page.
+    rows = (query
+            .order_by(Likes.id)
+            .with_entities(Likes.id, *MESSAGE_COLUMNS)
+            .limit(limit + 1)
+            .all())
+
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return build_rows(row[1:] for row in rows[:limit]), next_cursor
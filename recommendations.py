@@ -0,0 +1,187 @@
+"""Batch "who to follow" recommendations.
+
+Run with `flask compute-recommendations`. Candidates for each user are
+scored from the follows graph with sparse matrix products:
+
+- friends of friends: accounts followed by the accounts you follow, with
+  paths through people who follow a lot of accounts counting for less;
+- co-followers: accounts whose followers overlap (cosine similarity) with
+  the followers of the accounts you follow.
+
+Users are scored in blocks of rows so memory stays bounded, and the top
+few candidates per user are written to the recommendations table.
+
+This needs numpy and scipy; the web app itself never imports it.
+"""
+
+import numpy as np
+from scipy import sparse
+
+from models import db, Follows, Recommendation
+
+
+def load_follow_matrix(chunk_size=100000):
+    """Sparse matrix A where A[i, j] = 1 if user i follows user j.
+
+    The follows table is streamed `chunk_size` rows at a time and each
+    chunk becomes a CSR matrix straight away. Chunks are summed in runs
+    of similar size, as in a merge sort, so each edge is copied about
+    log(chunks) times and the table is never held as one list of rows.
+    """
+
+    select = db.select([Follows.user_following_id,
+                        Follows.user_being_followed_id])
+    result = (db.session.connection()
+              .execution_options(stream_results=True)
+              .execute(select))
+
+    runs = []
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        edges = np.array([tuple(row) for row in rows], dtype=np.int64)
+        size = int(edges.max()) + 1
+        run = sparse.csr_matrix(
+            (np.ones(len(edges), dtype=np.float32), (edges[:, 0], edges[:, 1])),
+            shape=(size, size),
+        )
+        while runs and runs[-1].nnz <= run.nnz:
+            run = add_square(runs.pop(), run)
+        runs.append(run)
+
+    follows = sparse.csr_matrix((0, 0), dtype=np.float32)
+    for run in runs:
+        follows = add_square(follows, run)
+    return follows
+
+
+def add_square(a, b):
+    """Sum of square sparse matrices `a` and `b`, padding the smaller one."""
+
+    size = max(a.shape[0], b.shape[0])
+    a.resize((size, size))
+    b.resize((size, size))
+    return a + b
+
+
+class Scorer:
+    """Score recommendation candidates for blocks of users.
+
+    Accounts with more than `max_followers` followers are left out of the
+    co-follower term: they are similar to nearly everyone, and including
+    them makes the intermediate products dense. Only each user's
+    `max_co_followers` closest co-followers (by shared follows) are used
+    to find accounts, which bounds the third hop.
+    """
+
+    def __init__(self, follows, fof_weight=1.0, co_follower_weight=1.0,
+                 max_followers=10000, max_co_followers=100):
+        self.follows = follows.tocsr()
+        self.fof_weight = fof_weight
+        self.co_follower_weight = co_follower_weight
+        self.max_co_followers = max_co_followers
+
+        out_degree = np.asarray(self.follows.sum(axis=1)).ravel()
+        in_degree = np.asarray(self.follows.sum(axis=0)).ravel()
+
+        # Following a lot of accounts says little about each of them.
+        self.hub_weights = sparse.diags(1 / np.log(2 + out_degree))
+
+        # A normalized by in-degree, without the most followed accounts,
+        # so (A_n^T A_n)[k, j] is the cosine similarity of followers.
+        scale = np.where((in_degree > 0) & (in_degree <= max_followers),
+                         1 / np.sqrt(np.maximum(in_degree, 1)), 0)
+        normalized = self.follows @ sparse.diags(scale.astype(np.float32))
+        self.normalized = normalized.tocsr()
+        self.normalized_t = normalized.T.tocsr()
+
+    def score(self, start, stop):
+        """Candidate scores for users start..stop-1, one row per user.
+
+        Accounts a user already follows, and the user themselves, are
+        left out.
+        """
+
+        block = self.follows[start:stop]
+
+        fof = block @ self.hub_weights @ self.follows
+        co_followers = keep_top(block @ self.normalized_t,
+                                self.max_co_followers) @ self.normalized
+        scores = (self.fof_weight * fof
+                  + self.co_follower_weight * co_followers).tocsr()
+
+        rows = np.arange(stop - start)
+        self_mask = sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, rows + start)), shape=scores.shape)
+
+        scores = scores - scores.multiply(block) - scores.multiply(self_mask)
+        scores.eliminate_zeros()
+        return scores
+
+
+def keep_top(matrix, k):
+    """`matrix` (CSR) with only the `k` largest entries in each row."""
+
+    counts = np.diff(matrix.indptr)
+    if not len(counts) or counts.max() <= k:
+        return matrix
+
+    keep = []
+    for row in np.flatnonzero(counts):
+        lo, hi = matrix.indptr[row], matrix.indptr[row + 1]
+        if hi - lo <= k:
+            keep.append(np.arange(lo, hi))
+        else:
+            keep.append(lo + np.sort(
+                np.argpartition(-matrix.data[lo:hi], k)[:k]))
+    keep = np.concatenate(keep)
+
+    indptr = np.zeros(len(counts) + 1, dtype=matrix.indptr.dtype)
+    np.cumsum(np.minimum(counts, k), out=indptr[1:])
+    return sparse.csr_matrix(
+        (matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape)
+
+
+def top_n(scores, n):
+    """Yield (row, columns, values) of the `n` highest scores per row."""
+
+    for row in range(scores.shape[0]):
+        lo, hi = scores.indptr[row], scores.indptr[row + 1]
+        if lo == hi:
+            continue
+
+        values = scores.data[lo:hi]
+        columns = scores.indices[lo:hi]
+
+        best = np.arange(hi - lo)
+        if hi - lo > n:
+            best = np.argpartition(-values, n)[:n]
+        best = best[np.argsort(-values[best], kind='stable')]
+
+        yield row, columns[best], values[best]
+
+
+def compute_recommendations(per_user=10, block_size=1000, **scorer_options):
+    """Replace the recommendations table with fresh top-N suggestions."""
+
+    follows = load_follow_matrix()
+    scorer = Scorer(follows, **scorer_options)
+    insert = Recommendation.__table__.insert()
+
+    Recommendation.query.delete()
+
+    for start in range(0, follows.shape[0], block_size):
+        stop = min(start + block_size, follows.shape[0])
+        rows = [
+            dict(user_id=start + row,
+                 recommended_user_id=int(column),
+                 score=float(value))
+            for row, columns, values in top_n(scorer.score(start, stop), per_user)
+            for column, value in zip(columns, values)
+        ]
+        if rows:
+            db.session.execute(insert, rows)
+
+    db.session.commit()
@@ -1,20 +1,11 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Same as `flask load-data generator`; see bulk_load.py.
+"""
 
+import sys
 
-db.drop_all()
-db.create_all()
+from app import app
+from bulk_load import load_csvs
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+load_csvs(sys.argv[1] if len(sys.argv) > 1 else 'generator')
@@ -0,0 +1,186 @@
+"""Log slow SQL statements with their query plans.
+
+`SlowQueryLog` times every statement run on the engine. Any that take
+longer than SLOW_QUERY_MS are recorded with the route that ran them, the
+shapes (types and list lengths) of their bound parameters and the plan
+from running EXPLAIN on the same connection straight afterwards. A
+fraction (SLOW_QUERY_ANALYZE_RATE) of slow SELECTs on PostgreSQL get
+EXPLAIN ANALYZE instead, which runs the query again to get real row
+counts and timings; other statements are never analyzed, since that
+would repeat their writes.
+
+Records are appended as JSON lines to a rotating file, and the most
+recent are kept in memory for the admin page.
+
+Configured from the app with `init_app`:
+
+- SLOW_QUERY_MS: threshold in milliseconds (default 100; 0 turns the
+  log off)
+- SLOW_QUERY_ANALYZE_RATE: fraction of slow SELECTs to EXPLAIN ANALYZE
+  (default 0)
+- SLOW_QUERY_LOG: file path (default slow-queries.log in the instance
+  folder)
+- SLOW_QUERY_LOG_MAX_BYTES, SLOW_QUERY_LOG_BACKUPS: when to rotate the
+  file, and how many old ones to keep (default 10MB, 5)
+"""
+
+import json
+import logging
+import os
+import random
+from collections import deque
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from threading import Lock
+from time import perf_counter
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+# EXPLAIN, and EXPLAIN ANALYZE (None if unsupported), by dialect.
+EXPLAIN_PREFIXES = {
+    'postgresql': ('EXPLAIN ', 'EXPLAIN (ANALYZE, BUFFERS) '),
+    'sqlite': ('EXPLAIN QUERY PLAN ', None),
+}
+
+# Statements EXPLAIN understands.
+EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'with')
+
+
+class SlowQueryLog:
+    """Record statements slower than a threshold, with their plans."""
+
+    def __init__(self, keep=100):
+        self.threshold = 0
+        self.analyze_rate = 0.0
+        self.recent = deque(maxlen=keep)
+        self.count = 0
+        self._handler = None
+        self._lock = Lock()
+
+    def init_app(self, app, engine):
+        """Watch statements run on `engine`, using `app`'s settings."""
+
+        self.threshold = app.config.get('SLOW_QUERY_MS', 100) / 1000
+        self.analyze_rate = app.config.get('SLOW_QUERY_ANALYZE_RATE', 0.0)
+        self.path = app.config.get('SLOW_QUERY_LOG') or os.path.join(
+            app.instance_path, 'slow-queries.log')
+        self.max_bytes = app.config.get('SLOW_QUERY_LOG_MAX_BYTES',
+                                        10 * 1024 * 1024)
+        self.backups = app.config.get('SLOW_QUERY_LOG_BACKUPS', 5)
+
+        if self.threshold > 0:
+            event.listen(engine, 'before_cursor_execute', self._before_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info.setdefault('slow_query_start', []).append(perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        starts = conn.info.get('slow_query_start')
+        if not starts:
+            return
+        elapsed = perf_counter() - starts.pop()
+        if elapsed >= self.threshold:
+            self.record(conn, cursor, statement, parameters, executemany,
+                        elapsed)
+
+    def record(self, conn, cursor, statement, parameters, executemany,
+               elapsed):
+        """Log a slow statement, explaining it if it ran on its own."""
+
+        plan, analyzed = None, False
+        explainable = statement.lstrip().lower().startswith(EXPLAINABLE)
+        if explainable and not executemany:
+            plan, analyzed = self.explain(conn.dialect.name, cursor,
+                                          statement, parameters)
+
+        entry = {
+            'at': datetime.utcnow().isoformat(timespec='seconds'),
+            'ms': round(elapsed * 1000, 3),
+            'route': (f"{request.method} {request.endpoint or request.path}"
+                      if has_request_context() else None),
+            'statement': ' '.join(statement.split()),
+            'parameters': parameter_shapes(parameters, executemany),
+            'plan': plan,
+            'analyzed': analyzed,
+        }
+
+        with self._lock:
+            self.count += 1
+            self.recent.appendleft(entry)
+        self._write(entry)
+
+    def explain(self, dialect, cursor, statement, parameters):
+        """(plan text, whether it was analyzed) for `statement`.
+
+        Runs on a new cursor of the same DBAPI connection, so it sees
+        the same transaction. On PostgreSQL it runs in a savepoint, so
+        a failure can't abort the request's transaction.
+        """
+
+        prefixes = EXPLAIN_PREFIXES.get(dialect)
+        if prefixes is None:
+            return None, False
+
+        analyze = (prefixes[1] is not None
+                   and statement.lstrip().lower().startswith('select')
+                   and random.random() < self.analyze_rate)
+        prefix = prefixes[1] if analyze else prefixes[0]
+        savepoint = dialect == 'postgresql'
+
+        explain_cursor = cursor.connection.cursor()
+        try:
+            if savepoint:
+                explain_cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                explain_cursor.execute(prefix + statement, parameters)
+                rows = explain_cursor.fetchall()
+            except Exception as error:
+                if savepoint:
+                    explain_cursor.execute(
+                        "ROLLBACK TO SAVEPOINT slow_query_explain")
+                return f"EXPLAIN failed: {error}", False
+            if savepoint:
+                explain_cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        finally:
+            explain_cursor.close()
+
+        # PostgreSQL gives one line of text per row; SQLite's plan detail
+        # is the last column.
+        return '\n'.join(str(row[-1]) for row in rows), analyze
+
+    def _write(self, entry):
+        with self._lock:
+            if self._handler is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                            exist_ok=True)
+                self._handler = RotatingFileHandler(self.path,
+                                                    maxBytes=self.max_bytes,
+                                                    backupCount=self.backups)
+        self._handler.handle(logging.makeLogRecord({'msg': json.dumps(entry)}))
+
+
+def parameter_shapes(parameters, executemany=False):
+    """Types of bound parameters (not their values, which may be private).
+
+    Lists and tuples also give their length, since long IN lists are a
+    common reason for a slow plan.
+    """
+
+    if executemany:
+        return {'rows': len(parameters),
+                'first': parameter_shapes(parameters[0]) if parameters else None}
+    if isinstance(parameters, dict):
+        return {key: shape(value) for key, value in parameters.items()}
+    return [shape(value) for value in parameters or ()]
+
+
+def shape(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
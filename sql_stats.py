@@ -0,0 +1,124 @@
+"""Per-request SQL statistics and N+1 query detection.
+
+`SQLStats` listens to the engine's cursor events and, for each request,
+counts the statements run, the time spent in them and how often each
+distinct statement was repeated. A statement run `repeat_threshold` or
+more times in one request is nearly always a lazy load inside a loop
+(an N+1 query), so the request is flagged.
+
+Every request is logged as one JSON object to the "warbler.sql" logger:
+at INFO normally, at WARNING when flagged, with the repeated statements.
+With `headers` on, responses also carry X-SQL-Statements, X-SQL-Time-Ms
+and X-SQL-Repeated (the number of repeated statements).
+
+Statements are told apart by their SQL text, which holds placeholders
+rather than values, so the bookkeeping is a dict increment per
+statement; it's cheap enough to leave on in production.
+"""
+
+import json
+import logging
+from collections import Counter
+from time import perf_counter
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger('warbler.sql')
+
+# Characters of each repeated statement to include in the log.
+LOGGED_STATEMENT_LENGTH = 300
+
+
+class RequestStats:
+    """SQL run during one request."""
+
+    __slots__ = ('statements', 'seconds', 'shapes')
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    def repeated(self, threshold):
+        """(statement, times run) for statements run `threshold`+ times."""
+
+        if not threshold:
+            return []
+        return [(statement, count)
+                for statement, count in self.shapes.most_common()
+                if count >= threshold]
+
+
+class SQLStats:
+    """Record SQL statistics for every request of an app."""
+
+    def __init__(self, repeat_threshold=5, headers=False):
+        self.repeat_threshold = repeat_threshold
+        self.headers = headers
+        self.requests = 0
+        self.statements = 0
+        self.seconds = 0.0
+        self.flagged = 0
+
+    def init_app(self, app, engine):
+        """Instrument requests to `app` and statements run on `engine`."""
+
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def _start_request(self):
+        g.sql_stats = RequestStats()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        if has_app_context() and 'sql_stats' in g:
+            conn.info.setdefault('sql_stats_start', []).append(perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        stats = g.get('sql_stats') if has_app_context() else None
+        starts = conn.info.get('sql_stats_start')
+        if stats is None or not starts:
+            return
+
+        stats.statements += 1
+        stats.seconds += perf_counter() - starts.pop()
+        stats.shapes[statement] += 1
+
+    def _finish_request(self, response):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return response
+
+        repeated = stats.repeated(self.repeat_threshold)
+        self.requests += 1
+        self.statements += stats.statements
+        self.seconds += stats.seconds
+        self.flagged += bool(repeated)
+
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'statements': stats.statements,
+            'db_ms': round(stats.seconds * 1000, 3),
+        }
+        if repeated:
+            record['repeated'] = [
+                {'count': count,
+                 'statement': ' '.join(statement.split())[:LOGGED_STATEMENT_LENGTH]}
+                for statement, count in repeated]
+            logger.warning(json.dumps(record))
+        else:
+            logger.info(json.dumps(record))
+
+        if self.headers:
+            response.headers['X-SQL-Statements'] = str(stats.statements)
+            response.headers['X-SQL-Time-Ms'] = f"{stats.seconds * 1000:.3f}"
+            response.headers['X-SQL-Repeated'] = str(len(repeated))
+
+        return response
@@ -0,0 +1,113 @@
+"""Static asset build and serving tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from flask import Flask, render_template_string
+
+from assets import Assets, build, CACHE_CONTROL
+
+CSS = b'body { background: url("/static/images/bg.png"); }\n' * 20
+
+
+class AssetsTestCase(TestCase):
+    """Test hashing static files and linking to them."""
+
+    def setUp(self):
+        """A static folder with a stylesheet and the image it uses."""
+
+        self.directory = TemporaryDirectory()
+        self.static = os.path.join(self.directory.name, 'static')
+        for path, data in (('images/bg.png', b'\x89PNG not really'),
+                           ('stylesheets/style.css', CSS)):
+            path = os.path.join(self.static, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+
+        self.manifest = build(self.static, echo=lambda line: None)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_app(self, **config):
+        app = Flask(__name__, static_folder=self.static)
+        app.config.update(config)
+        assets = Assets()
+        assets.init_app(app)
+        return app, assets
+
+    def dist(self, path):
+        return os.path.join(self.static, 'dist', path)
+
+    def test_build(self):
+        '''Test copies are named by content, and stylesheets point at them'''
+
+        image = self.manifest['images/bg.png']
+        css = self.manifest['stylesheets/style.css']
+        self.assertRegex(image, r'^images/bg\.[0-9a-f]{10}\.png$')
+
+        with open(self.dist(css), 'rb') as f:
+            rewritten = f.read()
+        self.assertIn(f'url("../{image}")'.encode(), rewritten)
+        with open(self.dist(css + '.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), rewritten)
+        self.assertFalse(os.path.exists(self.dist(image + '.gz')))
+
+        with open(self.dist('manifest.json')) as f:
+            self.assertEqual(json.load(f), self.manifest)
+
+        # Building again doesn't hash the previous build.
+        self.assertEqual(build(self.static, echo=lambda line: None),
+                         self.manifest)
+
+    def test_static_url(self):
+        '''Test built files get hashed URLs, and anything else is left alone'''
+
+        app, assets = self.make_app()
+        hashed = '/static/dist/' + self.manifest['images/bg.png']
+
+        self.assertEqual(assets.url('images/bg.png'), hashed)
+        self.assertEqual(assets.url('/static/images/bg.png'), hashed)
+        self.assertEqual(assets.url('/static/images/new.png'),
+                         '/static/images/new.png')
+        self.assertEqual(assets.url('https://example.com/a.png'),
+                         'https://example.com/a.png')
+
+        with app.test_request_context():
+            self.assertEqual(
+                render_template_string("{{ static_url('images/bg.png') }}"),
+                hashed)
+
+        app, assets = self.make_app(ASSET_FINGERPRINTS=False)
+        self.assertEqual(assets.url('images/bg.png'), '/static/images/bg.png')
+
+    def test_serve(self):
+        '''Test hashed files are immutable, and precompressed when accepted'''
+
+        app, assets = self.make_app()
+        client = app.test_client()
+        url = assets.url('stylesheets/style.css')
+
+        plain = client.get(url)
+        self.assertEqual(plain.headers['Cache-Control'], CACHE_CONTROL)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertTrue(plain.content_type.startswith('text/css'))
+
+        gzipped = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(gzipped.content_type.startswith('text/css'))
+        self.assertEqual(gzip.decompress(gzipped.data), plain.data)
+
+        self.assertEqual(client.get('/static/dist/manifest.json').status_code,
+                         404)
+        self.assertEqual(client.get('/static/dist/../secret').status_code, 404)
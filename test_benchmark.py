@@ -0,0 +1,78 @@
+"""Route benchmark tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_benchmark.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import benchmark
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class BenchmarkTestCase(TestCase):
+    """Test the route benchmarks on small datasets."""
+
+    def tearDown(self):
+        benchmark.reset_caches()
+
+    def test_seed(self):
+        '''Test seeding gives the asked-for rows and counts'''
+
+        benchmark.seed(users=20, messages=50, follows=60, likes=40)
+
+        self.assertEqual(User.query.count(), 20)
+        self.assertEqual(Follows.query.count(), 60)
+        self.assertEqual(Likes.query.count(), 40)
+        self.assertEqual(sum(u.followers_count for u in User.query), 60)
+
+        subjects = benchmark.pick_subjects()
+        self.assertEqual(subjects['user'], 1)
+
+    def test_routes_within_budget(self):
+        '''Test every route stays in budget, however much data there is'''
+
+        counts = []
+        for scale in (1, 3):
+            benchmark.seed(users=30 * scale, messages=100 * scale,
+                           follows=150 * scale, likes=100 * scale)
+            results = benchmark.run_routes(benchmark.pick_subjects(),
+                                           iterations=2, warmup=0)
+
+            self.assertEqual(benchmark.over_budget(results), [])
+            counts.append({name: result['queries']
+                           for name, result in results.items()})
+
+        self.assertEqual(counts[0], counts[1])
+
+    def test_regressions(self):
+        '''Test extra statements and slower medians are reported'''
+
+        base = {'home': {'queries': 5, 'cached_queries': 3, 'p50_ms': 10.0}}
+        same = {'home': {'queries': 5, 'cached_queries': 3, 'p50_ms': 12.0}}
+        worse = {'home': {'queries': 6, 'cached_queries': 3, 'p50_ms': 13.0}}
+
+        self.assertEqual(benchmark.regressions(same, base), [])
+        self.assertEqual(len(benchmark.regressions(worse, base)), 2)
+        self.assertEqual(
+            len(benchmark.regressions(worse, base, compare_timings=False)), 1)
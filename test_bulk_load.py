@@ -0,0 +1,94 @@
+"""Bulk CSV loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_load.py
+
+
+import os
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from bulk_load import load_csvs
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+USERS_CSV = """email,username,image_url,password,bio,header_image_url,location
+a@test.com,alice,/a.png,HASHED_PASSWORD,"Hi, I'm Alice",/ah.png,Here
+b@test.com,bob,/b.png,HASHED_PASSWORD,,/bh.png,There
+"""
+
+MESSAGES_CSV = """text,timestamp,user_id
+first,2020-01-01 10:00:00.5,2
+second,2020-01-02 10:00:00,2
+"""
+
+FOLLOWS_CSV = """user_being_followed_id,user_following_id
+2,1
+"""
+
+
+class BulkLoadTestCase(TestCase):
+    """Test loading the generator's CSV format."""
+
+    def test_load_csvs(self):
+        '''Test rows are numbered, converted and counted'''
+
+        with TemporaryDirectory() as directory:
+            for name, data in [('users', USERS_CSV), ('messages', MESSAGES_CSV),
+                               ('follows', FOLLOWS_CSV)]:
+                with open(os.path.join(directory, f'{name}.csv'), 'w') as f:
+                    f.write(data)
+
+            output = []
+            load_csvs(directory, batch_size=1, echo=output.append)
+
+        self.assertEqual(len(output), 4)
+
+        alice, bob = User.query.order_by(User.id).all()
+        self.assertEqual((alice.id, alice.bio), (1, "Hi, I'm Alice"))
+        self.assertIsNone(bob.bio)
+        self.assertEqual(bob.messages_count, 2)
+        self.assertEqual(bob.followers_count, 1)
+        self.assertEqual(alice.following_count, 1)
+
+        msg = Message.query.filter_by(text='first').one()
+        self.assertEqual(msg.timestamp, datetime(2020, 1, 1, 10, 0, 0, 500000))
+        self.assertEqual(Follows.query.count(), 1)
+
+        # New rows get ids after the loaded ones.
+        carol = User(email="c@test.com", username="carol",
+                     password="HASHED_PASSWORD")
+        db.session.add(carol)
+        db.session.commit()
+        self.assertEqual(carol.id, 3)
+
+    def test_unknown_column(self):
+        '''Test a CSV naming a column the table lacks is refused'''
+
+        with TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'users.csv'), 'w') as f:
+                f.write("email,nickname\na@test.com,al\n")
+
+            with self.assertRaises(ValueError):
+                load_csvs(directory, echo=lambda line: None)
+
+        db.session.rollback()
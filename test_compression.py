@@ -0,0 +1,129 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import zlib
+from unittest import TestCase
+
+from flask import Flask, Response
+
+from compression import Compression
+from metrics import compression_samples
+
+PAGE = '<p>Hello, warbler!</p>\n' * 100
+
+
+class CompressionTestCase(TestCase):
+    """Test which responses are compressed, and how."""
+
+    def setUp(self):
+        """App with pages of different types and sizes."""
+
+        self.app = Flask(__name__)
+        self.app.config['COMPRESSION_MIN_SIZE'] = 100
+        self.compression = Compression()
+        self.compression.encodings = ['gzip']
+        self.compression.init_app(self.app)
+
+        @self.app.route('/page')
+        def page():
+            return PAGE, {'ETag': '"v1"', 'Vary': 'Cookie'}
+
+        @self.app.route('/small')
+        def small():
+            return 'hi'
+
+        @self.app.route('/image')
+        def image():
+            return Response(b'\x89PNG' * 100, mimetype='image/png')
+
+        @self.app.route('/encoded')
+        def encoded():
+            return Response(gzip.compress(PAGE.encode()), mimetype='text/css',
+                            headers={'Content-Encoding': 'gzip'})
+
+        @self.app.route('/stream')
+        def stream():
+            return Response((f'line {i}\n' for i in range(3)),
+                            mimetype='text/plain')
+
+        self.client = self.app.test_client()
+
+    def get(self, url, accept='gzip, deflate'):
+        return self.client.get(url, headers={'Accept-Encoding': accept})
+
+    def test_compressed(self):
+        '''Test accepted, large text responses are gzipped'''
+
+        resp = self.get('/page')
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Cookie, Accept-Encoding')
+        self.assertEqual(resp.headers['ETag'], 'W/"v1"')
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertEqual(gzip.decompress(resp.data).decode(), PAGE)
+
+        samples = {(name, labels.get('encoding')): value for
+                   name, _, _, labels, value in
+                   compression_samples(self.compression)}
+        self.assertEqual(
+            samples['warbler_compression_input_bytes_total', 'gzip'],
+            len(PAGE))
+        self.assertEqual(
+            samples['warbler_compression_output_bytes_total', 'gzip'],
+            len(resp.data))
+        self.assertLess(samples['warbler_compression_ratio', 'gzip'], 0.2)
+
+    def test_negotiation(self):
+        '''Test the encoding comes from Accept-Encoding'''
+
+        self.assertNotIn('Content-Encoding', self.get('/page', '').headers)
+        refused = self.get('/page', 'gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', refused.headers)
+        self.assertEqual(refused.data.decode(), PAGE)
+        self.assertIn('Accept-Encoding', refused.headers['Vary'])
+
+        self.compression.encodings = ['br', 'gzip']
+        self.assertEqual(
+            self.get('/page', 'br;q=0.5, gzip').headers['Content-Encoding'],
+            'gzip')
+
+    def test_skipped(self):
+        '''Test small, binary and already encoded responses are left alone'''
+
+        for url in ('/small', '/image', '/encoded'):
+            resp = self.get(url)
+            self.assertEqual(resp.headers['Content-Length'],
+                             str(len(resp.data)))
+            self.assertNotIn('Accept-Encoding', resp.headers.get('Vary', ''))
+
+        self.assertEqual(self.get('/encoded').headers['Content-Encoding'],
+                         'gzip')
+        self.assertEqual(dict(self.compression.skipped),
+                         {'small': 1, 'type': 1, 'encoded': 2})
+
+    def test_streamed(self):
+        '''Test streamed responses are compressed chunk by chunk'''
+
+        resp = self.client.get('/stream', buffered=False,
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        lines = [decompressor.decompress(chunk).decode()
+                 for chunk in resp.response]
+        resp.close()
+
+        self.assertEqual(lines[:3], ['line 0\n', 'line 1\n', 'line 2\n'])
+        self.assertEqual(''.join(lines), 'line 0\nline 1\nline 2\n')
+        self.assertEqual(self.compression.responses['gzip'], 1)
+
+    def test_disabled(self):
+        '''Test nothing is compressed with compression off'''
+
+        self.compression.enabled = False
+        self.assertNotIn('Content-Encoding', self.get('/page').headers)
@@ -0,0 +1,53 @@
+"""CSV generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_create_csvs.py
+
+
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+
+def generate(out, *args):
+    """Run the generator into `out`; return the CSVs' contents by name."""
+
+    subprocess.run([sys.executable, GENERATOR, '--out', out, '--users', '200',
+                    '--messages', '500', '--follows', '1000',
+                    '--chunk-size', '30', *args],
+                   check=True, capture_output=True)
+
+    csvs = {}
+    for name in ('users', 'messages', 'follows'):
+        with open(os.path.join(out, f'{name}.csv')) as f:
+            csvs[name] = f.read()
+    return csvs
+
+
+class CreateCSVsTestCase(TestCase):
+    """Test the CSV generator."""
+
+    def test_same_for_any_workers(self):
+        '''Test output only depends on the options, not the workers'''
+
+        with TemporaryDirectory() as one, TemporaryDirectory() as several:
+            options = ['--follower-skew', '1', '--posting-skew', '1']
+            serial = generate(one, '--workers', '1', *options)
+            parallel = generate(several, '--workers', '3', *options)
+
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial['users'].count('\n'), 201)
+        self.assertEqual(serial['messages'].count('\n'), 501)
+
+    def test_following_skew(self):
+        '''Test a following skew without a mean is rejected'''
+
+        with TemporaryDirectory() as out:
+            with self.assertRaises(subprocess.CalledProcessError):
+                generate(out, '--following-skew', '2')
@@ -0,0 +1,121 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from follow_graph import Adjacency, FollowGraph
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class AdjacencyTestCase(TestCase):
+    """Test CSR adjacency arrays."""
+
+    def test_lookups(self):
+        '''Test membership, degree and neighbours with pending changes'''
+
+        adj = Adjacency.from_pairs([(1, 2), (1, 5), (3, 1)])
+
+        self.assertTrue(adj.contains(1, 5))
+        self.assertFalse(adj.contains(2, 1))
+        self.assertFalse(adj.contains(99, 1))
+        self.assertEqual(adj.degree(1), 2)
+
+        adj.add(1, 3)
+        adj.remove(1, 2)
+        adj.add(7, 1)
+
+        self.assertEqual(adj.neighbours(1), [3, 5])
+        self.assertEqual(adj.degree(7), 1)
+
+        compacted = adj.compacted()
+        self.assertEqual(compacted.neighbours(1), [3, 5])
+        self.assertEqual(compacted.neighbours(3), [1])
+        self.assertEqual(compacted.neighbours(7), [1])
+        self.assertEqual(compacted.pending, 0)
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the follow graph built from the follows table."""
+
+    def setUp(self):
+        """Create two users, one following the other."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u1 = User(email="test@test.com", username="testuser",
+                  password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="test2user",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=u2.id, user_following_id=u1.id))
+        db.session.commit()
+
+        self.u1, self.u2 = u1.id, u2.id
+
+    def test_follow_graph(self):
+        '''Test graph answers from the table and tracks later changes'''
+
+        graph = FollowGraph(compact_after=1)
+
+        self.assertTrue(graph.is_following(self.u1, self.u2))
+        self.assertTrue(graph.is_followed_by(self.u2, self.u1))
+        self.assertFalse(graph.is_following(self.u2, self.u1))
+        self.assertEqual(graph.followers_count(self.u2), 1)
+
+        graph.add(self.u2, self.u1)
+        self.assertEqual(graph.follower_ids(self.u1), [self.u2])
+
+        graph.remove_user(self.u1)
+        self.assertEqual(graph.following_ids(self.u2), [])
+        self.assertEqual(graph.follower_ids(self.u2), [])
+
+    def test_stale_graph(self):
+        '''Test a stale graph is reloaded in the background, answering
+        from the old one meanwhile'''
+
+        graph = FollowGraph(max_age=0)
+        self.assertFalse(graph.is_following(self.u2, self.u1))
+
+        db.session.add(Follows(user_being_followed_id=self.u1,
+                               user_following_id=self.u2))
+        db.session.commit()
+
+        with app.app_context():
+            with graph._build_lock:
+                self.assertFalse(graph.is_following(self.u2, self.u1))
+                # Already reloading: no second thread.
+                refresher = graph._refresher
+                graph.is_following(self.u2, self.u1)
+                self.assertIs(graph._refresher, refresher)
+            refresher.join(5)
+
+        graph.max_age = None
+        self.assertTrue(graph.is_following(self.u2, self.u1))
+        self.assertEqual(graph.followers_count(self.u1), 1)
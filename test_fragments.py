@@ -0,0 +1,63 @@
+"""Template fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+
+from unittest import TestCase
+
+from flask import Flask
+
+from fragments import FragmentCache
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test the {% cache %} template tag."""
+
+    def setUp(self):
+        """Create an app with a fragment cache."""
+
+        self.app = Flask(__name__)
+        self.fragments = FragmentCache(max_size=2)
+        self.fragments.init_app(self.app)
+        self.template = self.app.jinja_env.from_string(
+            "{% cache 'item', item.id, item.text %}"
+            "<p>{{ item.text }} {{ render_count() }}</p>"
+            "{% endcache %}<b>{{ viewer }}</b>")
+
+        self.renders = 0
+
+        def render_count():
+            self.renders += 1
+            return self.renders
+
+        self.app.jinja_env.globals['render_count'] = render_count
+
+    def render(self, viewer, **item):
+        return self.template.render(item=item, viewer=viewer)
+
+    def test_cache(self):
+        '''Test fragments are reused across viewers and re-keyed on change'''
+
+        self.assertEqual(self.render('a', id=1, text='<hi>'),
+                         '<p>&lt;hi&gt; 1</p><b>a</b>')
+        self.assertEqual(self.render('b', id=1, text='<hi>'),
+                         '<p>&lt;hi&gt; 1</p><b>b</b>')
+        self.assertEqual((self.fragments.hits, self.fragments.misses), (1, 1))
+
+        self.assertEqual(self.render('a', id=1, text='edited'),
+                         '<p>edited 2</p><b>a</b>')
+
+    def test_lru(self):
+        '''Test the least recently used fragment is dropped when full'''
+
+        self.render('a', id=1, text='one')
+        self.render('a', id=2, text='two')
+        self.render('a', id=1, text='one')
+        self.render('a', id=3, text='three')
+
+        self.render('a', id=1, text='one')
+        self.assertEqual(self.renders, 3)
+        self.render('a', id=2, text='two')
+        self.assertEqual(self.renders, 4)
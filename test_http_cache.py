@@ -0,0 +1,157 @@
+"""HTTP cache header tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_cache.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, http_cache, principals
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class HTTPCacheTestCase(TestCase):
+    """Test cache policies and conditional GETs."""
+
+    def setUp(self):
+        """Create an author with a message, and a reader."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        author = User(email="test@test.com", username="author",
+                      password="HASHED_PASSWORD")
+        reader = User(email="test2@test.com", username="reader",
+                      password="HASHED_PASSWORD")
+        db.session.add_all([author, reader])
+        db.session.commit()
+
+        msg = Message(text="hello", timestamp=datetime(2020, 1, 1, 12),
+                      user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.author, self.reader, self.msg = author.id, reader.id, msg.id
+        principals.clear()
+        self.client = app.test_client()
+
+    def revalidate(self, url):
+        """(first response, response to asking again with its ETag)"""
+
+        resp = self.client.get(url)
+        again = self.client.get(
+            url, headers={'If-None-Match': resp.headers['ETag']})
+        return resp, again
+
+    def test_message_not_modified(self):
+        '''Test a message page gets validators and answers 304'''
+
+        resp, again = self.revalidate(f'/messages/{self.msg}')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+        self.assertIn('Cookie', resp.headers['Vary'])
+        self.assertNotIn('Last-Modified', resp.headers)
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.data, b'')
+
+        by_date = self.client.get(
+            f'/messages/{self.msg}',
+            headers={'If-Modified-Since': 'Wed, 01 Jan 2020 12:00:00 GMT'})
+        self.assertEqual(by_date.status_code, 200)
+
+    def test_user_page_changes(self):
+        '''Test a profile's ETag changes with its messages and its viewer'''
+
+        url = f'/users/{self.author}'
+        resp, again = self.revalidate(url)
+        self.assertEqual(again.status_code, 304)
+        etag = resp.headers['ETag']
+
+        db.session.add(Message(text="again", user_id=self.author))
+        User.update_counts(self.author, messages_count=1)
+        db.session.commit()
+
+        changed = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertIn('again', changed.get_data(as_text=True))
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader
+        logged_in = self.client.get(url, headers={
+            'If-None-Match': changed.headers['ETag']})
+        self.assertEqual(logged_in.status_code, 200)
+
+    def test_no_validators_with_flashes(self):
+        '''Test pages showing a flashed message are never reused'''
+
+        with self.client.session_transaction() as sess:
+            sess['_flashes'] = [('danger', 'Access unauthorized.')]
+
+        resp = self.client.get(f'/messages/{self.msg}')
+        self.assertNotIn('ETag', resp.headers)
+        self.assertIn('Access unauthorized.', resp.get_data(as_text=True))
+
+    def test_timeline_policy(self):
+        '''Test older timeline pages may be reused for a while'''
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader
+
+        first = self.client.get('/')
+        older = self.client.get('/?before=2020-01-02T00:00:00_1')
+
+        self.assertEqual(first.headers['Cache-Control'], 'private, no-cache')
+        self.assertEqual(older.headers['Cache-Control'],
+                         f"private, max-age={app.config['TIMELINE_CACHE_SECONDS']}")
+
+    def test_disabled(self):
+        '''Test nothing is cached with HTTP caching off'''
+
+        http_cache.enabled = False
+        try:
+            resp = self.client.get(f'/messages/{self.msg}')
+        finally:
+            http_cache.enabled = True
+
+        self.assertNotIn('ETag', resp.headers)
+        self.assertEqual(resp.headers['Cache-Control'],
+                         'no-cache, no-store, must-revalidate')
+
+    def test_disabled_keeps_own_headers(self):
+        '''Test responses with their own Cache-Control keep it with caching off'''
+
+        http_cache.enabled = False
+        try:
+            with app.test_request_context('/assets/style.css'):
+                resp = app.response_class('body')
+                resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+                resp = http_cache.apply(resp)
+        finally:
+            http_cache.enabled = True
+
+        self.assertEqual(resp.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        self.assertNotIn('Pragma', resp.headers)
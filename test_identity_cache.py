@@ -0,0 +1,186 @@
+"""Identity cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_identity_cache.py
+
+
+import os
+from time import sleep
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, identity_cache, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from identity_cache import MemoryBackend
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class MemoryBackendTestCase(TestCase):
+    """Test the in-process cache backend."""
+
+    def test_versions(self):
+        '''Test values are only stored at the current version'''
+
+        backend = MemoryBackend(max_size=2)
+
+        backend.add('a', 0, 'A')
+        self.assertEqual(backend.get('a'), (0, 'A'))
+
+        backend.bump(['a'])
+        self.assertEqual(backend.get('a'), (1, None))
+        backend.add('a', 0, 'stale')
+        self.assertEqual(backend.get('a'), (1, None))
+
+        backend.add('b', 0, 'B')
+        backend.add('c', 0, 'C')
+        self.assertEqual(backend.get('a'), (1, None))
+
+    def test_bump_then_evict(self):
+        '''Test a reader from before a bump can't store after an eviction'''
+
+        backend = MemoryBackend(max_size=1)
+
+        version, _ = backend.get('a')
+        backend.bump(['a'])
+        backend.add('b', backend.get('b')[0], 'B')
+        self.assertEqual(list(backend._entries), ['b'])
+
+        backend.add('a', version, 'stale')
+        self.assertEqual(backend.get('a')[1], None)
+
+    def test_ttl(self):
+        '''Test values expire but keep their version'''
+
+        backend = MemoryBackend(ttl=0.01)
+        backend.add('a', 0, 'A')
+        self.assertEqual(backend.get('a'), (0, 'A'))
+
+        sleep(0.02)
+        self.assertEqual(backend.get('a'), (0, None))
+        backend.add('a', 0, 'A again')
+        self.assertEqual(backend.get('a'), (0, 'A again'))
+
+
+class IdentityCacheTestCase(TestCase):
+    """Test caching users and messages between sessions."""
+
+    def setUp(self):
+        """Create a user with a message."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+
+        msg = Message(text="a warble", user_id=u.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.uid, self.msg_id = u.id, msg.id
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def get_fresh(self, cls, ident):
+        """Look up a row from a new session, as the next request would."""
+
+        db.session.remove()
+        return identity_cache.get(cls, ident)
+
+    def test_hit(self):
+        '''Test rows are served from the cache after the first load'''
+
+        self.get_fresh(User, self.uid)
+        hits = identity_cache.hits
+
+        user = self.get_fresh(User, self.uid)
+        self.assertEqual(identity_cache.hits, hits + 1)
+        self.assertEqual(user.username, "testuser")
+        self.assertEqual([msg.text for msg in user.messages], ["a warble"])
+        self.assertIsNone(self.get_fresh(User, -1))
+
+    def test_update(self):
+        '''Test flushed and bulk updates invalidate cached rows'''
+
+        self.get_fresh(User, self.uid).bio = "new bio"
+        db.session.commit()
+        self.assertEqual(self.get_fresh(User, self.uid).bio, "new bio")
+
+        User.update_counts(self.uid, messages_count=5)
+        db.session.commit()
+        self.assertEqual(self.get_fresh(User, self.uid).messages_count, 5)
+
+        User.reconcile_counts()
+        db.session.commit()
+        self.assertEqual(self.get_fresh(User, self.uid).messages_count, 1)
+
+    def test_rollback(self):
+        '''Test rows loaded inside a rolled back transaction are dropped'''
+
+        db.session.remove()
+        User.query.get(self.uid).bio = "uncommitted"
+        db.session.flush()
+        self.assertEqual(identity_cache.get(User, self.uid).bio, "uncommitted")
+        db.session.rollback()
+
+        self.assertIsNone(self.get_fresh(User, self.uid).bio)
+
+    def test_delete(self):
+        '''Test deleting a user drops the messages that cascade with it'''
+
+        self.get_fresh(Message, self.msg_id)
+        self.get_fresh(User, self.uid)
+
+        User.query.filter_by(id=self.uid).delete()
+        db.session.commit()
+
+        self.assertIsNone(self.get_fresh(User, self.uid))
+        self.assertIsNone(self.get_fresh(Message, self.msg_id))
+
+    def test_get_many(self):
+        '''Test messages come back in order with their authors loaded'''
+
+        msg = Message(text="another", user_id=self.uid)
+        db.session.add(msg)
+        db.session.commit()
+        ids = [msg.id, self.msg_id, -1]
+
+        db.session.remove()
+        messages = Message.get_many(ids)
+        self.assertEqual([m.id for m in messages], ids[:2])
+
+        statements = []
+        def count(*args):
+            statements.append(args)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            self.assertEqual([m.user.username for m in messages],
+                             ["testuser", "testuser"])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(statements, [])
@@ -0,0 +1,162 @@
+"""Like writing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likes.py
+
+
+import os
+from threading import Thread
+from unittest import TestCase, skipUnless
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from likes import LikeBuffer
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class LikesTestCase(TestCase):
+    """Test toggling and batching likes."""
+
+    def setUp(self):
+        """Create two users and a message."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        u1 = User(email="test@test.com", username="testuser",
+                  password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="test2user",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        msg = Message(text="a warble", user_id=u2.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.u1, self.u2, self.msg = u1.id, u2.id, msg.id
+
+    def test_toggle(self):
+        '''Test toggling likes per user and keeping likes_count in step'''
+
+        self.assertTrue(Likes.toggle(self.u1, self.msg))
+        self.assertTrue(Likes.toggle(self.u2, self.msg))
+        db.session.commit()
+
+        self.assertEqual(Likes.query.count(), 2)
+        self.assertEqual(User.query.get(self.u1).likes_count, 1)
+
+        self.assertFalse(Likes.toggle(self.u1, self.msg))
+        self.assertIsNone(Likes.toggle(self.u1, -1))
+        db.session.commit()
+
+        self.assertEqual([like.user_id for like in Likes.query], [self.u2])
+        self.assertEqual(User.query.get(self.u1).likes_count, 0)
+        self.assertEqual(User.query.get(self.u2).likes_count, 1)
+
+    @skipUnless(db.engine.dialect.name == 'postgresql', "needs PostgreSQL")
+    def test_toggle_race(self):
+        '''Test a like inserted concurrently is taken as liked, not an error'''
+
+        liked = []
+
+        def toggle():
+            with app.app_context():
+                liked.append(Likes.toggle(self.u1, self.msg))
+                db.session.commit()
+
+        with db.engine.connect() as other:
+            transaction = other.begin()
+            other.execute(Likes.__table__.insert(),
+                          user_id=self.u1, message_id=self.msg)
+
+            # Blocks on the other transaction's uncommitted row.
+            thread = Thread(target=toggle)
+            thread.start()
+            thread.join(0.5)
+            transaction.commit()
+            thread.join()
+
+        self.assertEqual(liked, [True])
+        self.assertEqual(Likes.query.count(), 1)
+
+    def test_buffer(self):
+        '''Test buffered toggles are coalesced and written on flush'''
+
+        buffer = LikeBuffer(app, interval=60)
+
+        self.assertTrue(buffer.toggle(self.u1, self.msg))
+        self.assertFalse(buffer.toggle(self.u1, self.msg))
+        self.assertTrue(buffer.toggle(self.u1, self.msg))
+        self.assertTrue(buffer.toggle(self.u2, self.msg))
+        self.assertTrue(buffer.toggle(self.u2, -1))
+
+        user1 = User.query.get(self.u1)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(buffer.liked_message_ids(user1, [self.msg]),
+                         {self.msg})
+
+        buffer.flush()
+
+        self.assertEqual(Likes.query.count(), 2)
+        self.assertEqual(User.query.get(self.u1).likes_count, 1)
+        self.assertEqual(buffer.flushes, 1)
+
+        self.assertFalse(buffer.toggle(self.u1, self.msg))
+        buffer.flush()
+
+        self.assertEqual([like.user_id for like in Likes.query], [self.u2])
+        self.assertEqual(User.query.get(self.u1).likes_count, 0)
+
+    def test_buffer_max_pending(self):
+        '''Test the buffer flushes early once full'''
+
+        buffer = LikeBuffer(app, interval=60, max_pending=2)
+
+        buffer.toggle(self.u1, self.msg)
+        self.assertEqual(buffer.flushes, 0)
+        buffer.toggle(self.u2, self.msg)
+
+        # The flush runs on the timer thread, straight away.
+        buffer._timer.join(5)
+        self.assertEqual(buffer.flushes, 1)
+        self.assertEqual(Likes.query.count(), 2)
+
+    def test_buffer_failure(self):
+        '''Test a failed flush is logged and kept, not raised'''
+
+        buffer = LikeBuffer(app, interval=60)
+        buffer.toggle(self.u1, self.msg)
+
+        def fail(changes):
+            raise RuntimeError("database down")
+
+        apply, Likes.apply = Likes.__dict__['apply'], fail
+        try:
+            with self.assertLogs(app.logger, 'ERROR'):
+                buffer.flush()
+        finally:
+            Likes.apply = apply
+
+        self.assertEqual(buffer.flushes, 0)
+        buffer.flush()
+        self.assertEqual(Likes.query.count(), 1)
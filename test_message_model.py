@@ -6,6 +6,7 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
 from models import db, User, Message, Follows
@@ -21,6 +22,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+import read_models
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -76,4 +78,29 @@ class MessageModelTestCase(TestCase):
 
         self.assertIsInstance(m, Message)
 
-        
\ No newline at end of file
+        
+    def test_timeline(self):
+        '''Test timeline is newest-first and pages with a cursor'''
+
+        u = User.query.filter_by(username='testuser').first()
+        author = User(
+            email="author@test.com",
+            username="author",
+            password="HASHED_PASSWORD"
+        )
+        db.session.add(author)
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=author.id, user_following_id=u.id))
+        for day in range(1, 4):
+            db.session.add(Message(text=f'day {day}',
+                                   timestamp=datetime(2020, 1, day),
+                                   user_id=author.id))
+        db.session.add(Message(text='not followed', user_id=u.id))
+        db.session.commit()
+
+        page = read_models.timeline(u.id, limit=2)
+        self.assertEqual([m.text for m in page], ['day 3', 'day 2'])
+
+        older = read_models.timeline(u.id, before=page[-1].cursor, limit=2)
+        self.assertEqual([m.text for m in older], ['day 1'])
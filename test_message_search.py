@@ -0,0 +1,187 @@
+"""Message search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_message_search.py
+
+
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from message_search import (DiskMessageSearch, PostgresMessageSearch,
+                            tokenize)
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class DiskMessageSearchTestCase(TestCase):
+    """Test the on-disk inverted index."""
+
+    def setUp(self):
+        """Create a user with a few messages and an empty index."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+
+        self.messages = [Message(text=text, user_id=u.id)
+                         for text in ['Birds sing', 'Birds birds birds!',
+                                      'A quiet morning', 'Morning birds sing']]
+        db.session.add_all(self.messages)
+        db.session.commit()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index = DiskMessageSearch(os.path.join(self.tmp.name, 'index'))
+        self.index.rebuild()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_tokenize(self):
+        '''Test text is split into lowercase words'''
+
+        self.assertEqual(tokenize("Hello, World! it's"), ['hello', 'world', 'it', 's'])
+
+    def test_search(self):
+        '''Test results match every word, are ranked, and page with a cursor'''
+
+        found, cursor = self.index.search('birds')
+        self.assertEqual(found[0].text, 'Birds birds birds!')
+        self.assertEqual(len(found), 3)
+        self.assertIsNone(cursor)
+
+        found, _ = self.index.search('birds sing')
+        self.assertEqual(sorted(m.text for m in found), ['Birds sing', 'Morning birds sing'])
+
+        first, cursor = self.index.search('birds', limit=2)
+        rest, _ = self.index.search('birds', after=cursor, limit=2)
+        self.assertEqual(len(rest), 1)
+        self.assertNotIn(rest[0], first)
+
+    def test_equal_scores(self):
+        '''Test paging through results with the same score'''
+
+        assert_pages_through_ties(self, self.index, self.messages[0].user_id)
+
+    def test_not_built(self):
+        '''Test an index that was never built finds nothing'''
+
+        index = DiskMessageSearch(os.path.join(self.tmp.name, 'other'))
+        self.assertEqual(index.search('birds'), ([], None))
+
+    def test_incremental(self):
+        '''Test added and deleted messages update the index'''
+
+        msg = Message(text='Owls at night', user_id=self.messages[0].user_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.index.added(msg)
+
+        self.assertEqual([m.text for m in self.index.search('owls')[0]], ['Owls at night'])
+
+        self.index.deleted(msg.id, msg.text)
+        self.assertEqual(self.index.search('owls')[0], [])
+
+    def test_shared(self):
+        '''Test changes logged by one process are seen by another'''
+
+        other = DiskMessageSearch(self.index.path)
+        self.assertEqual(len(other.search('birds')[0]), 3)
+
+        msg = Message(text='More birds', user_id=self.messages[0].user_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.index.added(msg)
+        self.index.deleted(self.messages[1].id, self.messages[1].text)
+
+        self.assertEqual(sorted(m.text for m in other.search('birds')[0]),
+                         ['Birds sing', 'More birds', 'Morning birds sing'])
+        self.assertEqual(other._count, 4)
+
+        # Never indexed, so the count stays.
+        other.deleted(msg.id + 1, 'Birds')
+        other.search('birds')
+        self.assertEqual(other._count, 4)
+
+    def test_merge(self):
+        '''Test logged changes are folded into the dbm file'''
+
+        msg = Message(text='Owls and birds', user_id=self.messages[0].user_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.index.added(msg)
+        self.index.deleted(self.messages[0].id, self.messages[0].text)
+        self.index.deleted(msg.id + 1, 'Owls')
+        before = self.index.search('birds')[0]
+
+        self.index.merge()
+
+        self.assertEqual(os.path.getsize(self.index.log_path), 0)
+        self.assertEqual(self.index.search('birds')[0], before)
+        self.assertEqual([m.text for m in self.index.search('owls')[0]],
+                         ['Owls and birds'])
+        self.assertEqual(self.index._count, 4)
+        self.assertEqual(self.index._added, {})
+
+
+@skipUnless(db.engine.dialect.name == 'postgresql', "needs PostgreSQL")
+class PostgresMessageSearchTestCase(TestCase):
+    """Test PostgreSQL full-text search."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+        self.user_id = u.id
+
+    def test_equal_scores(self):
+        '''Test paging through results with the same ts_rank'''
+
+        assert_pages_through_ties(self, PostgresMessageSearch(), self.user_id)
+
+
+def assert_pages_through_ties(test, search, user_id):
+    """Page two at a time through five equally ranked messages."""
+
+    messages = [Message(text='Owls', user_id=user_id) for _ in range(5)]
+    db.session.add_all(messages)
+    db.session.commit()
+    for msg in messages:
+        search.added(msg)
+
+    seen, cursor = [], None
+    for _ in range(len(messages)):
+        page, cursor = search.search('owls', after=cursor, limit=2)
+        seen.extend(msg.id for msg in page)
+        if cursor is None:
+            break
+
+    test.assertEqual(seen, sorted((msg.id for msg in messages), reverse=True))
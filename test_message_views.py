@@ -20,7 +20,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, message_search
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -128,3 +128,22 @@ class MessageViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, 'http://localhost/')
+
+    def test_search_messages(self):
+        '''Does message search find messages by their words?'''
+
+        # As `flask reindex-messages` does for the disk backend.
+        if hasattr(message_search.backend, 'rebuild'):
+            message_search.backend.rebuild()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hello warblers"})
+
+            resp = c.get('/messages/search?q=warblers')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Hello warblers', html)
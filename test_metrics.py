@@ -0,0 +1,120 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import create_engine
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from metrics import Metrics, Histogram, cache_samples
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class FakeCache:
+    hits = 3
+    misses = 1
+
+
+class MetricsTestCase(TestCase):
+    """Test request, pool and collected metrics."""
+
+    def setUp(self):
+        """Make a small app with one good and one failing route."""
+
+        self.engine = create_engine('sqlite://')
+        self.app = Flask(__name__)
+        self.metrics = Metrics(buckets=(0.1, 1))
+        self.metrics.init_app(self.app, self.engine)
+        self.metrics.add_collector(
+            lambda: cache_samples({'fake': FakeCache()}))
+
+        @self.app.route('/ok')
+        def ok():
+            self.engine.execute("SELECT 1")
+            return 'ok'
+
+        @self.app.route('/fail')
+        def fail():
+            raise RuntimeError("broken")
+
+    def test_histogram(self):
+        '''Test buckets are cumulative and end in +Inf'''
+
+        histogram = Histogram(buckets=(1, 2))
+        for value in (0.5, 1.5, 1.5, 3):
+            histogram.observe(value)
+
+        samples = list(histogram.samples('x', {}))
+        self.assertEqual([value for _, _, value in samples],
+                         [1, 3, 4, 6.5, 4])
+        self.assertEqual(samples[2][1], {'le': '+Inf'})
+
+    def test_requests_and_pool(self):
+        '''Test requests are counted by endpoint and status'''
+
+        client = self.app.test_client()
+        client.get('/ok')
+        client.get('/ok')
+        client.get('/fail')
+
+        text = self.metrics.render()
+
+        self.assertIn('warbler_requests_total{endpoint="ok",method="GET",'
+                      'status="200"} 2', text)
+        self.assertIn('warbler_requests_total{endpoint="fail",method="GET",'
+                      'status="500"} 1', text)
+        self.assertIn('warbler_request_duration_seconds_count'
+                      '{endpoint="ok"} 2', text)
+        self.assertIn('# TYPE warbler_request_duration_seconds histogram', text)
+        self.assertIn('warbler_db_connection_hold_seconds_count 2', text)
+        self.assertIn('warbler_db_connections_in_use 0', text)
+        self.assertIn('warbler_cache_hit_ratio{cache="fake"} 0.75', text)
+
+    def test_metrics_endpoint(self):
+        '''Test the app serves its metrics'''
+
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        app.config['METRICS_TOKEN'] = 'scrape-me'
+        client = app.test_client()
+        client.get('/users')
+
+        self.assertEqual(client.get('/metrics').status_code, 403)
+        self.assertEqual(client.get('/metrics', headers={
+            'Authorization': 'Bearer wrong'}).status_code, 403)
+
+        resp = client.get('/metrics', headers={
+            'Authorization': 'Bearer scrape-me'})
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn('endpoint="list_users"', text)
+        self.assertIn('warbler_cache_hits_total{cache="identity"}', text)
+        self.assertIn('warbler_bcrypt_queue_depth 0', text)
+        self.assertIn('warbler_sql_statements_total', text)
@@ -0,0 +1,59 @@
+"""Password hasher tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+from threading import Event, Thread
+from unittest import TestCase
+
+from passwords import PasswordHasher, PasswordHasherBusy
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing on the bounded executor."""
+
+    def test_hash_and_check(self):
+        '''Test hashes use the configured cost and check correctly'''
+
+        hasher = PasswordHasher(rounds=4)
+        hashed = hasher.hash('secret')
+
+        self.assertTrue(hashed.startswith('$2b$04$'))
+        self.assertTrue(hasher.check(hashed, 'secret'))
+        self.assertFalse(hasher.check(hashed, 'wrong'))
+        self.assertFalse(hasher.needs_rehash(hashed))
+        self.assertEqual(hasher.stats()['completed'], 3)
+
+    def test_long_password(self):
+        '''Test passwords over bcrypt's 72 bytes hash and check'''
+
+        hasher = PasswordHasher(rounds=4)
+        password = 'é' * 40
+        hashed = hasher.hash(password)
+
+        self.assertTrue(hasher.check(hashed, password))
+        self.assertFalse(hasher.check(hashed, 'e' * 80))
+
+    def test_queue_limit(self):
+        '''Test jobs beyond the queue limit are refused'''
+
+        hasher = PasswordHasher(rounds=4, max_workers=1, max_queue=0)
+        started, release = Event(), Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        worker = Thread(target=hasher._run, args=(block,))
+        worker.start()
+        started.wait()
+
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash('secret')
+        self.assertEqual(hasher.stats()['rejected'], 1)
+
+        release.set()
+        worker.join()
+        self.assertEqual(hasher.stats()['pending'], 0)
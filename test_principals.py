@@ -0,0 +1,76 @@
+"""Session principal cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_principals.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from principals import PrincipalCache
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class PrincipalCacheTestCase(TestCase):
+    """Test caching of logged-in user details."""
+
+    def setUp(self):
+        """Create a user."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+
+        self.uid = u.id
+
+    def test_get(self):
+        '''Test principals are cached until invalidated'''
+
+        cache = PrincipalCache()
+
+        principal = cache.get(self.uid)
+        self.assertEqual(principal.username, "testuser")
+        self.assertIs(cache.get(self.uid), principal)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        User.query.get(self.uid).username = "renamed"
+        db.session.commit()
+        self.assertEqual(cache.get(self.uid).username, "testuser")
+
+        cache.invalidate(self.uid)
+        self.assertEqual(cache.get(self.uid).username, "renamed")
+        self.assertIsNone(cache.get(-1))
+
+    def test_expiry(self):
+        '''Test entries expire after the TTL and the LRU is bounded'''
+
+        cache = PrincipalCache(ttl=0, max_size=1)
+
+        first = cache.get(self.uid)
+        self.assertIsNot(cache.get(self.uid), first)
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(len(cache._entries), 1)
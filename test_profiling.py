@@ -0,0 +1,109 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiling.py
+
+
+import os
+import pstats
+import sys
+from tempfile import TemporaryDirectory
+from time import sleep
+from unittest import TestCase
+
+from flask import Flask, g
+
+from profiling import RequestProfiler, collapse
+
+
+class RequestProfilerTestCase(TestCase):
+    """Test picking requests to profile and the files written."""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_app(self, **config):
+        """App with a slow view, profiled per `config`."""
+
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'test'
+        app.config['PROFILE_DIR'] = self.directory.name
+        app.config['PROFILE_INTERVAL'] = 0.001
+        app.config.update(config)
+
+        profiler = RequestProfiler()
+        profiler.init_app(app)
+
+        @app.before_request
+        def add_user_to_g():
+            g.user = None
+
+        @app.route('/slow')
+        def slow():
+            sleep(0.05)
+            return 'done'
+
+        return app, profiler
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory.name))
+
+    def test_token(self):
+        '''Test a signed header profiles the request into a collapsed-stack file'''
+
+        app, profiler = self.make_app()
+        client = app.test_client()
+
+        resp = client.get('/slow', headers={'X-Warbler-Profile': 'forged'})
+        self.assertNotIn('X-Warbler-Profile-File', resp.headers)
+        self.assertEqual(self.profiles(), [])
+
+        resp = client.get('/slow',
+                          headers={'X-Warbler-Profile': profiler.make_token()})
+        name = resp.headers['X-Warbler-Profile-File']
+
+        self.assertEqual(self.profiles(), [name])
+        self.assertTrue(name.endswith('-slow-anon.folded'))
+        with open(os.path.join(self.directory.name, name)) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(any('test_profiling.slow:' in line for line in lines))
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+
+    def test_sampling(self):
+        '''Test random profiling only picks the listed endpoints'''
+
+        app, profiler = self.make_app(PROFILE_SAMPLE_RATE=1.0,
+                                      PROFILE_ENDPOINTS={'other'})
+        app.test_client().get('/slow')
+        self.assertEqual(self.profiles(), [])
+
+        profiler.endpoints = {'slow'}
+        resp = app.test_client().get('/slow')
+        self.assertNotIn('X-Warbler-Profile-File', resp.headers)
+        self.assertEqual(len(self.profiles()), 1)
+
+    def test_cprofile(self):
+        '''Test cProfile mode writes stats pstats can read'''
+
+        app, profiler = self.make_app(PROFILE_MODE='cprofile',
+                                      PROFILE_SAMPLE_RATE=1.0)
+        app.test_client().get('/slow')
+
+        name, = self.profiles()
+        self.assertTrue(name.endswith('.prof'))
+        stats = pstats.Stats(os.path.join(self.directory.name, name))
+        self.assertTrue(any(func[2] == 'slow' for func in stats.stats))
+
+    def test_collapse(self):
+        '''Test stacks run outermost to innermost'''
+
+        def inner():
+            return collapse(sys._getframe())
+
+        stack = inner().split(';')
+        self.assertEqual(stack[-1].rsplit(':', 1)[0], 'test_profiling.inner')
+        self.assertTrue(stack[-2].startswith('test_profiling.test_collapse:'))
@@ -0,0 +1,107 @@
+"""Read model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_read_models.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import read_models
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class ReadModelsTestCase(TestCase):
+    """Test message rows for list pages."""
+
+    def setUp(self):
+        """Create a reader following an author with three messages."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        reader = User(email="test@test.com", username="reader",
+                      password="HASHED_PASSWORD")
+        author = User(email="test2@test.com", username="author",
+                      password="HASHED_PASSWORD", image_url="/author.png")
+        db.session.add_all([reader, author])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=author.id,
+                               user_following_id=reader.id))
+        msgs = [Message(text=f'day {day}', timestamp=datetime(2020, 1, day),
+                        user_id=author.id)
+                for day in range(1, 4)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        self.reader, self.author = reader.id, author.id
+        self.msg_ids = [msg.id for msg in msgs]
+
+    def test_timeline(self):
+        '''Test timeline rows carry shared author fields and page with a cursor'''
+
+        page = read_models.timeline(self.reader, limit=2)
+
+        self.assertEqual([msg.text for msg in page], ['day 3', 'day 2'])
+        self.assertEqual(page[0].user.username, 'author')
+        self.assertEqual(page[0].user.image_url, '/author.png')
+        self.assertEqual(page[0].user_id, self.author)
+        self.assertIs(page[0].user, page[1].user)
+
+        older = read_models.timeline(self.reader, before=page[-1].cursor)
+        self.assertEqual([msg.text for msg in older], ['day 1'])
+
+    def test_messages_by_id(self):
+        '''Test rows come back in the order asked for, skipping missing ids'''
+
+        ids = [self.msg_ids[1], -1, self.msg_ids[0]]
+        self.assertEqual([msg.id for msg in read_models.messages_by_id(ids)],
+                         [self.msg_ids[1], self.msg_ids[0]])
+        self.assertEqual(read_models.messages_by_id([]), [])
+
+    def test_user_and_liked_messages(self):
+        '''Test profile and likes page rows'''
+
+        self.assertEqual([msg.text for msg in read_models.user_messages(self.author)],
+                         ['day 3', 'day 2', 'day 1'])
+        self.assertEqual(read_models.user_messages(self.reader), [])
+
+        db.session.add_all([Likes(user_id=self.reader, message_id=self.msg_ids[2]),
+                            Likes(user_id=self.reader, message_id=self.msg_ids[0])])
+        db.session.commit()
+
+        likes, next_cursor = read_models.liked_messages(self.reader)
+        self.assertEqual([msg.text for msg in likes], ['day 3', 'day 1'])
+        self.assertIsNone(next_cursor)
+
+        likes, next_cursor = read_models.liked_messages(self.reader, limit=1)
+        self.assertEqual([msg.text for msg in likes], ['day 3'])
+
+        likes, next_cursor = read_models.liked_messages(self.reader,
+                                                        after=next_cursor,
+                                                        limit=1)
+        self.assertEqual([msg.text for msg in likes], ['day 1'])
+        self.assertIsNone(next_cursor)
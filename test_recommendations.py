@@ -0,0 +1,108 @@
+"""Recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+from scipy import sparse
+
+from models import db, User, Message, Follows, Recommendation
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from recommendations import compute_recommendations, keep_top, load_follow_matrix
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class RecommendationTestCase(TestCase):
+    """Test "who to follow" recommendations."""
+
+    def setUp(self):
+        """Create a small follows graph: a -> b -> c, d -> b, d -> e."""
+
+        Recommendation.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = {}
+        for name in 'abcde':
+            users[name] = User(email=f"{name}@test.com", username=name,
+                               password="HASHED_PASSWORD")
+        db.session.add_all(users.values())
+        db.session.commit()
+
+        for follower, followed in ['ab', 'bc', 'db', 'de']:
+            db.session.add(Follows(user_following_id=users[follower].id,
+                                   user_being_followed_id=users[followed].id))
+        db.session.commit()
+
+        self.ids = {name: user.id for name, user in users.items()}
+
+    def test_compute_recommendations(self):
+        '''Test friends of friends and co-followed accounts are suggested'''
+
+        compute_recommendations()
+
+        suggested = [u.username for u in Recommendation.for_user(self.ids['a'])]
+
+        # c via b; e because d, who also follows b, follows e
+        self.assertEqual(sorted(suggested), ['c', 'e'])
+        self.assertNotIn('b', suggested)
+
+        db.session.add(Follows(user_following_id=self.ids['a'],
+                               user_being_followed_id=self.ids['c']))
+        db.session.commit()
+
+        suggested = [u.username for u in Recommendation.for_user(self.ids['a'])]
+        self.assertEqual(suggested, ['e'])
+
+    def test_max_co_followers(self):
+        '''Test co-followed accounts are only found through the closest
+        co-followers'''
+
+        compute_recommendations(max_co_followers=0)
+
+        suggested = [u.username for u in Recommendation.for_user(self.ids['a'])]
+        self.assertEqual(suggested, ['c'])
+
+    def test_load_follow_matrix(self):
+        '''Test the follow matrix is the same however it is chunked'''
+
+        expected = {(self.ids[follower], self.ids[followed])
+                    for follower, followed in ['ab', 'bc', 'db', 'de']}
+
+        for chunk_size in (1, 3, 100):
+            follows = load_follow_matrix(chunk_size).tocoo()
+            self.assertEqual(set(zip(follows.row.tolist(), follows.col.tolist())),
+                             expected)
+            self.assertEqual(follows.data.tolist(), [1.0] * 4)
+            self.assertEqual(follows.shape[0], follows.shape[1])
+
+    def test_keep_top(self):
+        '''Test only the largest entries in each row are kept'''
+
+        matrix = sparse.csr_matrix([[1, 5, 0, 3], [0, 0, 0, 0], [2, 0, 4, 0]])
+
+        self.assertEqual(keep_top(matrix, 2).toarray().tolist(),
+                         [[0, 5, 0, 3], [0, 0, 0, 0], [2, 0, 4, 0]])
+        self.assertEqual(keep_top(matrix, 3).toarray().tolist(),
+                         matrix.toarray().tolist())
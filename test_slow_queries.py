@@ -0,0 +1,133 @@
+"""Slow query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slow_queries.py
+
+
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import create_engine
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from slow_queries import SlowQueryLog, parameter_shapes
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test recording slow statements and their plans."""
+
+    def setUp(self):
+        """Log every statement on a scratch SQLite database."""
+
+        self.directory = TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'logs', 'slow.log')
+
+        flask_app = Flask(__name__)
+        flask_app.config['SLOW_QUERY_MS'] = 1e-9
+        flask_app.config['SLOW_QUERY_LOG'] = self.path
+
+        self.engine = create_engine('sqlite://')
+        self.engine.execute("CREATE TABLE items (id INTEGER, owner INTEGER)")
+        self.log = SlowQueryLog(keep=2)
+        self.log.init_app(flask_app, self.engine)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_record_with_plan(self):
+        '''Test slow statements are logged with parameter shapes and a plan'''
+
+        self.engine.execute("SELECT * FROM items WHERE owner = ?", 5)
+
+        entry = self.log.recent[0]
+        self.assertEqual(entry['statement'],
+                         "SELECT * FROM items WHERE owner = ?")
+        self.assertEqual(entry['parameters'], ['int'])
+        self.assertIn('SCAN', entry['plan'])
+        self.assertFalse(entry['analyzed'])
+        self.assertIsNone(entry['route'])
+
+        with open(self.path) as f:
+            logged = [json.loads(line) for line in f]
+        self.assertEqual(logged[-1], entry)
+
+    def test_executemany_not_explained(self):
+        '''Test batched statements are logged without a plan'''
+
+        self.engine.execute("INSERT INTO items VALUES (?, ?)", [(1, 2), (3, 4)])
+
+        entry = self.log.recent[0]
+        self.assertIsNone(entry['plan'])
+        self.assertEqual(entry['parameters'],
+                         {'rows': 2, 'first': ['int', 'int']})
+
+    def test_keeps_most_recent(self):
+        '''Test only the latest entries are kept in memory'''
+
+        for i in range(3):
+            self.engine.execute(f"SELECT {i}")
+
+        self.assertEqual([entry['statement'] for entry in self.log.recent],
+                         ['SELECT 2', 'SELECT 1'])
+        self.assertEqual(self.log.count, 3)
+
+    def test_parameter_shapes(self):
+        '''Test values are replaced by their types and list lengths'''
+
+        self.assertEqual(
+            parameter_shapes({'id': 1, 'ids': (1, 2, 3), 'bio': None}),
+            {'id': 'int', 'ids': 'tuple[3]', 'bio': 'null'})
+
+
+class SlowQueryViewTestCase(TestCase):
+    """Test the admin page."""
+
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+
+        user = User(email="test@test.com", username="testuser",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def test_admins_only(self):
+        '''Test only listed admins see slow queries'''
+
+        resp = self.client.get('/admin/slow-queries')
+        self.assertEqual(resp.status_code, 302)
+
+        app.config['ADMIN_USERNAMES'] = {'testuser'}
+        try:
+            resp = self.client.get('/admin/slow-queries')
+        finally:
+            app.config['ADMIN_USERNAMES'] = set()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Slow queries', resp.get_data(as_text=True))
@@ -0,0 +1,89 @@
+"""SQL statistics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sql_stats.py
+
+
+import os
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import create_engine
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, sql_stats
+from sql_stats import SQLStats
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class SQLStatsTestCase(TestCase):
+    """Test per-request statement counts and N+1 flagging."""
+
+    def setUp(self):
+        """Make a small app that runs one statement per item."""
+
+        engine = create_engine('sqlite://')
+        self.app = Flask(__name__)
+        self.stats = SQLStats(repeat_threshold=3, headers=True)
+        self.stats.init_app(self.app, engine)
+
+        @self.app.route('/items/<int:count>')
+        def items(count):
+            engine.execute("SELECT 1")
+            for i in range(count):
+                engine.execute("SELECT ?", (i,))
+            return 'ok'
+
+    def test_counts(self):
+        '''Test statements are counted per request'''
+
+        resp = self.app.test_client().get('/items/2')
+
+        self.assertEqual(resp.headers['X-SQL-Statements'], '3')
+        self.assertEqual(resp.headers['X-SQL-Repeated'], '0')
+        self.assertGreaterEqual(float(resp.headers['X-SQL-Time-Ms']), 0)
+
+    def test_repeated_statements_flagged(self):
+        '''Test a statement run in a loop is logged as an N+1 query'''
+
+        with self.assertLogs('warbler.sql', 'WARNING') as logs:
+            resp = self.app.test_client().get('/items/5')
+
+        self.assertEqual(resp.headers['X-SQL-Repeated'], '1')
+        self.assertIn('"count": 5', logs.output[0])
+        self.assertIn('SELECT ?', logs.output[0])
+        self.assertEqual((self.stats.requests, self.stats.flagged), (1, 1))
+
+    def test_app_pages(self):
+        '''Test the app's pages carry the headers when turned on'''
+
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        headers, sql_stats.headers = sql_stats.headers, True
+        try:
+            resp = app.test_client().get('/users')
+        finally:
+            sql_stats.headers = headers
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['X-SQL-Repeated'], '0')
+        self.assertGreater(int(resp.headers['X-SQL-Statements']), 0)
@@ -0,0 +1,326 @@
+"""Timeline strategy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timelines.py
+
+
+import os
+from datetime import datetime
+from time import sleep
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from follow_graph import FollowGraph
+from timelines import (AuthorRing, FanoutTimeline, MemoryTimelineStore,
+                       RingBufferTimeline, newest_first)
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class MemoryTimelineStoreTestCase(TestCase):
+    """Test the in-process timeline store."""
+
+    def test_bounded_length(self):
+        '''Test store keeps only the newest entries and pages through them'''
+
+        store = MemoryTimelineStore(max_length=3)
+        store.load(1, [])
+        for day in range(1, 6):
+            store.push([1, 2], (datetime(2020, 1, day), day, 9))
+
+        self.assertEqual([e[1] for e in store.get(1, limit=2)], [5, 4])
+        self.assertEqual([e[1] for e in store.get(1, (datetime(2020, 1, 4), 4), 1)], [3])
+        # the rest was trimmed away, so the store can't answer
+        self.assertIsNone(store.get(1, (datetime(2020, 1, 3), 3), 1))
+        # user 2 was never loaded, so nothing was pushed
+        self.assertIsNone(store.get(2))
+
+    def test_max_users(self):
+        '''Test least recently used timelines are evicted'''
+
+        store = MemoryTimelineStore(max_users=2)
+        store.load(1, [])
+        store.load(2, [])
+        store.get(1)
+        store.load(3, [])
+
+        self.assertIn(1, store)
+        self.assertNotIn(2, store)
+        self.assertIn(3, store)
+
+    def test_max_age(self):
+        '''Test timelines older than max_age count as not loaded'''
+
+        store = MemoryTimelineStore(max_age=0.01)
+        store.load(1, [])
+        self.assertEqual(store.get(1), [])
+
+        sleep(0.02)
+        self.assertNotIn(1, store)
+        self.assertIsNone(store.get(1))
+
+
+class AuthorRingTestCase(TestCase):
+    """Test the per-author ring buffer."""
+
+    def test_wraps_around(self):
+        '''Test ring keeps the newest keys and iterates newest first'''
+
+        ring = AuthorRing()
+        for key in [(1, 1), (2, 2), (4, 4), (5, 5), (3, 3)]:
+            ring.append(key, 3)
+
+        self.assertTrue(ring.truncated)
+        self.assertEqual(ring.keys(), [(3, 3), (4, 4), (5, 5)])
+        self.assertEqual(list(newest_first(ring.snapshot(), (5, 5))), [(4, 4), (3, 3)])
+
+        ring.remove(4, 3)
+        self.assertEqual(list(newest_first(ring.snapshot())), [(5, 5), (3, 3)])
+
+
+class TimelineTestCase(TestCase):
+    """Shared setup for timeline strategy tests."""
+
+    def setUp(self):
+        """Create a reader who follows an author."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.reader = User(email="reader@test.com", username="reader",
+                           password="HASHED_PASSWORD")
+        self.author = User(email="author@test.com", username="author",
+                           password="HASHED_PASSWORD")
+        db.session.add_all([self.reader, self.author])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.author.id,
+                               user_following_id=self.reader.id))
+        db.session.commit()
+
+    def post(self, timeline, text, day):
+        msg = Message(text=text, timestamp=datetime(2020, 1, day),
+                      user_id=self.author.id)
+        db.session.add(msg)
+        db.session.commit()
+        timeline.message_added(msg)
+        return msg
+
+
+class FanoutTimelineTestCase(TimelineTestCase):
+    """Test fan-out-on-write timelines."""
+
+    def test_fanout(self):
+        '''Test messages are pushed to followers and removed again'''
+
+        timeline = FanoutTimeline()
+        self.post(timeline, 'old', 1)
+
+        # first read builds the timeline from the database
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]], ['old'])
+
+        new = self.post(timeline, 'new', 2)
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]], ['new', 'old'])
+
+        db.session.delete(new)
+        db.session.commit()
+        timeline.message_deleted(new.id, self.author.id)
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]], ['old'])
+
+        Follows.query.delete()
+        db.session.commit()
+        timeline.unfollowed(self.reader.id, self.author.id)
+        self.assertEqual(timeline.page(self.reader.id)[0], [])
+
+    def test_celebrity(self):
+        '''Test authors over the threshold are merged in at read time'''
+
+        timeline = FanoutTimeline(fanout_threshold=1)
+        timeline.page(self.reader.id)
+        self.post(timeline, 'famous', 1)
+
+        self.assertIn(self.author.id, timeline.celebrities)
+        self.assertEqual(timeline.store.get(self.reader.id), [])
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]], ['famous'])
+
+    def test_other_process(self):
+        '''Test messages posted elsewhere show up once the timeline is reloaded'''
+
+        timeline = FanoutTimeline(MemoryTimelineStore(max_age=0.01))
+        self.assertEqual(timeline.page(self.reader.id)[0], [])
+
+        # Written by another process: no message_added here.
+        db.session.add(Message(text='elsewhere', timestamp=datetime(2020, 1, 1),
+                               user_id=self.author.id))
+        db.session.commit()
+
+        sleep(0.02)
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]],
+                         ['elsewhere'])
+
+    def test_deleted_celebrity(self):
+        '''Test deleted messages loaded into a timeline are dropped at read time'''
+
+        timeline = FanoutTimeline(fanout_threshold=1)
+        self.post(timeline, 'old', 1)
+        famous = self.post(timeline, 'famous', 2)
+
+        # loaded from the database, celebrity messages included
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]],
+                         ['famous', 'old'])
+
+        msg_id = famous.id
+        db.session.delete(famous)
+        db.session.commit()
+        timeline.message_deleted(msg_id, self.author.id)
+
+        self.assertEqual([m.text for m in timeline.page(self.reader.id, limit=1)[0]],
+                         ['old'])
+        self.assertNotIn(msg_id,
+                         [entry[1] for entry in timeline.store.get(self.reader.id)])
+
+    def test_cursor_past_deleted(self):
+        '''Test a page short of deleted messages still has a next cursor'''
+
+        timeline = FanoutTimeline()
+        timeline.max_refills = 0
+        self.post(timeline, 'old', 1)
+        gone = self.post(timeline, 'gone', 2)
+        timeline.page(self.reader.id)
+
+        # Deleted by another process: no message_deleted here.
+        db.session.delete(gone)
+        db.session.commit()
+
+        messages, next_cursor = timeline.page(self.reader.id, limit=1)
+        messages, _ = timeline.page(self.reader.id, before=next_cursor)
+        self.assertEqual([m.text for m in messages], ['old'])
+
+
+class RingBufferTimelineTestCase(TimelineTestCase):
+    """Test the in-memory ring buffer timeline."""
+
+    def test_merge(self):
+        '''Test rings of followed authors are merged newest first'''
+
+        other = User(email="other@test.com", username="other",
+                     password="HASHED_PASSWORD")
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=other.id,
+                               user_following_id=self.reader.id))
+        db.session.add(Message(text='other', timestamp=datetime(2020, 1, 2),
+                               user_id=other.id))
+        db.session.commit()
+
+        timeline = RingBufferTimeline(ring_size=2)
+        self.post(timeline, 'first', 1)
+        self.post(timeline, 'third', 3)
+        timeline.warm()
+
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]],
+                         ['third', 'other', 'first'])
+
+        # warmed up already, so later messages go straight into the ring
+        self.post(timeline, 'fourth', 4)
+        page, next_cursor = timeline.page(self.reader.id, limit=2)
+        self.assertEqual([m.text for m in page], ['fourth', 'third'])
+
+        # 'first' has been pushed out of the ring, so this is read from SQL
+        older = timeline.page(self.reader.id, before=next_cursor)[0]
+        self.assertEqual([m.text for m in older], ['other', 'first'])
+
+    def test_load_missing_author(self):
+        '''Test authors evicted from memory are loaded on demand'''
+
+        timeline = RingBufferTimeline(max_authors=1)
+        self.post(timeline, 'hello', 1)
+        timeline.warm()
+        timeline.message_added(Message(text='x', timestamp=datetime(2020, 1, 1),
+                                       id=-1, user_id=self.reader.id))
+        self.assertNotIn(self.author.id, timeline._rings)
+
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]], ['hello'])
+
+    def test_other_process(self):
+        '''Test rings are reloaded once older than max_age'''
+
+        timeline = RingBufferTimeline(max_age=0.01)
+        self.post(timeline, 'here', 1)
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]],
+                         ['here'])
+
+        # Written by another process: no message_added here.
+        db.session.add(Message(text='elsewhere', timestamp=datetime(2020, 1, 2),
+                               user_id=self.author.id))
+        db.session.commit()
+
+        sleep(0.02)
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]],
+                         ['elsewhere', 'here'])
+
+    def test_warm(self):
+        '''Test warming keeps only the newest ring_size messages per author'''
+
+        timeline = RingBufferTimeline(ring_size=2)
+        for day in range(1, 4):
+            self.post(timeline, f'day {day}', day)
+        timeline.warm()
+
+        ring = timeline._rings[self.author.id]
+        self.assertEqual(len(ring), 2)
+        self.assertTrue(ring.truncated)
+
+    def test_warm_in_background(self):
+        '''Test warming runs in a background thread'''
+
+        timeline = RingBufferTimeline()
+        self.post(timeline, 'hello', 1)
+        author_id = self.author.id
+
+        with app.app_context():
+            timeline.start_warming()
+        timeline._warmer.join()
+
+        self.assertIn(author_id, timeline._rings)
+
+    def test_page_before_warming(self):
+        '''Test pages read before warming load rings on demand'''
+
+        timeline = RingBufferTimeline()
+        self.post(timeline, 'hello', 1)
+
+        page = timeline.page(self.reader.id)[0]
+
+        self.assertIsNone(timeline._warmed_at)
+        self.assertEqual([m.text for m in page], ['hello'])
+
+    def test_follow_graph(self):
+        '''Test followed ids are read from the follow graph when given'''
+
+        timeline = RingBufferTimeline(follow_graph=FollowGraph())
+        self.post(timeline, 'hello', 1)
+
+        self.assertEqual([m.text for m in timeline.page(self.reader.id)[0]],
+                         ['hello'])
+
+        timeline.follow_graph.remove(self.reader.id, self.author.id)
+        self.assertEqual(timeline.page(self.reader.id)[0], [])
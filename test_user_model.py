@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
+from passwords import bcrypt, password_hasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -35,6 +36,7 @@ class UserModelTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        Likes.query.delete()
         User.query.delete()
         Message.query.delete()
         Follows.query.delete()
@@ -157,3 +159,74 @@ class UserModelTestCase(TestCase):
         self.assertEqual(user1.authenticate(username='testuser', password='HASHED_PASSWORD'), user1)
         self.assertFalse(user1.authenticate(username='bob', password='HASHED_PASSWORD'), user1)
         self.assertFalse(user1.authenticate(username='testuser', password='wrong_password'), user1)
+
+    def test_liked_message_ids(self):
+        '''Test liked_message_ids only returns liked ids from those asked about'''
+
+        user1 = User(
+            email="test@test.com",
+            username="testuser",
+            password="HASHED_PASSWORD"
+        )
+        db.session.add(user1)
+        db.session.commit()
+
+        msgs = [Message(text=f'msg {i}', user_id=user1.id) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        db.session.add_all([Likes(user_id=user1.id, message_id=msgs[0].id),
+                            Likes(user_id=user1.id, message_id=msgs[2].id)])
+        db.session.commit()
+
+        self.assertEqual(user1.liked_message_ids([msgs[0].id, msgs[1].id]), {msgs[0].id})
+        self.assertEqual(user1.liked_message_ids([]), set())
+
+    def test_reconcile_counts(self):
+        '''Test counter columns are updated and recomputed from the base tables'''
+
+        user1 = User(
+            email="test@test.com",
+            username="testuser",
+            password="HASHED_PASSWORD"
+        )
+        user2 = User(
+            email="test2@test.com",
+            username="test2user",
+            password="HASHED_PASSWORD"
+        )
+        db.session.add_all([user1, user2])
+        db.session.commit()
+
+        User.update_counts([user1.id, user2.id], messages_count=5)
+        db.session.commit()
+        self.assertEqual(user1.messages_count, 5)
+
+        db.session.add(Message(text='hi', user_id=user2.id))
+        db.session.add(Follows(user_being_followed_id=user2.id, user_following_id=user1.id))
+        db.session.commit()
+
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual(user1.messages_count, 0)
+        self.assertEqual(user1.following_count, 1)
+        self.assertEqual(user2.messages_count, 1)
+        self.assertEqual(user2.followers_count, 1)
+
+    def test_authenticate_rehash(self):
+        '''Test a hash made at an old bcrypt cost is replaced on login'''
+
+        old_hash = bcrypt.generate_password_hash('HASHED_PASSWORD', 4).decode('UTF-8')
+        user1 = User(
+            email="test@test.com",
+            username="testuser",
+            password=old_hash
+        )
+        db.session.add(user1)
+        db.session.commit()
+
+        self.assertTrue(password_hasher.needs_rehash(old_hash))
+        self.assertEqual(User.authenticate('testuser', 'HASHED_PASSWORD'), user1)
+        self.assertNotEqual(user1.password, old_hash)
+        self.assertFalse(password_hasher.needs_rehash(user1.password))
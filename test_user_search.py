@@ -0,0 +1,129 @@
+"""User search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_search.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from user_search import (MemoryUserSearch, TrigramUserSearch, UserSearch,
+                         create_trigram_indexes, has_pg_trgm)
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class UserSearchTestCase(TestCase):
+    """Test username search."""
+
+    def setUp(self):
+        """Create users to search for."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        for username, bio in [('warbler', None),
+                              ('warblerfan', None),
+                              ('superwarbler', None),
+                              ('someone', 'I love warblers')]:
+            db.session.add(User(email=f"{username}@test.com", username=username,
+                                bio=bio, password="HASHED_PASSWORD"))
+        db.session.commit()
+
+    def test_ranking(self):
+        '''Test exact, prefix, substring and bio matches are ranked in order'''
+
+        found = UserSearch().search('Warbler')
+        self.assertEqual([u.username for u in found],
+                         ['warbler', 'warblerfan', 'superwarbler', 'someone'])
+
+        found = UserSearch().search('warbler', offset=1, limit=2)
+        self.assertEqual([u.username for u in found], ['warblerfan', 'superwarbler'])
+
+    def test_short_query(self):
+        '''Test both backends only match username prefixes for short queries'''
+
+        db.session.add(User(email="wa@test.com", username="wa",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        backends = [MemoryUserSearch()]
+        if has_pg_trgm():
+            backends.append(TrigramUserSearch())
+
+        for search in backends:
+            with self.subTest(backend=type(search).__name__):
+                self.assertEqual([u.username for u in search.search('WA')],
+                                 ['wa', 'warbler', 'warblerfan'])
+                self.assertEqual([u.username for u in search.search('so')],
+                                 ['someone'])
+                self.assertEqual(search.search('ve'), [])
+
+    def test_memory_index_updates(self):
+        '''Test the in-memory index follows user changes'''
+
+        search = MemoryUserSearch()
+        self.assertEqual([u.username for u in search.search('so')], ['someone'])
+
+        user = User.query.filter_by(username='someone').one()
+        user.username = 'anyone'
+        db.session.commit()
+        search.changed(user)
+
+        self.assertEqual(search.search('so'), [])
+        self.assertEqual([u.username for u in search.search('any')], ['anyone'])
+
+        search.removed(user.id)
+        self.assertEqual(search.search('any'), [])
+
+    def test_stale_memory_index(self):
+        '''Test a stale in-memory index is reloaded in the background,
+        searching the old one meanwhile'''
+
+        search = MemoryUserSearch(max_age=0)
+        self.assertEqual(search.search('newbie'), [])
+
+        db.session.add(User(email="newbie@test.com", username="newbie",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        with app.app_context():
+            with search._build_lock:
+                self.assertEqual(search.search('newbie'), [])
+                refresher = search._refresher
+                search.search('newbie')
+                self.assertIs(search._refresher, refresher)
+            refresher.join(5)
+
+        search.max_age = None
+        self.assertEqual([u.username for u in search.search('newbie')],
+                         ['newbie'])
+
+    def test_create_trigram_indexes(self):
+        '''Test the trigram indexes are only created where pg_trgm is'''
+
+        with db.engine.begin() as connection:
+            created = create_trigram_indexes(connection)
+
+        self.assertEqual(created, db.engine.dialect.name == 'postgresql'
+                         and isinstance(UserSearch().backend,
+                                        TrigramUserSearch))
@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -319,3 +319,62 @@ class MessageViewTestCase(TestCase):
             resp = c.get(f'/users/{testuser.id}/likes')
 
             self.assertEqual(resp.status_code, 200)
+
+    def test_follow_counts(self):
+        '''Test follow and stop following keep the cached counts up to date'''
+
+        testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        testuser2 = User.signup(username="testuser2",
+                                    email="test2@test.com",
+                                    password="testuser",
+                                    image_url=None)
+
+        db.session.commit()
+        user_id, user2_id = testuser.id, testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post(f'/users/follow/{user2_id}')
+
+            self.assertEqual(User.query.get(user_id).following_count, 1)
+            self.assertEqual(User.query.get(user2_id).followers_count, 1)
+
+            c.post(f'/users/stop-following/{user2_id}')
+
+            self.assertEqual(User.query.get(user_id).following_count, 0)
+            self.assertEqual(User.query.get(user2_id).followers_count, 0)
+
+    def test_delete_user_like_counts(self):
+        '''Test deleting a user takes likes of their messages off the likers' counts'''
+
+        author = User.signup(username="author", email="test@test.com",
+                             password="testuser", image_url=None)
+        liker = User.signup(username="liker", email="test2@test.com",
+                            password="testuser", image_url=None)
+        db.session.commit()
+        author_id, liker_id = author.id, liker.id
+
+        theirs = [Message(text=f"warble {i}", user_id=author_id)
+                  for i in range(2)]
+        other = Message(text="someone else's", user_id=liker_id)
+        db.session.add_all(theirs + [other])
+        db.session.commit()
+
+        for msg in theirs + [other]:
+            Likes.toggle(liker_id, msg.id)
+        db.session.commit()
+        self.assertEqual(User.query.get(liker_id).likes_count, 3)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post('/users/delete')
+
+        self.assertIsNone(User.query.get(author_id))
+        self.assertEqual(User.query.get(liker_id).likes_count, 1)
@@ -0,0 +1,713 @@
+"""Home timeline strategies for Warbler.
+
+`JoinTimeline` (the default) builds each page with one SQL JOIN when it
+is read. `FanoutTimeline` pushes new messages into per-follower timelines
+when they are written, so reading a page is a lookup in a timeline store.
+`RingBufferTimeline` keeps the newest messages of each author in memory
+and merges the authors a user follows when a page is read.
+
+The app picks one with the TIMELINE_MODE setting (see `make_timeline`)
+and calls its hooks from the views that change messages or follows.
+"""
+
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from heapq import merge
+from itertools import islice
+from threading import Lock, Thread
+from time import monotonic
+
+from flask import current_app
+
+from models import db, Follows, Message, TIMELINE_PAGE_SIZE
+import read_models
+
+
+class JoinTimeline:
+    """Build timelines at read time with one JOIN of follows and messages.
+
+    The write hooks do nothing here; other strategies override them.
+    """
+
+    def init_app(self, app):
+        """Called once with the app the timeline serves."""
+
+    def page(self, user_id, before=None, limit=TIMELINE_PAGE_SIZE):
+        """Messages for the home page of `user_id`, newest first, and the
+        cursor of the next page (None on the last one)."""
+
+        messages = read_models.timeline(user_id, before=before, limit=limit)
+        next_cursor = messages[-1].cursor if len(messages) == limit else None
+        return messages, next_cursor
+
+    def message_added(self, msg):
+        """Called once `msg` has been committed."""
+
+    def message_deleted(self, msg_id, author_id):
+        """Called once message `msg_id` by `author_id` has been deleted."""
+
+    def followed(self, user_id, followed_id):
+        """Called once `user_id` has started following `followed_id`."""
+
+    def unfollowed(self, user_id, followed_id):
+        """Called once `user_id` has stopped following `followed_id`."""
+
+
+class MemoryTimelineStore:
+    """In-process store of materialized timelines.
+
+    Each timeline is a sorted list of (timestamp, message_id, author_id)
+    entries holding at most `max_length` of the newest ones. At most
+    `max_users` timelines are kept; the least recently read are dropped
+    and rebuilt from the database on their next read. Timelines loaded
+    more than `max_age` seconds ago count as not loaded either, so
+    messages and follows from other processes show up eventually.
+
+    Another backend (e.g. a shared cache) only needs the same methods.
+    """
+
+    def __init__(self, max_length=800, max_users=100000, max_age=None):
+        self.max_length = max_length
+        self.max_users = max_users
+        self.max_age = max_age
+        self._timelines = OrderedDict()
+        self._loaded_at = {}
+        self._truncated = set()
+        self._lock = Lock()
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return self._fresh(user_id)
+
+    def load(self, user_id, entries):
+        """Replace the timeline of `user_id` with `entries`."""
+
+        entries = sorted(entries)
+
+        with self._lock:
+            self._timelines[user_id] = entries
+            self._timelines.move_to_end(user_id)
+            self._loaded_at[user_id] = monotonic()
+            self._truncated.discard(user_id)
+            self._trim(user_id, entries)
+
+            # A full load may have been cut short by the caller's LIMIT.
+            if len(entries) >= self.max_length:
+                self._truncated.add(user_id)
+
+            while len(self._timelines) > self.max_users:
+                evicted, _ = self._timelines.popitem(last=False)
+                self._loaded_at.pop(evicted, None)
+                self._truncated.discard(evicted)
+
+    def push(self, user_ids, entry):
+        """Add `entry` to the timelines of `user_ids` that are loaded."""
+
+        with self._lock:
+            for user_id in user_ids:
+                entries = self._timelines.get(user_id)
+                if entries is not None:
+                    insort(entries, entry)
+                    self._trim(user_id, entries)
+
+    def extend(self, user_id, new_entries):
+        """Merge `new_entries` into the timeline of `user_id`, if loaded."""
+
+        with self._lock:
+            entries = self._timelines.get(user_id)
+            if entries is not None:
+                entries.extend(new_entries)
+                entries.sort()
+                self._trim(user_id, entries)
+
+    def remove(self, user_ids, message_id):
+        """Drop `message_id` from the timelines of `user_ids`."""
+
+        with self._lock:
+            for user_id in user_ids:
+                entries = self._timelines.get(user_id)
+                if entries is not None:
+                    entries[:] = [e for e in entries if e[1] != message_id]
+
+    def remove_author(self, user_id, author_id):
+        """Drop every message by `author_id` from the timeline of `user_id`."""
+
+        with self._lock:
+            entries = self._timelines.get(user_id)
+            if entries is not None:
+                entries[:] = [e for e in entries if e[2] != author_id]
+
+    def get(self, user_id, position=None, limit=TIMELINE_PAGE_SIZE):
+        """Newest entries for `user_id` older than `position`, newest first.
+
+        `position` is a (timestamp, message_id) pair. Returns None when the
+        timeline isn't loaded (or is too old), or when the page runs past
+        the oldest entry of a timeline that has had older entries trimmed
+        away.
+        """
+
+        with self._lock:
+            if not self._fresh(user_id):
+                return None
+            entries = self._timelines[user_id]
+            self._timelines.move_to_end(user_id)
+
+            end = len(entries) if position is None else bisect_left(entries, position)
+            start = max(end - limit, 0)
+
+            if end - start < limit and user_id in self._truncated:
+                return None
+
+            return entries[start:end][::-1]
+
+    def _fresh(self, user_id):
+        """Is a timeline loaded, and young enough? (lock must be held)"""
+
+        loaded_at = self._loaded_at.get(user_id)
+        return loaded_at is not None and (
+            self.max_age is None or monotonic() - loaded_at <= self.max_age)
+
+    def _trim(self, user_id, entries):
+        """Keep only the newest `max_length` entries (lock must be held)."""
+
+        if len(entries) > self.max_length:
+            del entries[:-self.max_length]
+            self._truncated.add(user_id)
+
+
+class FanoutTimeline(JoinTimeline):
+    """Materialize timelines by fanning out each message on write.
+
+    Authors with at least `fanout_threshold` followers are not fanned out;
+    their messages are merged into each page when it is read instead. The
+    set of them is reloaded along with timelines, after the store's
+    `max_age`.
+    """
+
+    max_refills = 2
+
+    def __init__(self, store=None, fanout_threshold=10000):
+        self.store = store if store is not None else MemoryTimelineStore()
+        self.fanout_threshold = fanout_threshold
+        self._celebrities = None
+        self._celebrities_at = None
+
+    @property
+    def celebrities(self):
+        """Ids of authors whose messages are merged in at read time."""
+
+        max_age = self.store.max_age
+        if (self._celebrities is None
+                or (max_age is not None
+                    and monotonic() - self._celebrities_at > max_age)):
+            rows = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .group_by(Follows.user_being_followed_id)
+                    .having(db.func.count() >= self.fanout_threshold))
+            self._celebrities = {author_id for (author_id,) in rows}
+            self._celebrities_at = monotonic()
+
+        return self._celebrities
+
+    def page(self, user_id, before=None, limit=TIMELINE_PAGE_SIZE):
+        """Messages for the home page of `user_id`, newest first, and the
+        cursor of the next page.
+
+        Entries whose message is gone are dropped from the store and the
+        page is read again to fill their place, up to `max_refills`
+        times. The cursor comes from the entries, so a page that is still
+        short leads on all the same.
+        """
+
+        position = Message.parse_cursor(before)
+
+        if user_id not in self.store:
+            self._rebuild(user_id)
+
+        for _ in range(self.max_refills + 1):
+            entries = self.store.get(user_id, position, limit)
+            if entries is None:
+                # Older than anything kept in the store: ask the database.
+                return super().page(user_id, before=before, limit=limit)
+
+            if self.celebrities:
+                entries = self._merge_celebrities(user_id, entries, position,
+                                                  limit)
+
+            messages = read_models.messages_by_id([entry[1]
+                                                   for entry in entries])
+            if len(messages) == len(entries):
+                break
+
+            found = {msg.id for msg in messages}
+            for entry in entries:
+                if entry[1] not in found:
+                    self.store.remove([user_id], entry[1])
+
+        next_cursor = (Message.make_cursor(*entries[-1][:2])
+                       if len(entries) == limit else None)
+        return messages, next_cursor
+
+    def message_added(self, msg):
+        """Push `msg` into the timeline of every follower of its author."""
+
+        if msg.user_id in self.celebrities:
+            return
+
+        follower_ids = self._follower_ids(msg.user_id)
+        if len(follower_ids) >= self.fanout_threshold:
+            self.celebrities.add(msg.user_id)
+            return
+
+        self.store.push(follower_ids, (msg.timestamp, msg.id, msg.user_id))
+
+    def message_deleted(self, msg_id, author_id):
+        """Remove the message from its author's followers' timelines.
+
+        Messages by celebrities can still be in timelines loaded from the
+        database; `page` drops those when it reads them.
+        """
+
+        if author_id not in self.celebrities:
+            self.store.remove(self._follower_ids(author_id), msg_id)
+
+    def followed(self, user_id, followed_id):
+        """Backfill recent messages of `followed_id` into `user_id`'s timeline."""
+
+        if followed_id not in self.celebrities:
+            num_followers = (Follows
+                             .query
+                             .filter_by(user_being_followed_id=followed_id)
+                             .count())
+            if num_followers >= self.fanout_threshold:
+                self.celebrities.add(followed_id)
+
+        if followed_id in self.celebrities:
+            return
+
+        recent = (db.session
+                  .query(Message.timestamp, Message.id, Message.user_id)
+                  .filter(Message.user_id == followed_id)
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(self.store.max_length))
+        self.store.extend(user_id, [tuple(row) for row in recent])
+
+    def unfollowed(self, user_id, followed_id):
+        """Remove messages of `followed_id` from `user_id`'s timeline."""
+
+        self.store.remove_author(user_id, followed_id)
+
+    def _rebuild(self, user_id):
+        """Load the timeline of `user_id` from the database."""
+
+        rows = (Message
+                .timeline_query(user_id)
+                .with_entities(Message.timestamp, Message.id, Message.user_id)
+                .limit(self.store.max_length))
+        self.store.load(user_id, [tuple(row) for row in rows])
+
+    def _merge_celebrities(self, user_id, entries, position, limit):
+        """Merge messages of followed celebrities into a page of `entries`."""
+
+        rows = (Message
+                .timeline_query(user_id, position)
+                .filter(Message.user_id.in_(list(self.celebrities)))
+                .with_entities(Message.timestamp, Message.id, Message.user_id)
+                .limit(limit))
+
+        merged = {entry[1]: entry for entry in entries}
+        for row in rows:
+            merged[row[1]] = tuple(row)
+
+        return sorted(merged.values(), reverse=True)[:limit]
+
+    @staticmethod
+    def _follower_ids(author_id):
+        """Ids of everyone following `author_id`."""
+
+        rows = (db.session
+                .query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == author_id))
+        return [follower_id for (follower_id,) in rows]
+
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_key(timestamp, msg_id):
+    """Sort key for a message as a pair of ints: (microseconds, id)."""
+
+    return (timestamp - EPOCH) // MICROSECOND, msg_id
+
+
+def from_key(key):
+    """(timestamp, id) of a message's sort key."""
+
+    return EPOCH + key[0] * MICROSECOND, key[1]
+
+
+class AuthorRing:
+    """Ring buffer of the newest message keys of one author.
+
+    Keys (see `to_key`) are kept oldest first in two arrays of machine
+    ints, so an entry costs 16 bytes. `start` is the slot of the oldest
+    key once the buffer has wrapped around. `truncated` is set once older
+    keys have been dropped, so the buffer no longer holds every message.
+    `loaded_at` is when it was read from the database.
+    """
+
+    __slots__ = ('stamps', 'ids', 'start', 'truncated', 'loaded_at')
+
+    def __init__(self, loaded_at=None):
+        self.stamps = array('q')
+        self.ids = array('q')
+        self.start = 0
+        self.truncated = False
+        self.loaded_at = loaded_at if loaded_at is not None else monotonic()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def key(self, i):
+        """The i-th oldest key."""
+
+        slot = (self.start + i) % len(self.ids)
+        return self.stamps[slot], self.ids[slot]
+
+    def keys(self):
+        """All keys, oldest first."""
+
+        return [self.key(i) for i in range(len(self.ids))]
+
+    def append(self, key, capacity):
+        """Add `key`, dropping the oldest key if the ring is full."""
+
+        size = len(self.ids)
+
+        if size and key < self.key(size - 1):
+            # Out of order (rare): rebuild in sorted order instead.
+            self._reset(sorted(self.keys() + [key]), capacity)
+        elif size < capacity:
+            self.stamps.append(key[0])
+            self.ids.append(key[1])
+        else:
+            self.stamps[self.start], self.ids[self.start] = key
+            self.start = (self.start + 1) % size
+            self.truncated = True
+
+    def remove(self, msg_id, capacity):
+        """Drop the key for `msg_id`, if present."""
+
+        if msg_id in self.ids:
+            self._reset([key for key in self.keys() if key[1] != msg_id],
+                        capacity)
+
+    def snapshot(self):
+        """Copy of the buffer that can be read without holding a lock."""
+
+        return self.stamps[:], self.ids[:], self.start
+
+    def _reset(self, keys, capacity):
+        if len(keys) > capacity:
+            keys = keys[-capacity:]
+            self.truncated = True
+
+        self.stamps = array('q', [stamp for stamp, _ in keys])
+        self.ids = array('q', [msg_id for _, msg_id in keys])
+        self.start = 0
+
+
+def newest_first(snapshot, position=None):
+    """Iterate over the keys of a ring snapshot that sort before `position`.
+
+    Keys are yielded newest first.
+    """
+
+    stamps, ids, start = snapshot
+    size = len(ids)
+
+    def key(i):
+        slot = (start + i) % size
+        return stamps[slot], ids[slot]
+
+    lo, hi = 0, size
+    if position is not None:
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(mid) < position:
+                lo = mid + 1
+            else:
+                hi = mid
+    else:
+        lo = size
+
+    for i in range(lo - 1, -1, -1):
+        yield key(i)
+
+
+class RingBufferTimeline(JoinTimeline):
+    """Build timelines in memory from per-author ring buffers.
+
+    The newest `ring_size` messages of each author are kept in an
+    `AuthorRing`, updated as messages are added and deleted. A page is a
+    k-way heap merge of the rings of everyone the user follows.
+
+    At most `max_authors` rings are kept, least recently read are dropped
+    first, so memory stays below about 16 * ring_size * max_authors bytes.
+    The rings of every author are warmed (`warm`) in a background thread
+    when the app serves its first request, while pages read meanwhile
+    load the rings they need on demand. Rings older than `max_age`
+    seconds are reloaded when next read, so messages posted through
+    other processes show up eventually.
+
+    Followed ids come from `follow_graph` when one is given, and from
+    the follows table otherwise.
+    """
+
+    def __init__(self, ring_size=100, max_authors=100000, max_age=None,
+                 follow_graph=None):
+        self.ring_size = ring_size
+        self.max_authors = max_authors
+        self.max_age = max_age
+        self.follow_graph = follow_graph
+        self._rings = OrderedDict()
+        self._lock = Lock()
+        self._warmer = None
+        self._warmed_at = None
+
+        # True while every author with messages has a ring, i.e. none have
+        # been evicted: a missing ring then means the author has none.
+        self._complete = False
+
+    def warm(self):
+        """Load the newest `ring_size` messages of every author."""
+
+        started = monotonic()
+        loaded = self._read_rings(loaded_at=started)
+
+        with self._lock:
+            self._complete = True
+            for author_id, ring in loaded.items():
+                # Rings loaded or added to since the read began are newer.
+                if author_id not in self._rings:
+                    self._add_ring(author_id, ring)
+            self._warmed_at = started
+
+    def init_app(self, app):
+        """Warm the rings once `app` serves its first request."""
+
+        app.before_first_request(self.start_warming)
+
+    def start_warming(self):
+        """Run `warm` in a background thread."""
+
+        app = current_app._get_current_object()
+
+        def warm():
+            try:
+                with app.app_context():
+                    self.warm()
+            except Exception:
+                app.logger.exception("Warming the timeline rings failed")
+
+        self._warmer = Thread(target=warm, daemon=True, name='timeline-warm')
+        self._warmer.start()
+
+    def page(self, user_id, before=None, limit=TIMELINE_PAGE_SIZE):
+        """Messages for the home page of `user_id`, newest first, and the
+        cursor of the next page (taken from the keys, as for fan-out)."""
+
+        position = Message.parse_cursor(before)
+        if position:
+            position = to_key(*position)
+
+        snapshots, boundary = self._snapshots(self._following_ids(user_id))
+
+        streams = [newest_first(snapshot, position) for snapshot in snapshots]
+        keys = list(islice(merge(*streams, reverse=True), limit))
+
+        # Past the oldest key of a truncated ring, that author's older
+        # messages would be missing from the merge: ask the database.
+        if boundary is not None and (len(keys) < limit or keys[-1] < boundary):
+            return super().page(user_id, before=before, limit=limit)
+
+        next_cursor = (Message.make_cursor(*from_key(keys[-1]))
+                       if len(keys) == limit else None)
+        return (read_models.messages_by_id([msg_id for _, msg_id in keys]),
+                next_cursor)
+
+    def message_added(self, msg):
+        """Add `msg` to the ring of its author."""
+
+        key = to_key(msg.timestamp, msg.id)
+
+        with self._lock:
+            ring = self._rings.get(msg.user_id)
+            if ring is None and self._is_complete():
+                ring = self._add_ring(msg.user_id)
+
+            # Without a ring, it will be loaded with this message in it.
+            if ring is not None:
+                ring.append(key, self.ring_size)
+
+    def message_deleted(self, msg_id, author_id):
+        """Remove the message from the ring of its author."""
+
+        with self._lock:
+            ring = self._rings.get(author_id)
+            if ring is not None:
+                ring.remove(msg_id, self.ring_size)
+
+    def _snapshots(self, author_ids):
+        """Snapshots of the rings of `author_ids`, loading missing (and
+        old) ones.
+
+        Also returns the newest "oldest key" among truncated rings.
+        """
+
+        rings = []
+        missing = []
+
+        with self._lock:
+            complete = self._is_complete()
+            for author_id in author_ids:
+                ring = self._rings.get(author_id)
+                if ring is not None and not self._expired(ring.loaded_at):
+                    self._rings.move_to_end(author_id)
+                    rings.append(ring)
+                elif ring is not None or not complete:
+                    missing.append(author_id)
+
+        if missing:
+            rings.extend(self._load_rings(missing))
+
+        snapshots = []
+        boundary = None
+
+        with self._lock:
+            for ring in rings:
+                if len(ring):
+                    snapshots.append(ring.snapshot())
+                    if ring.truncated:
+                        oldest = ring.key(0)
+                        boundary = oldest if boundary is None else max(boundary, oldest)
+
+        return snapshots, boundary
+
+    def _load_rings(self, author_ids):
+        """Load the rings of `author_ids` from the messages table."""
+
+        loaded = {author_id: AuthorRing() for author_id in author_ids}
+        loaded.update(self._read_rings(author_ids))
+
+        with self._lock:
+            for author_id, ring in loaded.items():
+                self._add_ring(author_id, ring)
+
+        return loaded.values()
+
+    def _read_rings(self, author_ids=None, loaded_at=None):
+        """Rings of the newest messages of `author_ids` (or of every
+        author), read from the messages table."""
+
+        ranked = db.session.query(
+            Message.user_id, Message.timestamp, Message.id,
+            db.func.row_number().over(
+                partition_by=Message.user_id,
+                order_by=(Message.timestamp.desc(), Message.id.desc()),
+            ).label('rank'))
+        if author_ids is not None:
+            ranked = ranked.filter(Message.user_id.in_(author_ids))
+        ranked = ranked.subquery()
+
+        rows = (db.session
+                .query(ranked.c.user_id, ranked.c.timestamp, ranked.c.id)
+                .filter(ranked.c.rank <= self.ring_size)
+                .order_by(ranked.c.user_id, ranked.c.timestamp, ranked.c.id)
+                .yield_per(10000))
+
+        rings = {}
+        for author_id, timestamp, msg_id in rows:
+            ring = rings.get(author_id)
+            if ring is None:
+                ring = rings[author_id] = AuthorRing(loaded_at)
+            ring.append(to_key(timestamp, msg_id), self.ring_size)
+
+        for ring in rings.values():
+            # Exactly ring_size rows may mean more were left behind.
+            ring.truncated = len(ring) >= self.ring_size
+
+        return rings
+
+    def _expired(self, loaded_at):
+        return (self.max_age is not None
+                and monotonic() - loaded_at > self.max_age)
+
+    def _is_complete(self):
+        """Does every author with messages have a ring? (lock must be held)
+
+        Only until `max_age` after warming, as other processes may have
+        given new authors messages since.
+        """
+
+        return self._complete and not self._expired(self._warmed_at)
+
+    def _add_ring(self, author_id, ring=None):
+        """Store a ring for `author_id`, evicting if over `max_authors`.
+
+        The lock must be held.
+        """
+
+        ring = ring if ring is not None else AuthorRing()
+        self._rings[author_id] = ring
+        self._rings.move_to_end(author_id)
+
+        while len(self._rings) > self.max_authors:
+            self._rings.popitem(last=False)
+            self._complete = False
+
+        return ring
+
+    def _following_ids(self, user_id):
+        """Ids of everyone `user_id` follows."""
+
+        if self.follow_graph is not None:
+            return self.follow_graph.following_ids(user_id)
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id))
+        return [followed_id for (followed_id,) in rows]
+
+
+def make_timeline(config, follow_graph=None):
+    """Create the timeline strategy selected by TIMELINE_MODE in `config`.
+
+    The 'ring' strategy reads followed ids from `follow_graph`, if given.
+    """
+
+    mode = config.get('TIMELINE_MODE', 'join')
+
+    if mode == 'fanout':
+        store = MemoryTimelineStore(
+            max_length=config.get('TIMELINE_MAX_LENGTH', 800),
+            max_users=config.get('TIMELINE_MAX_USERS', 100000),
+            max_age=config.get('TIMELINE_MAX_AGE'),
+        )
+        return FanoutTimeline(
+            store,
+            fanout_threshold=config.get('TIMELINE_FANOUT_THRESHOLD', 10000),
+        )
+
+    if mode == 'ring':
+        return RingBufferTimeline(
+            ring_size=config.get('TIMELINE_RING_SIZE', 100),
+            max_authors=config.get('TIMELINE_MAX_AUTHORS', 100000),
+            max_age=config.get('TIMELINE_MAX_AGE'),
+            follow_graph=follow_graph,
+        )
+
+    return JoinTimeline()
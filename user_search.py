@@ -0,0 +1,365 @@
+"""Username (and bio) search for the user directory.
+
+On PostgreSQL with the pg_trgm extension, searches use trigram GIN
+indexes on users.username and users.bio and rank by trigram similarity.
+On other databases (e.g. SQLite test setups), an in-process n-gram and
+prefix index of the users table is used instead.
+
+The trigram indexes are created along with the users table when the
+extension can be installed; for existing databases, run
+`flask create-search-indexes`.
+
+Results are ranked: exact username, username prefix, closest username
+substring matches, then bio matches. Queries shorter than
+MIN_QUERY_LENGTH (too short for a trigram) only match username prefixes,
+exact match first and then shortest, with either backend.
+"""
+
+from bisect import bisect_left, insort
+from collections import defaultdict
+from threading import Lock, Thread
+from time import monotonic
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+
+from models import db, User
+
+USERS_PER_PAGE = 30
+
+# Shorter queries only match username prefixes.
+MIN_QUERY_LENGTH = 3
+
+TRIGRAM_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm"
+    " ON users USING gin (username gin_trgm_ops);"
+    "CREATE INDEX IF NOT EXISTS ix_users_bio_trgm"
+    " ON users USING gin (bio gin_trgm_ops);"
+)
+
+
+def create_trigram_indexes(connection):
+    """Install pg_trgm and index users.username and users.bio with it.
+
+    Returns whether the indexes exist: not on other databases, nor when
+    the extension isn't available or the database user may not install
+    it.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        return False
+
+    available = connection.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'").first()
+    if available is None:
+        return False
+
+    try:
+        with connection.begin_nested():
+            connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DBAPIError:
+        return False
+
+    connection.execute(TRIGRAM_INDEXES)
+    return True
+
+
+@event.listens_for(User.__table__, 'after_create')
+def add_trigram_indexes(target, connection, **kw):
+    create_trigram_indexes(connection)
+
+
+def trigrams(text):
+    """Set of 3-character substrings of lowercased `text`."""
+
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramUserSearch:
+    """Search users with pg_trgm indexes in PostgreSQL."""
+
+    def search(self, q, offset=0, limit=USERS_PER_PAGE):
+        """Users matching `q`, best first."""
+
+        if len(q) < MIN_QUERY_LENGTH:
+            return self._prefix_search(q, offset, limit)
+
+        pattern = '%{}%'.format(q.replace('\\', '\\\\')
+                                 .replace('%', '\\%')
+                                 .replace('_', '\\_'))
+        username = db.func.lower(User.username)
+
+        return (User
+                .query
+                .filter(db.or_(User.username.ilike(pattern),
+                               User.bio.ilike(pattern)))
+                .order_by((username == q.lower()).desc(),
+                          username.startswith(q.lower(), autoescape=True).desc(),
+                          User.username.ilike(pattern).desc(),
+                          db.func.similarity(User.username, q).desc(),
+                          User.id)
+                .offset(offset)
+                .limit(limit)
+                .all())
+
+    def _prefix_search(self, q, offset, limit):
+        """Users whose username starts with `q`, exact match first, then
+        shortest."""
+
+        username = db.func.lower(User.username)
+
+        return (User
+                .query
+                .filter(username.startswith(q.lower(), autoescape=True))
+                .order_by((username == q.lower()).desc(),
+                          db.func.length(User.username),
+                          User.id)
+                .offset(offset)
+                .limit(limit)
+                .all())
+
+    def changed(self, user):
+        """The database indexes keep themselves up to date."""
+
+    def removed(self, user_id):
+        """The database indexes keep themselves up to date."""
+
+
+class MemoryUserSearch:
+    """In-process n-gram and prefix index of usernames and bios.
+
+    Queries of at least MIN_QUERY_LENGTH characters look up trigram
+    postings and then check the candidates; shorter queries only match
+    username prefixes.
+    The index is built from the users table on first use. Once it is
+    older than `max_age` seconds it is rebuilt in a background thread,
+    one at a time, while searches use the old index; users changed
+    meanwhile are applied to both.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._built_at = None
+        self._changes = None
+        self._refreshing = False
+        self._refresher = None
+        self._lock = Lock()
+        self._build_lock = Lock()
+        self._users = {}
+        self._username_grams = defaultdict(set)
+        self._bio_grams = defaultdict(set)
+        self._prefixes = []
+
+    def rebuild(self):
+        """Reload the index from the users table."""
+
+        with self._build_lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        """Reload the index (build lock must be held)."""
+
+        with self._lock:
+            self._changes = []
+
+        try:
+            rows = (db.session
+                    .query(User.id, User.username, User.bio)
+                    .yield_per(10000))
+
+            fresh = MemoryUserSearch()
+            for user_id, username, bio in rows:
+                fresh._add(user_id, username, bio)
+            fresh._prefixes = sorted((username.lower(), user_id)
+                                     for user_id, (username, _)
+                                     in fresh._users.items())
+
+            with self._lock:
+                # Users changed while the table was read may be stale.
+                for user_id, user in self._changes:
+                    if user is None:
+                        fresh._remove(user_id)
+                    else:
+                        fresh._update(user_id, *user)
+
+                self._users = fresh._users
+                self._username_grams = fresh._username_grams
+                self._bio_grams = fresh._bio_grams
+                self._prefixes = fresh._prefixes
+                self._built_at = monotonic()
+
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def _ensure_built(self):
+        if self._built_at is None:
+            with self._build_lock:
+                if self._built_at is None:
+                    self._rebuild()
+
+        elif (self.max_age is not None
+                and monotonic() - self._built_at > self.max_age):
+            self._refresh()
+
+    def _refresh(self):
+        """Rebuild in the background, unless that is already happening."""
+
+        if not has_app_context():
+            self.rebuild()
+            return
+
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        app = current_app._get_current_object()
+
+        def refresh():
+            try:
+                with app.app_context():
+                    self.rebuild()
+            except Exception:
+                app.logger.exception("Reloading the user search index failed")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        self._refresher = Thread(target=refresh, daemon=True,
+                                 name='user-search')
+        self._refresher.start()
+
+    def search(self, q, offset=0, limit=USERS_PER_PAGE):
+        """Users matching `q`, best first."""
+
+        self._ensure_built()
+
+        with self._lock:
+            ranked = sorted(self._matches(q.lower()))
+
+        ids = [user_id for *_, user_id in ranked[offset:offset + limit]]
+        if not ids:
+            return []
+
+        found = {user.id: user
+                 for user in User.query.filter(User.id.in_(ids))}
+        return [found[user_id] for user_id in ids if user_id in found]
+
+    def changed(self, user):
+        """Index a new or edited user."""
+
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((user.id, (user.username, user.bio)))
+            if self._built_at is None:
+                return
+            self._update(user.id, user.username, user.bio)
+
+    def removed(self, user_id):
+        """Drop a deleted user from the index."""
+
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((user_id, None))
+            if self._built_at is None:
+                return
+            self._remove(user_id)
+
+    def _matches(self, q):
+        """(rank, ..., user_id) tuples for users matching `q`.
+
+        The lock must be held.
+        """
+
+        if len(q) < MIN_QUERY_LENGTH:
+            start = bisect_left(self._prefixes, (q,))
+            for username, user_id in self._prefixes[start:]:
+                if not username.startswith(q):
+                    break
+                yield (username != q, len(username), user_id)
+            return
+
+        grams = trigrams(q)
+
+        for user_id in set.intersection(*(self._username_grams.get(g, set())
+                                          for g in grams)):
+            username = self._users[user_id][0].lower()
+            if q in username:
+                rank = 0 if username == q else 1 if username.startswith(q) else 2
+                yield (rank, len(username), user_id)
+
+        for user_id in set.intersection(*(self._bio_grams.get(g, set())
+                                          for g in grams)):
+            username, bio = self._users[user_id]
+            if q in bio.lower() and q not in username.lower():
+                yield (3, len(username), user_id)
+
+    def _add(self, user_id, username, bio):
+        self._users[user_id] = (username, bio or '')
+        for gram in trigrams(username):
+            self._username_grams[gram].add(user_id)
+        for gram in trigrams(bio or ''):
+            self._bio_grams[gram].add(user_id)
+
+    def _update(self, user_id, username, bio):
+        self._remove(user_id)
+        self._add(user_id, username, bio)
+        insort(self._prefixes, (username.lower(), user_id))
+
+    def _remove(self, user_id):
+        if user_id not in self._users:
+            return
+
+        username, bio = self._users.pop(user_id)
+
+        entry = (username.lower(), user_id)
+        i = bisect_left(self._prefixes, entry)
+        if i < len(self._prefixes) and self._prefixes[i] == entry:
+            del self._prefixes[i]
+
+        for gram in trigrams(username):
+            self._username_grams[gram].discard(user_id)
+        for gram in trigrams(bio):
+            self._bio_grams[gram].discard(user_id)
+
+
+class UserSearch:
+    """Pick a search backend the first time it is needed.
+
+    pg_trgm is used when the database is PostgreSQL and the extension is
+    installed; otherwise users are searched in memory.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = (TrigramUserSearch() if has_pg_trgm()
+                             else MemoryUserSearch(self.max_age))
+        return self._backend
+
+    def search(self, q, offset=0, limit=USERS_PER_PAGE):
+        return self.backend.search(q, offset, limit)
+
+    def changed(self, user):
+        self.backend.changed(user)
+
+    def removed(self, user_id):
+        self.backend.removed(user_id)
+
+
+def has_pg_trgm():
+    """Is the database PostgreSQL with the pg_trgm extension installed?"""
+
+    if db.engine.dialect.name != 'postgresql':
+        return False
+
+    installed = db.session.execute(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").first()
+    return installed is not None